@@ -1,5 +1,7 @@
 import datetime
+import uuid
 
+from django.core import signing
 from django.utils.crypto import salted_hmac
 
 from ratings import settings
@@ -8,9 +10,16 @@ def get_name(instance, key):
     """
     Return a cookie name for anonymous vote of *instance* using *key*.
     """
+    return get_name_for(str(instance._meta), instance.pk, key)
+
+def get_name_for(label, object_id, key):
+    """
+    Return a cookie name for anonymous vote of the object *object_id*
+    of the model *label* ('app_label.model') using *key*.
+    """
     mapping = {
-        'model': str(instance._meta),
-        'object_id': instance.pk,
+        'model': label,
+        'object_id': object_id,
         'key': key,
     }
     return settings.COOKIE_NAME_PATTERN % mapping
@@ -20,4 +29,63 @@ def get_value(ip_address):
     Return a cookie value for an anonymous vote.
     """
     now = datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
-    return salted_hmac("gr.cookie", "%s-%s" % (now, ip_address)).hexdigest()
\ No newline at end of file
+    return salted_hmac("gr.cookie", "%s-%s" % (now, ip_address)).hexdigest()
+
+# VOTER COOKIE
+
+def _get_signer():
+    return signing.Signer(salt='ratings.cookies.voter')
+
+def new_voter_id():
+    """
+    Return a brand new anonymous voter id.
+    """
+    return uuid.uuid4().hex
+
+def get_voter_value(voter_id):
+    """
+    Return the signed voter cookie value for *voter_id*.
+    """
+    return _get_signer().sign(voter_id)
+
+def load_voter_id(cookies):
+    """
+    Return the voter id stored in the signed voter cookie contained in
+    the *cookies* dict. Return None if the cookie is missing or its
+    signature is not valid.
+    
+    The signature is checked at each call: use *get_voter_id* to check
+    it only once for each request (e.g. when a page displays a lot of 
+    rating forms).
+    """
+    value = cookies.get(settings.VOTER_COOKIE_NAME)
+    if not value:
+        return None
+    try:
+        return _get_signer().unsign(value)
+    except signing.BadSignature:
+        return None
+
+def get_voter_id(request, create=False):
+    """
+    Return the id of the anonymous voter sending *request*, resolved
+    only once for each request.
+
+    If the request does not contain a valid voter cookie return None, or,
+    if *create* is True, a brand new voter id: in this case the voter
+    cookie must be set to the response (see *voter_id_created*).
+    """
+    try:
+        voter_id = request._ratings_voter_id
+    except AttributeError:
+        voter_id = request._ratings_voter_id = load_voter_id(request.COOKIES)
+    if voter_id is None and create:
+        voter_id = request._ratings_voter_id = new_voter_id()
+        request._ratings_voter_created = True
+    return voter_id
+
+def voter_id_created(request):
+    """
+    Return True if a new voter id was created for *request*.
+    """
+    return getattr(request, '_ratings_voter_created', False)
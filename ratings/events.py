@@ -0,0 +1,143 @@
+"""
+Live score updates.
+
+Each time a score is recalculated by *upsert_score*, its new values are
+published to the event *bus*, using the target *(content_type_id,
+object_id, key)* as topic. Subscribers (e.g. the *ratings_events* view,
+which streams changes to browsers as Server-Sent Events) receive the
+latest values of the targets they subscribed to.
+
+Changes are coalesced: if a target changes many times before the
+subscriber reads its events, only the most recent values are delivered.
+
+The default bus dispatches events between the threads of the current
+process, so publishing never involves an external broker. Deployments
+running many processes can replace *bus* with an object having the same
+*subscribe* and *publish* methods, backed by a message broker.
+"""
+import threading
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import simplejson as json
+
+# the score fields published for each change
+SCORE_FIELDS = ('average', 'total', 'num_votes', 'version')
+
+
+class Subscription(object):
+    """
+    The pending changes of the *targets* subscribed to *bus*.
+    Only the latest values of each target are kept.
+    """
+    def __init__(self, bus, targets):
+        self.bus = bus
+        self.targets = frozenset(targets)
+        self.pending = {}
+        self.condition = threading.Condition()
+
+    def put(self, target, data):
+        with self.condition:
+            self.pending[target] = data
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        Return the pending changes as a list of *(target, data)*, waiting
+        at most *timeout* seconds for a change if none is pending.
+        Return an empty list if nothing changed.
+        """
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+            events, self.pending = self.pending.items(), {}
+        return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus(object):
+    """
+    In-process publish/subscribe of score changes.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def subscribe(self, targets):
+        """
+        Return a new *Subscription* to the given sequence of targets.
+        The subscription must be closed when it is no longer used.
+        """
+        subscription = Subscription(self, targets)
+        with self.lock:
+            for target in subscription.targets:
+                self.subscriptions.setdefault(target, set()).add(
+                    subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for target in subscription.targets:
+                subscriptions = self.subscriptions.get(target, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self.subscriptions.pop(target, None)
+
+    def publish(self, target, data):
+        """
+        Deliver *data* to the subscribers of *target*.
+        """
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(target, ()))
+        for subscription in subscriptions:
+            subscription.put(target, data)
+
+
+bus = EventBus()
+
+def publish_score(score):
+    """
+    Publish the current values of *score* (see *SCORE_FIELDS*).
+    """
+    target = (score.content_type_id, score.object_id, score.key)
+    bus.publish(target, dict((i, getattr(score, i)) for i in SCORE_FIELDS))
+
+def format_event(target, data):
+    """
+    Return the Server-Sent Event for the change of *target*, whose
+    data is json containing the content type ('app_label.model'),
+    the object id, the key and the score fields.
+    """
+    content_type_id, object_id, key = target
+    content_type = ContentType.objects.get_for_id(content_type_id)
+    data = dict(data, content_type='%s.%s' % (content_type.app_label,
+        content_type.model), object_id=object_id, key=key)
+    return 'event: score\ndata: %s\n\n' % json.dumps(data,
+        separators=(',', ':'))
+
+def stream(subscription, interval=1, heartbeat=15):
+    """
+    Yield Server-Sent Events for the changes received by *subscription*,
+    closing the subscription when the iteration ends.
+
+    After each burst of messages, the stream waits *interval* seconds,
+    so that at most one message per target is sent in each interval.
+    A comment is sent after *heartbeat* seconds without changes, keeping
+    the connection alive.
+    """
+    try:
+        # telling the client how long to wait before reconnecting
+        yield 'retry: %d\n\n' % (max(interval, 1) * 1000)
+        while True:
+            events = subscription.get(heartbeat)
+            if not events:
+                yield ': keepalive\n\n'
+                continue
+            for target, data in events:
+                yield format_event(target, data)
+            if interval:
+                time.sleep(interval)
+    finally:
+        subscription.close()
@@ -0,0 +1,243 @@
+"""
+Streaming export of votes.
+
+Votes are read in batches of primary keys through *values_list*, so that
+neither model instances nor content objects are loaded, and each batch
+is handed to a writer: memory usage does not depend on the number of
+exported votes.
+
+Available formats are *csv*, *npy* (a NumPy structured array), *npz*
+(a NumPy array for each column) and *parquet*. NumPy formats require
+NumPy, and Parquet requires pyarrow.
+"""
+import csv
+import os
+import shutil
+import tempfile
+import zipfile
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+
+try:
+    import numpy
+    from numpy.lib import format as npformat
+except ImportError:
+    numpy = npformat = None
+
+try:
+    import pyarrow
+    from pyarrow import parquet
+except ImportError:
+    pyarrow = parquet = None
+
+COLUMNS = ('id', 'content_type', 'object_id', 'key', 'score', 'user',
+    'ip_address', 'cookie', 'created_at', 'modified_at')
+
+def get_rows(queryset, batch_size=10000):
+    """
+    Yield lists of at most *batch_size* rows for the votes in *queryset*.
+    Each row is a tuple of values for *COLUMNS*: the content type is
+    given as 'app_label.model' and datetimes are naive and in UTC.
+    """
+    queryset = queryset.order_by('pk').values_list('id', 'content_type',
+        'object_id', 'key', 'score', 'user', 'ip_address', 'cookie',
+        'created_at', 'modified_at')
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_id)[:batch_size])
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[:1] + (_get_label(row[1]),) + row[2:8] +
+            (_get_utc(row[8]), _get_utc(row[9])) for row in rows]
+
+def _get_label(content_type_id):
+    content_type = ContentType.objects.get_for_id(content_type_id)
+    return u'%s.%s' % (content_type.app_label, content_type.model)
+
+def _get_utc(value):
+    if value is not None and timezone.is_aware(value):
+        return timezone.make_naive(value, timezone.utc)
+    return value
+
+
+class CSVWriter(object):
+    """
+    Write votes as CSV, with a header row, to the file-like object
+    *output*. Null values are written as empty strings.
+    """
+    def __init__(self, output):
+        self.writer = csv.writer(output)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows([[self._format(i) for i in row]
+            for row in rows])
+
+    def _format(self, value):
+        if value is None:
+            return ''
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def close(self):
+        pass
+
+
+class NPYWriter(object):
+    """
+    Write votes as a NumPy structured array, with a field for each column,
+    to the file at *path*. Null users are written as -1, and null ip 
+    addresses and cookies as empty strings.
+
+    Rows are first appended to a temporary file, since the array header
+    needs the number of rows: the array is then copied in chunks using
+    a memory mapped file.
+    """
+    def __init__(self, path, chunk_size=10000):
+        if numpy is None:
+            raise ImproperlyConfigured('NumPy is required to export votes '
+                'as arrays.')
+        labels = [_get_label(i.pk) for i in ContentType.objects.all()]
+        self.dtype = numpy.dtype([
+            ('id', numpy.int64),
+            ('content_type', 'S%d' % max([len(i) for i in labels] or [1])),
+            ('object_id', numpy.int64),
+            ('key', 'S16'),
+            ('score', numpy.float64),
+            ('user', numpy.int64),
+            ('ip_address', 'S15'),
+            ('cookie', 'S64'),
+            ('created_at', 'datetime64[us]'),
+            ('modified_at', 'datetime64[us]'),
+        ])
+        self.path = path
+        self.chunk_size = chunk_size
+        self.counter = 0
+        self._open_buffers()
+
+    def _open_buffers(self):
+        # the temporary file where rows are appended
+        self.buffer = tempfile.TemporaryFile()
+
+    def write(self, rows):
+        array = numpy.array([self._format(row) for row in rows],
+            dtype=self.dtype)
+        array.tofile(self.buffer)
+        self.counter += len(array)
+
+    def _format(self, row):
+        user = -1 if row[5] is None else row[5]
+        return (row[0], row[1].encode('utf-8'), row[2],
+            row[3].encode('utf-8'), row[4], user, (row[6] or '').encode(
+            'utf-8'), (row[7] or '').encode('utf-8'), row[8], row[9])
+
+    def _copy(self, buffer, dtype, path):
+        # copying the temporary rows in a .npy file, chunk by chunk
+        array = npformat.open_memmap(path, mode='w+', dtype=dtype,
+            shape=(self.counter,))
+        buffer.seek(0)
+        for start in xrange(0, self.counter, self.chunk_size):
+            chunk = numpy.fromfile(buffer, dtype=dtype,
+                count=min(self.chunk_size, self.counter - start))
+            array[start:start + len(chunk)] = chunk
+        array.flush()
+        del array
+
+    def close(self):
+        self._copy(self.buffer, self.dtype, self.path)
+        self.buffer.close()
+
+
+class NPZWriter(NPYWriter):
+    """
+    Write votes as a NumPy *.npz* archive, containing an array for each
+    column (see *NPYWriter*), to the file at *path*.
+    """
+    def _open_buffers(self):
+        # a temporary file for each column
+        self.buffers = [tempfile.TemporaryFile() for i in COLUMNS]
+
+    def write(self, rows):
+        array = numpy.array([self._format(row) for row in rows],
+            dtype=self.dtype)
+        for column, buffer in zip(COLUMNS, self.buffers):
+            array[column].tofile(buffer)
+        self.counter += len(array)
+
+    def close(self):
+        archive = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED,
+            allowZip64=True)
+        directory = tempfile.mkdtemp()
+        try:
+            for column, buffer in zip(COLUMNS, self.buffers):
+                path = os.path.join(directory, column + '.npy')
+                self._copy(buffer, self.dtype[column], path)
+                buffer.close()
+                archive.write(path, column + '.npy')
+                os.remove(path)
+        finally:
+            archive.close()
+            shutil.rmtree(directory)
+
+
+class ParquetWriter(object):
+    """
+    Write votes as a Parquet file at *path*, with a row group for
+    each batch of votes.
+    """
+    def __init__(self, path):
+        if pyarrow is None:
+            raise ImproperlyConfigured('pyarrow is required to export votes '
+                'as Parquet.')
+        self.schema = pyarrow.schema([
+            pyarrow.field('id', pyarrow.int64()),
+            pyarrow.field('content_type', pyarrow.string()),
+            pyarrow.field('object_id', pyarrow.int64()),
+            pyarrow.field('key', pyarrow.string()),
+            pyarrow.field('score', pyarrow.float64()),
+            pyarrow.field('user', pyarrow.int64()),
+            pyarrow.field('ip_address', pyarrow.string()),
+            pyarrow.field('cookie', pyarrow.string()),
+            pyarrow.field('created_at', pyarrow.timestamp('us')),
+            pyarrow.field('modified_at', pyarrow.timestamp('us')),
+        ])
+        self.writer = parquet.ParquetWriter(path, self.schema)
+
+    def write(self, rows):
+        columns = zip(*rows)
+        self.writer.write_table(pyarrow.Table.from_arrays([
+            pyarrow.array(list(values), type=field.type)
+            for values, field in zip(columns, self.schema)],
+            schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+FORMATS = {
+    'csv': CSVWriter,
+    'npy': NPYWriter,
+    'npz': NPZWriter,
+    'parquet': ParquetWriter,
+}
+
+def export_votes(queryset, writer, batch_size=10000):
+    """
+    Write the votes in *queryset* using the given *writer* (see *FORMATS*),
+    reading votes in batches of *batch_size*. The writer is closed at
+    the end. Return the number of exported votes.
+    """
+    counter = 0
+    try:
+        for rows in get_rows(queryset, batch_size=batch_size):
+            writer.write(rows)
+            counter += len(rows)
+    finally:
+        writer.close()
+    return counter
@@ -1,14 +1,62 @@
+import hashlib
+import hmac
 import time
 
 from django import forms
+from django.conf import settings as django_settings
 from django.contrib.contenttypes.models import ContentType
-from django.utils.crypto import salted_hmac, constant_time_compare
-from django.utils.encoding import force_unicode
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_unicode, force_bytes
 
 from ratings import cookies, exceptions, settings
 
 from widgets import SliderWidget, StarWidget
 
+_hmac_cache = {}
+
+def validate_score(score, score_range=None, score_step=None):
+    """
+    Raise a *ValidationError* if *score* is not in *score_range* or is
+    not valid for *score_step* (both optional).
+    """
+    # score range, if given we have to check score is in that range
+    if score_range:
+        if not (score_range[0] <= score <= score_range[1]):
+            raise forms.ValidationError('Score is not in range')
+    # check score steps
+    if score_step:
+        try:
+            _, decimals = str(score_step).split('.')
+        except ValueError:
+            decimal_places = 0
+        else:
+            decimal_places = len(decimals) if int(decimals) else 0
+        if not decimal_places and int(score) != score:
+            raise forms.ValidationError('Score is not in steps')
+        factor = 10 ** decimal_places
+        if int(score * factor) % int(score_step * factor):
+            raise forms.ValidationError('Score is not in steps')
+
+def security_hmac(key_salt, value):
+    """
+    Return the HMAC-SHA1 of *value*, using a key generated from *key_salt*
+    and the project's secret key.
+
+    The result is the same as *django.utils.crypto.salted_hmac*, but the
+    key derivation (and the HMAC key setup) is done only once per process
+    for each *key_salt*.
+    """
+    secret = django_settings.SECRET_KEY
+    try:
+        base = _hmac_cache[key_salt, secret]
+    except KeyError:
+        key = hashlib.sha1((key_salt + secret).encode('utf-8')).digest()
+        base = _hmac_cache[key_salt, secret] = hmac.new(key,
+            digestmod=hashlib.sha1)
+    mac = base.copy()
+    mac.update(force_bytes(value))
+    return mac
+
 class VoteForm(forms.Form):
     """
     Form class to handle voting of content objects.
@@ -24,6 +72,10 @@ class VoteForm(forms.Form):
           the vote model
         - the form must define the *delete* method, getting the request and
           returning True if the form requests the deletion of the vote
+
+    If *cacheable* is True, the security data is not included in the form,
+    so that the form markup does not change over time: it must be then
+    filled before voting (see *RatingHandler.cacheable_forms*).
     """
     # rating data
     content_type  = forms.CharField(widget=forms.HiddenInput)
@@ -37,16 +89,20 @@ class VoteForm(forms.Form):
     honeypot = forms.CharField(required=False, widget=forms.HiddenInput)
 
     def __init__(self, target_object, key, score_range=None, score_step=None,
-        can_delete_vote=None, data=None, initial=None, request=None):
+        can_delete_vote=None, data=None, initial=None, request=None,
+        voter_cookie=False, using=None, cacheable=False):
         self.target_object = target_object
         self.key = key
         self.score_range = score_range
         self.score_step = score_step
         self.can_delete_vote = can_delete_vote
         self.request = request
+        self.voter_cookie = voter_cookie
+        self.using = using
         if initial is None:
             initial = {}
-        initial.update(self.generate_security_data())
+        if not cacheable:
+            initial.update(self.generate_security_data())
         super(VoteForm, self).__init__(data=data, initial=initial)
         self.fields['score'] = self.get_score_field(score_range, score_step,
             can_delete_vote)
@@ -116,14 +172,14 @@ class VoteForm(forms.Form):
         """
         Generate a dict of security data for *initial* data.
         """
-        timestamp = int(time.time())
         security_dict = {
             'content_type': str(self.target_object._meta),
             'object_pk': str(self.target_object._get_pk_val()),
             'key': str(self.key),
-            'timestamp': str(timestamp),
-            'security_hash': self.initial_security_hash(timestamp),
+            'timestamp': str(int(time.time())),
         }
+        security_dict['security_hash'] = self.generate_security_hash(
+            **security_dict)
         return security_dict
 
     def initial_security_hash(self, timestamp):
@@ -145,7 +201,7 @@ class VoteForm(forms.Form):
         """
         key_salt = 'ratings.forms.VoteForm'
         value = '-'.join((content_type, object_pk, key, timestamp))
-        return salted_hmac(key_salt, value).hexdigest()
+        return security_hmac(key_salt, value).hexdigest()
 
     # VOTE
 
@@ -164,25 +220,27 @@ class VoteForm(forms.Form):
                 raise forms.ValidationError('Vote deletion is not allowed')
             self._delete_vote = True
             return score
-        # score range, if given we have to check score is in that range
-        if self.score_range:
-            if not (self.score_range[0] <= score <= self.score_range[1]):
-                raise forms.ValidationError('Score is not in range')
-        # check score steps
-        if self.score_step:
-            try:
-                _, decimals = str(self.score_step).split('.')
-            except ValueError:
-                decimal_places = 0
-            else:
-                decimal_places = len(decimals) if int(decimals) else 0
-            if not decimal_places and int(score) != score:
-                raise forms.ValidationError('Score is not in steps')
-            factor = 10 ** decimal_places
-            if int(score * factor) % int(self.score_step * factor):
-                raise forms.ValidationError('Score is not in steps')
+        validate_score(score, self.score_range, self.score_step)
         return score
 
+    def get_cookie_value(self, request):
+        """
+        Return the cookie value identifying the anonymous user that maybe
+        voted the target object, or None if the user does not own a cookie.
+        """
+        if self.voter_cookie:
+            return cookies.get_voter_id(request)
+        cookie_name = cookies.get_name(self.target_object, self.key)
+        return request.COOKIES.get(cookie_name)
+
+    def get_new_cookie_value(self, request):
+        """
+        Return the cookie value used to identify a new anonymous vote.
+        """
+        if self.voter_cookie:
+            return cookies.get_voter_id(request, create=True)
+        return cookies.get_value(request.META.get('REMOTE_ADDR'))
+
     def get_vote_model(self):
         """
         Return the vote model used to rate an object.
@@ -216,15 +274,15 @@ class VoteForm(forms.Form):
             # votes are handled by cookies
             if not ip_address:
                 raise exceptions.DataError('Invalid ip address')
-            cookie_name = cookies.get_name(self.target_object, self.key)
-            cookie_value = request.COOKIES.get(cookie_name)
+            cookie_value = self.get_cookie_value(request)
             if cookie_value:
-                # the user maybe voted this object (it has a cookie)
+                # the user maybe voted this object (it has a cookie): the
+                # lookup uses the (content_type, object_id, key, cookie) index
                 lookups.update({'cookie': cookie_value, 'user__isnull':True})
                 data['cookie'] = cookie_value
             else:
                 lookups = None
-                data['cookie'] = cookies.get_value(ip_address)
+                data['cookie'] = self.get_new_cookie_value(request)
         elif request.user.is_authenticated():
             # votes are handled by database (django users)
             lookups.update({'user': request.user, 'cookie__isnull': True})
@@ -251,17 +309,20 @@ class VoteForm(forms.Form):
         model = self.get_vote_model()
         lookups, data = self.get_vote_data(request, allow_anonymous)
         if lookups is None:
-            return model(**data)
-        try:
-            # trying to get an existing vote
-            vote = model.objects.get(**lookups)
-        except model.DoesNotExist:
-            # create a brand new vote
             vote = model(**data)
         else:
-            # change data for existting vote
-            vote.score = data['score']
-            vote.ip_address = data['ip_address']
+            try:
+                # trying to get an existing vote
+                vote = model.objects.using(self.using).get(**lookups)
+            except model.DoesNotExist:
+                # create a brand new vote
+                vote = model(**data)
+            else:
+                # change data for existting vote
+                vote.score = data['score']
+                vote.ip_address = data['ip_address']
+        # the target object can live in a database other than the vote one
+        vote._content_object_cache = self.target_object
         return vote
 
     # DELETE
@@ -346,23 +407,7 @@ class StarVoteCommentForm(StarVoteForm):
         # a 0 score means the user want to delete his vote
         if score == 0:
             return score
-        # score range, if given we have to check score is in that range
-        if self.score_range:
-            if not (self.score_range[0] <= score <= self.score_range[1]):
-                raise forms.ValidationError('Score is not in range')
-        # check score steps
-        if self.score_step:
-            try:
-                _, decimals = str(self.score_step).split('.')
-            except ValueError:
-                decimal_places = 0
-            else:
-                decimal_places = len(decimals) if int(decimals) else 0
-            if not decimal_places and int(score) != score:
-                raise forms.ValidationError('Score is not in steps')
-            factor = 10 ** decimal_places
-            if int(score * factor) % int(self.score_step * factor):
-                raise forms.ValidationError('Score is not in steps')
+        validate_score(score, self.score_range, self.score_step)
         return score
 
     def clean(self):
@@ -395,15 +440,15 @@ class StarVoteCommentForm(StarVoteForm):
             # votes are handled by cookies
             if not ip_address:
                 raise exceptions.DataError('Invalid ip address')
-            cookie_name = cookies.get_name(self.target_object, self.key)
-            cookie_value = request.COOKIES.get(cookie_name)
+            cookie_value = self.get_cookie_value(request)
             if cookie_value:
-                # the user maybe voted this object (it has a cookie)
+                # the user maybe voted this object (it has a cookie): the
+                # lookup uses the (content_type, object_id, key, cookie) index
                 lookups.update({'cookie': cookie_value, 'user__isnull': True})
                 data['cookie'] = cookie_value
             else:
                 lookups = None
-                data['cookie'] = cookies.get_value(ip_address)
+                data['cookie'] = self.get_new_cookie_value(request)
         elif request.user.is_authenticated():
             # votes are handled by database (django users)
             lookups.update({'user': request.user, 'cookie__isnull': True})
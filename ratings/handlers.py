@@ -1,8 +1,16 @@
-from django.db import IntegrityError
+import datetime
+import threading
+import uuid
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import IntegrityError, connections, router
 from django.db.models.base import ModelBase
 from django.db.models.signals import pre_delete as pre_delete_signal
+from django.utils import timezone
 
 from ratings import settings, models, forms, exceptions, signals, cookies
+from ratings import leaderboards, limiters, recommend, routers
 
 class RatingHandler(object):
     """
@@ -72,17 +80,91 @@ class RatingHandler(object):
         the number of allowed votes per ip address, only used if anonymous users 
         can vote (default: *0*, means no limit)
     
+    .. py:attribute:: ip_limiter_class
+    
+        the class used to count votes per ip address 
+        (default: *ratings.limiters.IPLimiter*, that counts votes in the db) 
+        use *ratings.limiters.CacheIPLimiter* to count votes in the cache
+        
+    .. py:attribute:: votes_per_ip_address_window
+    
+        the sliding window (number of seconds) used by 
+        *ratings.limiters.CacheIPLimiter* to count votes (default: one day)
+    
     .. py:attribute:: form_class
     
         form class that will be used to handle voting 
         (default: *ratings.forms.VoteForm*) 
         this app, out of the box, provides also *SliderVoteForm* and a *StarVoteForm*
         
+    .. py:attribute:: cacheable_forms
+    
+        set to True to render vote forms not containing any user dependent
+        data (the current vote and the security timestamp and hash), so that
+        pages displaying them can be cached: that data is then loaded by 
+        *ratings.js* using a single request to the *ratings_hydrate* view 
+        for all the forms in the page (default: *False*)
+        
     .. py:attribute:: cookie_max_age
     
         if anonymous rating is allowed, you can define here the cookie max age
         as a number of seconds (default: one year)
         
+    .. py:attribute:: voter_cookie
+    
+        if anonymous rating is allowed, set to True to identify anonymous 
+        voters using a single signed cookie containing a voter id, 
+        instead of setting a cookie for each voted object (default: *False*)
+        
+    .. py:attribute:: pin_reads_after_vote
+    
+        if ratings reads are sent to replicas (see *ratings.routers*), 
+        this is the number of seconds the voter's reads are pinned to 
+        the write database after voting, so that users always see their 
+        own votes (default: *0*, means reads are pinned only during 
+        the voting request)
+        
+    .. py:attribute:: vote_db
+    
+        the database alias where votes, compacted votes and comments 
+        are stored (default: *None*, means the database is chosen by 
+        the database routers)
+        
+    .. py:attribute:: score_db
+    
+        the database alias where scores are stored (default: *None*, 
+        means the database is chosen by the database routers): votes 
+        and scores are never joined, so they can live in different 
+        databases, also different from the one of the target objects
+        
+    .. py:attribute:: daily_rollups
+    
+        set to True to maintain the daily rollups of votes 
+        (see *ratings.models.VoteRollup*), used to draw trend charts 
+        and to calculate scores for a period of time 
+        (default: *settings.GENERIC_RATINGS_DAILY_ROLLUPS*)
+        
+    .. py:attribute:: leaderboard_metrics
+    
+        a sequence of score fields (*average*, *num_votes*, *total* or 
+        *variance*) for which top-N leaderboards are maintained when 
+        scores change (see *ratings.leaderboards*), e.g. *('average',)*
+        (default: *()*, means no leaderboard is maintained)
+        
+    .. py:attribute:: leaderboard_size
+    
+        the number of objects in each leaderboard (default: *10*)
+        
+    .. py:attribute:: vote_coalescing_window
+    
+        the number of seconds during which repeated changes of the same 
+        vote (e.g. while dragging a slider) are coalesced: the first change
+        is saved, while the following ones only update a pending score 
+        stored in the cache, saved (and applied to the score) once, when
+        the window ends (default: 
+        *settings.GENERIC_RATINGS_VOTE_COALESCING_WINDOW*, *0* means
+        every change is saved)
+        
     .. py:attribute:: success_messages
     
         this should be a sequence of (vote created, vote changed, vote deleted)
@@ -106,15 +188,28 @@ class RatingHandler(object):
     default_key = settings.DEFAULT_KEY
     next_querystring_key = settings.NEXT_QUERYSTRING_KEY
     votes_per_ip_address = settings.VOTES_PER_IP_ADDRESS
+    votes_per_ip_address_window = settings.VOTES_PER_IP_ADDRESS_WINDOW
     cookie_max_age = settings.COOKIE_MAX_AGE
+    voter_cookie = settings.VOTER_COOKIE
+    pin_reads_after_vote = settings.PIN_READS_AFTER_VOTE
+    vote_db = None
+    score_db = None
+    daily_rollups = settings.DAILY_ROLLUPS
+    leaderboard_metrics = ()
+    leaderboard_size = 10
+    vote_coalescing_window = settings.VOTE_COALESCING_WINDOW
     
     success_messages = None
     can_delete_vote = True
     can_change_vote = True
     form_class = forms.VoteForm
+    cacheable_forms = False
+    ip_limiter_class = limiters.IPLimiter
     
     def __init__(self, model):
         self.model = model
+        self._ip_limiter = None
+        self._local = threading.local()
             
     def get_key(self, request, instance):
         """
@@ -197,16 +292,65 @@ class RatingHandler(object):
             'can_delete_vote': self.can_delete_vote,
             'request': request,
         }
+        if self.allow_anonymous and self.voter_cookie:
+            kwargs['voter_cookie'] = True
+        if self.vote_db is not None:
+            kwargs['using'] = self.vote_db
+        if self.cacheable_forms:
+            # user dependent data is loaded by *get_vote_form_states*
+            kwargs['cacheable'] = True
+            return kwargs
         # initial vote (if present)
-        if self.allow_anonymous:
-            vote = self.get_vote(instance, key, request.COOKIES)
-        elif request.user.is_authenticated():
-            vote = self.get_vote(instance, key, request.user)
-        else:
-            vote = None
+        user_or_cookies = self._get_voter(request)
+        vote = None
+        if user_or_cookies is not None:
+            vote = self.get_vote(instance, key, user_or_cookies)
         if vote is not None:
             kwargs['initial'] = {'score': int(vote.score)}
         return kwargs
+    
+    def _get_voter(self, request):
+        """
+        Return the user or the cookies identifying the voter of *request*,
+        or None if the current user cannot vote.
+        """
+        if self.allow_anonymous:
+            return request.COOKIES
+        if request.user.is_authenticated():
+            return request.user
+        return None
+    
+    def get_vote_form_states(self, request, object_ids, key):
+        """
+        Return a dict mapping the ids of the existing objects, among 
+        *object_ids*, with the user dependent data of their vote forms,
+        not included in cacheable forms (see *cacheable_forms*), e.g.::
+        
+            {1: {'timestamp': '1356994800', 'security_hash': '...', 
+                'score': 4}}
+        
+        The score is None if the user did not vote the object. 
+        Target objects and votes are retreived using a query each.
+        """
+        objects = self.model._default_manager.in_bulk(object_ids)
+        user_or_cookies = self._get_voter(request)
+        votes = {}
+        if objects and user_or_cookies is not None:
+            votes = self.get_votes_for_many(objects.keys(), key, 
+                user_or_cookies)
+        form_class = self.get_vote_form_class(request)
+        states = {}
+        for object_id, instance in objects.items():
+            form = form_class(instance, key, 
+                **self.get_vote_form_kwargs(request, instance, key))
+            state = form.generate_security_data()
+            score = votes.get(object_id)
+            states[object_id] = {
+                'timestamp': state['timestamp'],
+                'security_hash': state['security_hash'],
+                'score': None if score is None else int(score),
+            }
+        return states
         
     # voting
         
@@ -231,9 +375,7 @@ class RatingHandler(object):
             # in case of vote-per-ip cap, check if this ip
             # can continue voting this object
             ip_address = request.META['REMOTE_ADDR']
-            count = models.Vote.objects.filter_for(vote.content_object,
-                user__isnull=True, ip_address=ip_address).count()
-            return count < self.votes_per_ip_address
+            return self.get_ip_limiter().allow(vote, ip_address)
         return self.can_change_vote if vote.id else True
         
     def vote(self, request, vote):
@@ -243,15 +385,179 @@ class RatingHandler(object):
         
         By default this method just does *vote.save()* and recalculates
         the related score (average, total, number of votes).
+        
+        Ratings reads are pinned to the write database while the vote
+        is saved (see *ratings.routers.pinned*).
+        
+        If *vote_coalescing_window* is set, a change of an existing vote
+        can be stored as a pending score, saved later by 
+        *flush_pending_vote*.
+        """
+        with routers.pinned():
+            if (self.vote_coalescing_window and vote.id and 
+                self._coalesce(vote)):
+                return False
+            created = self.save_vote(vote)
+        if created and self.vote_coalescing_window:
+            cache.set(self._get_coalescing_keys(vote.id)[0], True, 
+                self.vote_coalescing_window)
+        return created
+    
+    def save_vote(self, vote):
+        """
+        Save the vote to the database and recalculate the related score,
+        without coalescing changes (see *vote*).
+        Return True if the *vote* was created, False otherwise.
         """
         created = not vote.id
+        previous = None
+        if self.daily_rollups and not created:
+            previous = self._get_stored(vote)
         try:
-            vote.save()
+            vote.save(using=self.vote_db)
         except IntegrityError: # assume another thread created the vote
             created = False
         else:
-            models.upsert_score(vote.content_object, vote.key, weight=self.weight)
+            if created and vote.user_id:
+                # the new vote can replace a compacted one
+                models.release_compacted_vote(self._get_content(vote), 
+                    vote.key, vote.user, using=self.vote_db)
+            score, _ = self.upsert_score(vote)
+            self.update_leaderboards(score)
+            if self.daily_rollups:
+                self.update_rollup(vote, previous)
+            if created and self.allow_anonymous and self.votes_per_ip_address:
+                self.get_ip_limiter().hit(vote, vote.ip_address)
         return created
+    
+    # coalescing vote changes
+    
+    def _get_coalescing_keys(self, vote_id):
+        # the cache keys of the window, pending score, scheduled flush and
+        # flushed token of a vote (identifying the voter, the target object 
+        # and the key)
+        return ['ratings:coalescing:%s:%s' % (name, vote_id) 
+            for name in ('window', 'pending', 'flush', 'flushed')]
+    
+    def _coalesce(self, vote):
+        """
+        Store the score of the changed *vote* as pending, if the coalescing
+        window of the vote is open, and return True.
+        Otherwise, open the window and return False: the vote must be saved.
+        """
+        window_key, pending_key, flush_key, _ = self._get_coalescing_keys(
+            vote.id)
+        if cache.add(window_key, True, self.vote_coalescing_window):
+            # the saved score supersedes a pending one
+            cache.delete(pending_key)
+            return False
+        # each change is identified by a token, so that a flush never 
+        # discards a change stored after the pending score is read
+        cache.set(pending_key, (uuid.uuid4().hex, vote.score), 
+            self.vote_coalescing_window * 10)
+        if cache.add(flush_key, True, self.vote_coalescing_window):
+            self.schedule_flush(vote.id)
+        return True
+    
+    def schedule_flush(self, vote_id):
+        """
+        Schedule the saving of the pending score of the vote *vote_id*
+        at the end of the coalescing window.
+        
+        By default, a timer thread of the current process is used: if 
+        the process exits before the window ends, the latest change
+        of the vote is saved only by the *flush_pending_votes* command.
+        Override this method to use a task queue.
+        """
+        def flush():
+            try:
+                self.flush_pending_vote(vote_id)
+            finally:
+                for connection in connections.all():
+                    connection.close()
+        timer = threading.Timer(self.vote_coalescing_window, flush)
+        timer.daemon = True
+        timer.start()
+    
+    def flush_pending_vote(self, vote_id):
+        """
+        Save the pending score of the vote *vote_id*, if any, and 
+        recalculate the related score.
+        Return the saved vote, None if nothing was pending.
+        
+        Ratings reads are pinned to the write database while the vote
+        is saved (see *ratings.routers.pinned*).
+        """
+        _, pending_key, flush_key, flushed_key = self._get_coalescing_keys(
+            vote_id)
+        # further changes will schedule another flush
+        cache.delete(flush_key)
+        pending = self._get_pending(vote_id)
+        if pending is None:
+            return None
+        token, score = pending
+        with routers.pinned():
+            try:
+                vote = models.Vote.objects.using(self.vote_db).get(pk=vote_id)
+            except models.Vote.DoesNotExist:
+                return None
+            vote.score = score
+            self.save_vote(vote)
+        # the pending score is not deleted, since it could have been 
+        # replaced meanwhile: it is only marked as saved
+        cache.set(flushed_key, token, self.vote_coalescing_window * 10)
+        return vote
+    
+    def flush_pending_votes(self):
+        """
+        Save the pending scores of all the votes of the handled model, 
+        e.g. if the processes that scheduled their flush exited before
+        the coalescing window ended (see *flush_pending_votes* command).
+        Return the list of saved votes.
+        """
+        if not self.vote_coalescing_window:
+            return []
+        # a pending score expires ten windows after a change, and a vote 
+        # can be changed only in the window following its last saving
+        since = timezone.now() - datetime.timedelta(
+            seconds=self.vote_coalescing_window * 11)
+        vote_ids = models.Vote.objects.using(self.vote_db).filter(
+            content_type=ContentType.objects.get_for_model(self.model),
+            modified_at__gte=since).values_list('id', flat=True)
+        votes = [self.flush_pending_vote(i) 
+            for i in self.get_pending_scores(list(vote_ids))]
+        return [i for i in votes if i is not None]
+    
+    def _get_pending(self, vote_id):
+        # the (token, score) pending for the vote *vote_id*, if not saved
+        return self._get_pending_many([vote_id]).get(vote_id)
+    
+    def _get_pending_many(self, vote_ids):
+        keys = {}
+        for vote_id in vote_ids:
+            _, pending_key, _, flushed_key = self._get_coalescing_keys(
+                vote_id)
+            keys[pending_key] = keys[flushed_key] = vote_id
+        values = cache.get_many(keys)
+        pending = {}
+        for vote_id in vote_ids:
+            _, pending_key, _, flushed_key = self._get_coalescing_keys(
+                vote_id)
+            value = values.get(pending_key)
+            if value is not None and value[0] != values.get(flushed_key):
+                pending[vote_id] = value
+        return pending
+    
+    def get_pending_scores(self, vote_ids):
+        """
+        Return a dict mapping the ids of the votes, among *vote_ids*,
+        having a score not yet saved (see *vote_coalescing_window*) with
+        the pending scores.
+        """
+        if not self.vote_coalescing_window or not vote_ids:
+            return {}
+        return dict((vote_id, score) for vote_id, (_, score) in 
+            self._get_pending_many(vote_ids).items())
         
     def post_vote(self, request, vote, created):
         """
@@ -286,14 +592,65 @@ class RatingHandler(object):
         
         By default this method just do *vote.delete()* and recalculates
         the related score (average, total, number of votes).
+        
+        Ratings reads are pinned to the write database while the vote
+        is deleted (see *ratings.routers.pinned*).
         """
-        # thread safe delete
-        try:
-            vote.delete()
-        except AssertionError: # maybe the object was already deleted
-            pass
+        if self.vote_coalescing_window and vote.id:
+            cache.delete_many(self._get_coalescing_keys(vote.id)[1:])
+        with routers.pinned():
+            previous = self._get_stored(vote) if self.daily_rollups else None
+            # thread safe delete
+            try:
+                vote.delete(using=self.vote_db)
+            except AssertionError: # maybe the object was already deleted
+                pass
+            else:
+                score, _ = self.upsert_score(vote)
+                self.update_leaderboards(score)
+                if previous is not None:
+                    self.update_rollup(vote, previous, deleted=True)
+        
+    def upsert_score(self, vote):
+        """
+        Update or create the score related to the saved or deleted *vote*,
+        reading votes from *vote_db* and storing the score in *score_db*.
+        """
+        return models.upsert_score(self._get_content(vote), vote.key, 
+            weight=self.weight, vote_db=self.vote_db, score_db=self.score_db)
+        
+    def update_leaderboards(self, score):
+        """
+        Update the leaderboards (see *leaderboard_metrics*) after 
+        the given *score* changed.
+        """
+        for metric in self.leaderboard_metrics:
+            leaderboards.update(score, metric, self.leaderboard_size, 
+                self.score_db)
+        
+    def update_rollup(self, vote, previous, deleted=False):
+        """
+        Update the daily rollup of the saved or deleted *vote*.
+        
+        The argument *previous* is a sequence *(score, created_at)* 
+        containing the vote data stored before the change, or None if 
+        the vote was just created.
+        """
+        content = self._get_content(vote)
+        if previous is None:
+            return models.update_rollup(content, vote.key, 
+                models.get_day(vote.created_at), added=[vote.score], 
+                using=self.vote_db)
+        score, created_at = previous
+        if deleted:
+            added = []
+        elif score == vote.score:
+            return None
         else:
-            models.upsert_score(vote.content_object, vote.key, weight=self.weight)
+            added = [vote.score]
+        return models.update_rollup(content, vote.key, 
+            models.get_day(created_at), added=added, removed=[score], 
+            using=self.vote_db)
         
     def post_delete(self, request, vote):
         """
@@ -322,7 +679,10 @@ class RatingHandler(object):
         """
         from django.http import HttpResponse
         from django.utils import simplejson as json
-        score = vote.get_score()
+        # the score is read from *score_db*, without loading the target
+        content_type, object_id = self._get_content(vote)
+        score = models.Score.objects.using(self.score_db).get(
+            content_type=content_type, object_id=object_id, key=vote.key)
         data = {
             'key': score.key,
             'vote_id': vote.id,
@@ -346,7 +706,15 @@ class RatingHandler(object):
         """
         Called by *success_response* when the vote is by an nonymous user.
         Set the cookie to the response.
+        
+        If the *voter_cookie* option is True, the voter cookie is set only 
+        the first time the anonymous user votes, and it is never deleted.
         """
+        if self.voter_cookie:
+            if cookies.voter_id_created(request):
+                response.set_cookie(settings.VOTER_COOKIE_NAME, 
+                    cookies.get_voter_value(vote.cookie), self.cookie_max_age)
+            return
         cookie_name = str(cookies.get_name(vote.content_object, vote.key))
         if deleted:
             response.delete_cookie(cookie_name)
@@ -380,6 +748,10 @@ class RatingHandler(object):
         # handling anonymous votes
         if self.allow_anonymous:
             self.set_cookies(request, response, vote, created, deleted)
+        # pinning next reads of the voter to the write database
+        if self.pin_reads_after_vote:
+            response.set_cookie(settings.PIN_COOKIE_NAME, '1', 
+                self.pin_reads_after_vote)
         # handling success message
         if self.success_messages:
             self.set_message(request, response, vote, created, deleted)
@@ -395,6 +767,33 @@ class RatingHandler(object):
     
     # utils
     
+    def _get_content(self, vote):
+        """
+        Return the target object of *vote* as a sequence
+        *(content_type, object_id)*, without hitting the database
+        where the vote is stored.
+        """
+        return (ContentType.objects.get_for_id(vote.content_type_id), 
+            vote.object_id)
+    
+    def _get_stored(self, vote):
+        """
+        Return a sequence *(score, created_at)* containing the data 
+        of *vote* stored in the database, None if the vote is not found.
+        """
+        stored = models.Vote.objects.using(self.vote_db).filter(
+            pk=vote.pk).values_list('score', 'created_at')
+        return stored[0] if stored else None
+    
+    def get_ip_limiter(self):
+        """
+        Return the limiter used to cap anonymous votes per ip address,
+        an instance of *ip_limiter_class*.
+        """
+        if self._ip_limiter is None:
+            self._ip_limiter = self.ip_limiter_class(self)
+        return self._ip_limiter
+    
     def _get_user_lookups(self, instance, key, user_or_cookies):
         """
         Return the correct db model lookup for given *user_or_cookies*.
@@ -409,6 +808,9 @@ class RatingHandler(object):
         if hasattr(user_or_cookies, 'pk'):
             return {'user': user_or_cookies}
         elif self.allow_anonymous:
+            if self.voter_cookie:
+                voter_id = cookies.load_voter_id(user_or_cookies)
+                return {'cookie': voter_id} if voter_id else {}
             cookie_name = cookies.get_name(instance, key)
             if cookie_name in user_or_cookies:
                 return {'cookie': user_or_cookies[cookie_name]}
@@ -425,12 +827,21 @@ class RatingHandler(object):
         
         A *ValueError* is raised if you give cookies but anonymous votes 
         are not allowed by the handler.
+        
+        Votes given by users and then compacted (see *compact_votes*
+        management command) are taken into account.
         """
         user_lookup = self._get_user_lookups(instance, key, user_or_cookies)
         if not user_lookup:
             return False
-        return models.Vote.objects.filter_for(instance, key=key, 
-            **user_lookup).exists()
+        if models.Vote.objects.db_manager(self.vote_db).filter_for(instance, 
+            key=key, **user_lookup).exists():
+            return True
+        if 'user' in user_lookup:
+            return models.VoteAggregate.objects.db_manager(
+                self.vote_db).filter_for(instance, key=key,
+                voters__contains=',%s,' % user_lookup['user'].pk).exists()
+        return False
         
     def get_vote(self, instance, key, user_or_cookies):
         """
@@ -442,6 +853,8 @@ class RatingHandler(object):
         or a cookie dict (for anonymous votes).
         
         Return None if the vote does not exists.
+        The vote score is the pending one, if the latest change of 
+        the vote is not yet saved (see *vote_coalescing_window*).
         
         A *ValueError* is raised if you give cookies but anonymous votes 
         are not allowed by the handler.
@@ -449,7 +862,58 @@ class RatingHandler(object):
         user_lookup = self._get_user_lookups(instance, key, user_or_cookies)
         if not user_lookup:
             return None
-        return models.Vote.objects.get_for(instance, key, **user_lookup)
+        vote = models.Vote.objects.db_manager(self.vote_db).get_for(instance, 
+            key, **user_lookup)
+        if vote is not None:
+            vote.score = self.get_pending_scores([vote.id]).get(vote.id, 
+                vote.score)
+        return vote
+        
+    def get_votes_for_many(self, object_ids, key, user_or_cookies):
+        """
+        Return a dict mapping the ids of the objects, among *object_ids*,
+        voted by the user related to given *user_or_cookies* using *key*
+        with the given scores, using a single query.
+        
+        The argument *user_or_cookies* can be a Django User instance
+        or a cookie dict (for anonymous votes).
+        
+        A *ValueError* is raised if you give cookies but anonymous votes 
+        are not allowed by the handler.
+        """
+        content_type = ContentType.objects.get_for_model(self.model)
+        votes = models.Vote.objects.using(self.vote_db).filter(
+            content_type=content_type, key=key, object_id__in=object_ids)
+        if hasattr(user_or_cookies, 'pk'):
+            votes = votes.filter(user=user_or_cookies).values_list(
+                'object_id', 'id', 'score')
+        elif not self.allow_anonymous:
+            raise ValueError('Anonymous vote not allowed')
+        elif self.voter_cookie:
+            voter_id = cookies.load_voter_id(user_or_cookies)
+            if not voter_id:
+                return {}
+            votes = votes.filter(cookie=voter_id).values_list(
+                'object_id', 'id', 'score')
+        else:
+            # a cookie for each voted object
+            label = str(self.model._meta)
+            expected = {}
+            for object_id in object_ids:
+                name = cookies.get_name_for(label, object_id, key)
+                if name in user_or_cookies:
+                    expected[int(object_id)] = user_or_cookies[name]
+            if not expected:
+                return {}
+            rows = votes.filter(cookie__in=expected.values()).values_list(
+                'object_id', 'id', 'score', 'cookie')
+            votes = [(object_id, vote_id, score) for object_id, vote_id, 
+                score, cookie in rows if expected.get(object_id) == cookie]
+        votes = list(votes)
+        scores = dict((vote_id, score) for _, vote_id, score in votes)
+        scores.update(self.get_pending_scores(scores.keys()))
+        return dict((object_id, scores[vote_id]) 
+            for object_id, vote_id, _ in votes)
         
     def get_votes_for(self, instance, **kwargs):
         """
@@ -457,8 +921,9 @@ class RatingHandler(object):
         All the content objects related to returned votes are evaluated
         together with votes.
         """
-        return models.Vote.objects.filter_with_contents(
-            content_object=instance, **kwargs)
+        return models.Vote.objects.db_manager(
+            self.vote_db).filter_with_contents(content_object=instance, 
+            **kwargs)
             
     def get_votes_by(self, user, **kwargs):
         """
@@ -467,7 +932,8 @@ class RatingHandler(object):
         All the content objects related to returned votes are evaluated
         together with votes.
         """
-        return models.Vote.objects.filter_with_contents(user=user, 
+        return models.Vote.objects.db_manager(
+            self.vote_db).filter_with_contents(user=user, 
             content_object=self.model, **kwargs)
 
     def get_comments_for(self, instance, **kwargs):
@@ -476,8 +942,9 @@ class RatingHandler(object):
         All the content objects related to returned votes are evaluated
         together with votes.
         """
-        return models.Vote.objects.filter_with_contents(
-            content_object=instance, **kwargs)
+        return models.Vote.objects.db_manager(
+            self.vote_db).filter_with_contents(content_object=instance, 
+            **kwargs)
 
     def get_comments_by(self, user, **kwargs):
         """
@@ -486,7 +953,8 @@ class RatingHandler(object):
         All the content objects related to returned votes are evaluated
         together with votes.
         """
-        return models.Vote.objects.filter_with_contents(user=user,
+        return models.Vote.objects.db_manager(
+            self.vote_db).filter_with_contents(user=user,
             content_object=self.model, **kwargs)
 
     def get_score(self, instance, key):
@@ -494,7 +962,136 @@ class RatingHandler(object):
         Return the score for the target object *instance* and the given *key*.
         Return None if the target object does not have a score.
         """
-        return models.Score.objects.get_for(instance, key)
+        return models.Score.objects.db_manager(self.score_db).get_for(
+            instance, key)
+    
+    def get_daily_votes(self, instance, key, start=None, end=None):
+        """
+        Return a list of *(day, num_votes, average)* for each day with votes
+        given to *instance* using *key*, from day *start* to day *end*
+        (both included and both optional), e.g. to draw a trend chart.
+        
+        Only the daily rollups are read (see *daily_rollups*).
+        """
+        return models.get_daily_votes(instance, key, start=start, end=end,
+            using=self.vote_db)
+        
+    def get_period_score(self, instance, key, start=None, end=None):
+        """
+        Return the score of *instance* for *key* considering only the 
+        votes created from day *start* to day *end*, e.g. this month's 
+        rating, as a dict with keys *num_votes*, *total*, *average* 
+        and *histogram*.
+        
+        Only the daily rollups are read (see *daily_rollups*).
+        """
+        return models.get_period_score(instance, key, start=start, end=end,
+            weight=self.weight, using=self.vote_db)
+    
+    def get_leaderboard(self, key, metric='average'):
+        """
+        Return the leaderboard of the objects of the handled model having
+        the highest *metric* for the given *key*, as a list of 
+        *(object_id, value)*. The *metric* must be in *leaderboard_metrics*.
+        
+        The leaderboard is usually read from the cache, without hitting
+        the database.
+        """
+        if metric not in self.leaderboard_metrics:
+            raise ValueError('No leaderboard for metric %r' % metric)
+        content_type = ContentType.objects.get_for_model(self.model)
+        return leaderboards.get(content_type, key, metric, 
+            self.leaderboard_size, self.score_db)
+        
+    def get_top_rated(self, key, metric='average', limit=None):
+        """
+        Return the list of the (up to *limit*) objects having the highest 
+        *metric* for the given *key*, e.g.::
+        
+            for article in handler.get_top_rated('main', limit=5):
+                print article, article.leaderboard_value
+        
+        Each object has the *leaderboard_value* attribute containing 
+        the value of the metric. Objects are retreived using a single query.
+        """
+        board = self.get_leaderboard(key, metric)[:limit]
+        return self._get_instances(board, 'leaderboard_value')
+        
+    def get_similar(self, instance, key, n=10):
+        """
+        Return the list of the (up to *n*) objects most similar to 
+        *instance*, based on the votes given by users using *key*, e.g.::
+        
+            for article in handler.get_similar(article, 'main', n=5):
+                print article, article.similarity
+                
+        Each object has the *similarity* attribute. Similarities are
+        read from the table built by the *build_similarities* 
+        management command (see *ratings.recommend*).
+        """
+        content_type = ContentType.objects.get_for_model(self.model)
+        similar = recommend.get_similar(content_type, instance.pk, key, n=n,
+            using=self.score_db)
+        return self._get_instances(similar, 'similarity')
+        
+    def get_recommendations_for(self, user, key, n=10):
+        """
+        Return the list of the (up to *n*) objects, not yet voted by 
+        *user* using *key*, that the user is expected to like most.
+        
+        Each object has the *predicted_score* attribute. Predictions are
+        based on the similarities built by the *build_similarities* 
+        management command (see *ratings.recommend*).
+        """
+        content_type = ContentType.objects.get_for_model(self.model)
+        recommendations = recommend.get_recommendations_for(user, 
+            content_type, key, n=n, vote_db=self.vote_db, 
+            score_db=self.score_db)
+        return self._get_instances(recommendations, 'predicted_score')
+        
+    def _get_instances(self, values, attr):
+        """
+        Return the list of instances of the handled model, given a sequence
+        of *(object_id, value)*, setting *value* as the attribute *attr*.
+        Objects are retreived using a single query.
+        """
+        objects = self.model._default_manager.in_bulk([i[0] for i in values])
+        instances = []
+        for object_id, value in values:
+            if object_id in objects:
+                instance = objects[object_id]
+                setattr(instance, attr, value)
+                instances.append(instance)
+        return instances
+    
+    def get_versions(self, instances, key):
+        """
+        Return a dict mapping the primary keys of the given *instances* 
+        with the versions of their scores for *key*, using a single query.
+        The version of a score changes each time the score is recalculated
+        or created again, so it can be used to build cache keys, e.g. see 
+        the *ratingcache* templatetag (see also 
+        *ratings.models.get_versions_for_many*).
+        """
+        content_type = ContentType.objects.get_for_model(self.model)
+        return models.get_versions_for_many(content_type, key, 
+            [i.pk for i in instances], using=self.score_db)
+    
+    def get_stats_for_many(self, content_type_or_queryset, key, 
+        object_ids=None):
+        """
+        Return the statistics of the votes given to many target objects,
+        as a dict mapping object ids with stats, using a single grouped 
+        query, e.g.::
+        
+            stats = handler.get_stats_for_many(Article.objects.all(), 'main')
+        
+        This is basically a wrapper around 
+        *ratings.model.get_stats_for_many*.
+        """
+        return models.get_stats_for_many(content_type_or_queryset, key, 
+            object_ids=object_ids, vote_db=self.vote_db, 
+            score_db=self.score_db)
     
     def annotate_scores(self, queryset, key, **kwargs):
         """
@@ -503,7 +1100,8 @@ class RatingHandler(object):
         In *kwargs* it is possible to specify the values to retreive mapped 
         to field names (it is up to you to avoid name clashes).
         You can annotate the queryset with the number of votes (*num_votes*), 
-        the average score (*average*) and the total sum of all votes (*total*).
+        the average score (*average*), the total sum of all votes (*total*)
+        and the variance of votes (*variance*).
 
         For example, the following call::
 
@@ -522,8 +1120,12 @@ class RatingHandler(object):
                 print 'staff average:', article.staff_avg
         
         This is basically a wrapper around *ratings.model.annotate_scores*.
+        If scores are stored in a database (see *score_db*) other than 
+        the one of the *queryset*, the scores are merged in Python and 
+        the queryset cannot be sorted by score values.
         """
-        return models.annotate_scores(queryset, key, **kwargs)
+        return models.annotate_scores(queryset, key, using=self.score_db, 
+            **kwargs)
         
     def annotate_votes(self, queryset, key, user, score='score'):
         """
@@ -542,7 +1144,8 @@ class RatingHandler(object):
         This is basically a wrapper around *ratings.model.annotate_votes*.
         For anonymous voters this functionality is unavailable.
         """
-        return models.annotate_votes(queryset, key, user, score)
+        return models.annotate_votes(queryset, key, user, score, 
+            using=self.vote_db)
         
     def deleting_target_object(self, sender, instance, **kwargs):
         """
@@ -551,9 +1154,69 @@ class RatingHandler(object):
         
         This receiver is usually connected by the ratings registry, when 
         a handler is registered.
-        """
-        models.delete_scores_for(instance)
-        models.delete_votes_for(instance)
+        
+        Nothing is done if the instance is deleted by *delete_queryset*,
+        since in that case the ratings are already deleted in bulk.
+        Note that a plain *queryset.delete()* calls this receiver for each
+        deleted object, deleting ratings one object at a time.
+        """
+        if getattr(self._local, 'deleting_queryset', False):
+            return
+        models.delete_scores_for(instance, using=self.score_db)
+        models.delete_votes_for(instance, using=self.vote_db)
+        if self.leaderboard_metrics:
+            leaderboards.discard(ContentType.objects.get_for_model(sender),
+                [instance.pk], self.leaderboard_size, self.score_db)
+        
+    def deleting_target_queryset(self, sender, queryset):
+        """
+        The target objects in *queryset*, all instances of the model 
+        *sender*, are being deleted, so we must delete all the votes, 
+        scores and comments related to those objects.
+        
+        This is called by *delete_queryset*: by default all the ratings 
+        are deleted in bulk using *ratings.models.delete_ratings_for_queryset*,
+        and the leaderboards containing the objects are rebuilt.
+        """
+        content_type = ContentType.objects.get_for_model(sender)
+        boards = []
+        if self.leaderboard_metrics:
+            # leaderboard entries of the objects are deleted with ratings
+            boards = leaderboards.get_containing(content_type, 
+                list(queryset.values_list('pk', flat=True)), self.score_db)
+        models.delete_ratings_for_queryset(queryset, vote_db=self.vote_db,
+            score_db=self.score_db)
+        for key, metric in boards:
+            leaderboards.rebuild(content_type, key, metric, 
+                self.leaderboard_size, self.score_db)
+        
+    def delete_queryset(self, queryset):
+        """
+        Delete all the target objects in *queryset*, together with their
+        votes, scores and comments, e.g.::
+        
+            handler = ratings.get_handler(Article)
+            handler.delete_queryset(Article.objects.filter(is_active=False))
+        
+        Ratings are deleted in bulk by *deleting_target_queryset*, and the
+        per-instance receiver *deleting_target_object* is skipped while 
+        the queryset is deleted. Ratings and target objects are deleted in 
+        one transaction for each database involved 
+        (see *ratings.models.in_transaction*).
+        
+        Always use this method to delete many target objects: a plain
+        *queryset.delete()* deletes the ratings one object at a time.
+        """
+        databases = (queryset.db, 
+            self.vote_db or router.db_for_write(models.Vote),
+            self.score_db or router.db_for_write(models.Score))
+        with models.in_transaction(*databases):
+            self.deleting_target_queryset(queryset.model, queryset)
+            self._local.deleting_queryset = True
+            try:
+                queryset.delete()
+            finally:
+                self._local.deleting_queryset = False
             
      
 class Ratings(object):
@@ -578,16 +1241,56 @@ class Ratings(object):
     """
     def __init__(self):
         self._registry = {}
+        # map 'app_label.model' labels to registered models
+        self._labels = {}
         self.connect()
 
     def connect(self):
         """
         Pre and post (delete) vote signals.
         """
-        signals.vote_will_be_saved.connect(self.pre_vote, sender=models.Vote)
-        signals.vote_was_saved.connect(self.post_vote, sender=models.Vote)
-        signals.vote_will_be_deleted.connect(self.pre_delete, sender=models.Vote)
-        signals.vote_was_deleted.connect(self.post_delete, sender=models.Vote)
+        for signal, receiver in (
+            (signals.vote_will_be_saved, self.pre_vote),
+            (signals.vote_was_saved, self.post_vote),
+            (signals.vote_will_be_deleted, self.pre_delete),
+            (signals.vote_was_deleted, self.post_delete)):
+            signal.connect(receiver, sender=models.Vote, 
+                dispatch_uid=signals.REGISTRY_UID)
+        # map each signal to the registry receiver and the handler hook
+        # called by that receiver
+        self._signal_hooks = {
+            signals.vote_will_be_saved: (self.pre_vote, 'pre_vote'),
+            signals.vote_was_saved: (self.post_vote, 'post_vote'),
+            signals.vote_will_be_deleted: (self.pre_delete, 'pre_delete'),
+            signals.vote_was_deleted: (self.post_delete, 'post_delete'),
+        }
+        
+    def has_only_own_receiver(self, signal, sender):
+        """
+        Return True if the only receiver connected to *signal* for the
+        given *sender* is the one connected by this registry.
+        
+        Once another receiver is connected, this returns False even if 
+        that receiver is later disconnected.
+        """
+        return (not signal.has_other_receivers and 
+            signal.has_listeners(sender))
+        
+    def send_signal(self, signal, handler, vote, request, **kwargs):
+        """
+        Send the vote *signal* and return a list of tuple pairs
+        *[(receiver, response), ... ]*, like *signal.send* does.
+        
+        If no other receivers are connected to the signal, the 
+        registry receiver is skipped, and the *handler* hook (e.g. 
+        *handler.pre_vote*) is directly called.
+        """
+        sender = vote.__class__
+        if self.has_only_own_receiver(signal, sender):
+            receiver, hook_name = self._signal_hooks[signal]
+            hook = getattr(handler, hook_name)
+            return [(receiver, hook(request, vote, **kwargs))]
+        return signal.send(sender=sender, vote=vote, request=request, **kwargs)
         
     def connect_model_signals(self, model, handler):
         """
@@ -638,6 +1341,7 @@ class Ratings(object):
                     model._meta.module_name)
             handler = self.get_handler_instance(model, handler_class, kwargs)
             self._registry[model] = handler
+            self._labels[str(model._meta)] = model
             self.connect_model_signals(model, handler)
         
     def unregister(self, model_or_iterable):
@@ -655,6 +1359,7 @@ class Ratings(object):
                     "The model '%s' is not currently being handled" % 
                     model._meta.module_name)
             del self._registry[model]
+            del self._labels[str(model._meta)]
             
     def get_handler(self, model_or_instance):
         """
@@ -666,6 +1371,15 @@ class Ratings(object):
         else:
             model = type(model_or_instance)
         return self._registry.get(model)
+    
+    def get_handler_for_label(self, label):
+        """
+        Return the handler for the model identified by *label* 
+        ('app_label.model'), without looking up the app cache.
+        Return None if model is not registered.
+        """
+        model = self._labels.get(label)
+        return None if model is None else self._registry[model]
 
     def pre_vote(self, sender, vote, request, **kwargs):
         """
@@ -0,0 +1,288 @@
+"""
+Bulk import of votes, e.g. from a legacy table.
+
+Votes are read from CSV or JSON lines files having the columns written by
+*ratings.exports* (*content_type* as 'app_label.model', *object_id*,
+*key*, *score*, *user*, *ip_address*, *cookie*, *created_at* and
+*modified_at*; only content type, object id and score are required).
+
+Each vote is validated using the handler registered for its model, then
+votes are inserted in batches using *bulk_create*. Scores (and daily 
+rollups) of the voted objects are rebuilt once, at the end of the import.
+"""
+import csv
+import itertools
+
+from django import forms as django_forms
+from django.conf import settings as django_settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import router, transaction
+from django.db.models import Q, get_model
+from django.utils import simplejson as json
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ratings import forms, handlers, models, settings
+
+SKIP, UPDATE = 'skip', 'update'
+
+def read_csv(stream):
+    """
+    Yield a dict for each row of the CSV *stream*, having a header row.
+    Empty values are considered null.
+    """
+    for row in csv.DictReader(stream):
+        yield dict((k, v.decode('utf-8') if v else None)
+            for k, v in row.items())
+
+def read_jsonl(stream):
+    """
+    Yield a dict for each line of the JSON lines *stream*.
+    """
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+READERS = {
+    'csv': read_csv,
+    'jsonl': read_jsonl,
+}
+
+
+class VoteImporter(object):
+    """
+    Import votes in batches of *batch_size*, storing votes in *vote_db*
+    and scores in *score_db* (if not given, the databases are chosen by 
+    the database routers).
+
+    Votes conflicting with existing votes (see *Vote.unique_together*) are
+    skipped if *on_conflict* is 'skip', or change the score of the
+    existing vote if *on_conflict* is 'update'.
+    """
+    def __init__(self, batch_size=1000, on_conflict=SKIP, vote_db=None,
+        score_db=None):
+        if on_conflict not in (SKIP, UPDATE):
+            raise ValueError('Invalid conflict handling: %r' % on_conflict)
+        self.batch_size = batch_size
+        self.on_conflict = on_conflict
+        self.vote_db = vote_db or router.db_for_write(models.Vote)
+        self.score_db = score_db
+        self.counters = dict.fromkeys(('created', 'updated', 'skipped',
+            'invalid'), 0)
+        self.errors = []
+        self.targets = set()
+
+    def run(self, rows):
+        """
+        Import the votes in the sequence of dicts *rows*, then rebuild
+        the affected scores. Return the counters of created, updated,
+        skipped (conflicting) and invalid votes. Errors are stored in
+        *errors*, as a list of *(row number, message)*.
+        """
+        rows = iter(rows)
+        number = 0
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            votes = []
+            for row in batch:
+                number += 1
+                try:
+                    votes.append((number, self.get_vote(row)))
+                except django_forms.ValidationError, err:
+                    self._invalid(number, u' '.join(err.messages))
+            self.save(self.validate_targets(votes))
+        self.upsert_scores()
+        return self.counters
+
+    def get_vote(self, row):
+        """
+        Return an unsaved vote given the dict *row*.
+        Raise *ValidationError* if the row is not valid.
+        """
+        try:
+            model = get_model(*row['content_type'].split('.'))
+        except (KeyError, AttributeError, TypeError, ValueError):
+            model = None
+        handler = handlers.ratings.get_handler(model)
+        if handler is None:
+            raise django_forms.ValidationError('Bad or unregistered '
+                'content type: %s' % row.get('content_type'))
+        try:
+            object_id = int(row['object_id'])
+            score = float(row['score'])
+            user_id = int(row['user']) if row.get('user') else None
+        except (KeyError, TypeError, ValueError):
+            raise django_forms.ValidationError('Invalid object id, score '
+                'or user.')
+        forms.validate_score(score, handler.score_range, handler.score_step)
+        ip_address = row.get('ip_address') or None
+        if user_id is None and ip_address is None:
+            raise django_forms.ValidationError('Missing user or ip address.')
+        now = timezone.now()
+        created_at = self._get_datetime(row.get('created_at')) or now
+        return models.Vote(
+            content_type=ContentType.objects.get_for_model(model), 
+            object_id=object_id, score=score,
+            key=row.get('key') or settings.DEFAULT_KEY, user_id=user_id,
+            ip_address=ip_address, cookie=row.get('cookie') or None,
+            created_at=created_at,
+            modified_at=self._get_datetime(row.get('modified_at')) or now)
+
+    def _get_datetime(self, value):
+        if not value:
+            return None
+        try:
+            value = parse_datetime(value)
+        except ValueError:
+            value = None
+        if value is None:
+            raise django_forms.ValidationError('Invalid date.')
+        # exported datetimes are naive and in UTC
+        if timezone.is_naive(value) and django_settings.USE_TZ:
+            return timezone.make_aware(value, timezone.utc)
+        return value
+
+    def validate_targets(self, votes):
+        """
+        Return the votes given to existing target objects by existing 
+        users, given a sequence of *(row number, vote)*. 
+        Objects and users are checked using a query for each model.
+        """
+        objects, user_ids = {}, set()
+        for _, vote in votes:
+            objects.setdefault(vote.content_type, set()).add(vote.object_id)
+            if vote.user_id is not None:
+                user_ids.add(vote.user_id)
+        for content_type, object_ids in objects.items():
+            model = content_type.model_class()
+            objects[content_type] = set(model._default_manager.filter(
+                pk__in=object_ids).values_list('pk', flat=True))
+        user_ids = set(User.objects.filter(pk__in=user_ids).values_list(
+            'pk', flat=True))
+        valid = []
+        for number, vote in votes:
+            if vote.object_id not in objects[vote.content_type]:
+                self._invalid(number, 'Invalid target object.')
+            elif vote.user_id is not None and vote.user_id not in user_ids:
+                self._invalid(number, 'Invalid user.')
+            else:
+                valid.append(vote)
+        return valid
+
+    def _invalid(self, number, message):
+        self.counters['invalid'] += 1
+        self.errors.append((number, message))
+
+    def _get_lookups(self, vote):
+        # the values of both the unique_together sets of the vote
+        content = (vote.content_type_id, vote.object_id, vote.key)
+        lookups = []
+        if vote.user_id is not None:
+            lookups.append(content + ('user', vote.user_id))
+        if vote.user_id is None or vote.cookie is not None:
+            lookups.append(content + ('anonymous', vote.ip_address,
+                vote.cookie))
+        return lookups
+
+    def get_existing(self, votes):
+        """
+        Return a dict mapping the unique values (see *Vote.unique_together*)
+        of the existing votes that can conflict with *votes* with 
+        the existing votes.
+        """
+        existing = {}
+        groups = {}
+        for vote in votes:
+            groups.setdefault((vote.content_type_id, vote.key), []).append(
+                vote)
+        for (content_type_id, key), group in groups.items():
+            queryset = models.Vote.objects.using(self.vote_db).filter(
+                Q(user__in=set(i.user_id for i in group 
+                    if i.user_id is not None)) | 
+                Q(ip_address__in=set(i.ip_address 
+                    for i in group if i.ip_address is not None)),
+                content_type=content_type_id, key=key,
+                object_id__in=set(i.object_id for i in group))
+            for vote in queryset.only('id', 'content_type', 'object_id', 
+                'key', 'user', 'ip_address', 'cookie'):
+                for lookup in self._get_lookups(vote):
+                    existing[lookup] = vote
+        return existing
+
+    def save(self, votes):
+        """
+        Save the given *votes*, handling conflicts with existing votes
+        and between votes in the same batch.
+        """
+        with transaction.commit_on_success(using=self.vote_db):
+            existing = self.get_existing(votes)
+            created, seen = [], set()
+            for vote in votes:
+                lookups = self._get_lookups(vote)
+                conflicts = [existing[i] for i in lookups if i in existing]
+                if seen.intersection(lookups):
+                    self.counters['skipped'] += 1
+                elif conflicts:
+                    if self.on_conflict == UPDATE:
+                        models.Vote.objects.using(self.vote_db).filter(
+                            pk=conflicts[0].pk).update(score=vote.score,
+                            modified_at=vote.modified_at)
+                        self.counters['updated'] += 1
+                        self.targets.add((vote.content_type, vote.object_id,
+                            vote.key))
+                    else:
+                        self.counters['skipped'] += 1
+                else:
+                    created.append(vote)
+                    self.targets.add((vote.content_type, vote.object_id,
+                        vote.key))
+                seen.update(lookups)
+            with _preserve_dates(models.Vote):
+                models.Vote.objects.using(self.vote_db).bulk_create(created)
+            self.counters['created'] += len(created)
+
+    def upsert_scores(self):
+        """
+        Rebuild the scores (and leaderboards) of the objects having
+        imported votes, and their daily rollups if enabled by the handler.
+        """
+        rollups = {}
+        for content_type, object_id, key in self.targets:
+            handler = handlers.ratings.get_handler(content_type.model_class())
+            score, _ = models.upsert_score((content_type, object_id), key,
+                weight=handler.weight, vote_db=self.vote_db,
+                score_db=self.score_db)
+            handler.update_leaderboards(score)
+            if handler.daily_rollups:
+                rollups.setdefault(content_type, set()).add(object_id)
+        # rollups are rebuilt using all the votes of each target object
+        for content_type, object_ids in rollups.items():
+            object_ids = sorted(object_ids)
+            for start in xrange(0, len(object_ids), self.batch_size):
+                models.backfill_rollups(models.Vote.objects.using(
+                    self.vote_db).filter(content_type=content_type, 
+                    object_id__in=object_ids[start:start + self.batch_size]),
+                    batch_size=self.batch_size, using=self.vote_db)
+
+
+class _preserve_dates(object):
+    """
+    Context manager disabling *auto_now* and *auto_now_add* in the
+    date fields of *model*, so that dates of imported votes are kept.
+    """
+    def __init__(self, model):
+        self.fields = [i for i in model._meta.fields
+            if getattr(i, 'auto_now', False) or
+            getattr(i, 'auto_now_add', False)]
+
+    def __enter__(self):
+        self.flags = [(i.auto_now, i.auto_now_add) for i in self.fields]
+        for field in self.fields:
+            field.auto_now = field.auto_now_add = False
+
+    def __exit__(self, *args):
+        for field, (auto_now, auto_now_add) in zip(self.fields, self.flags):
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
@@ -0,0 +1,201 @@
+"""
+Bounded top-N leaderboards of scores.
+
+A leaderboard contains the ids of the objects of a content type having
+the highest values of a score field (the *metric*, e.g. *average*) for
+a given key, together with those values. Leaderboards are stored in
+the *LeaderboardEntry* table (the source of truth) and in the Django
+cache, and are maintained by the handler when scores change (see
+*RatingHandler.leaderboard_metrics*).
+
+Reading a leaderboard costs a single cache hit: on cache misses, the
+entries are read from the table, and if the table is empty the
+leaderboard is rebuilt from the ordered index on scores.
+
+Changes to the same leaderboard are serialized by a lock stored in the
+Django cache. Each vote changes at most a few entries in place, and the
+leaderboard is rebuilt only when an entry falls off and must be 
+replaced. If the lock is taken, the change is skipped without waiting:
+the leaderboard is repaired by the next change of its scores, or by
+*rebuild* (e.g. run periodically). If a rebuild still conflicts with a 
+concurrent one (e.g. the cache is not shared by all processes), the
+entries written by the other rebuild are kept.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import router, transaction, IntegrityError
+
+from ratings import models
+
+METRICS = ('average', 'num_votes', 'total', 'variance')
+
+key_prefix = 'ratings:top'
+
+# the number of seconds after which the lock of a leaderboard expires
+lock_timeout = 30
+
+def get_cache_key(content_type, key, metric):
+    return '%s:%s:%s:%s' % (key_prefix, content_type.pk, key, metric)
+
+def rebuild(content_type, key, metric, size, score_db=None):
+    """
+    Rebuild the leaderboard of *content_type*, *key* and *metric*, using
+    the *size* scores with the highest *metric* value.
+    Return the leaderboard as a list of *(object_id, value)*.
+    
+    If the leaderboard is locked by another change, it is not stored
+    (see the module docstring).
+    """
+    if metric not in METRICS:
+        raise ValueError('Invalid leaderboard metric: %r' % metric)
+    cache_key = get_cache_key(content_type, key, metric)
+    if not _lock(cache_key):
+        return _get_top_scores(content_type, key, metric, size, score_db)
+    try:
+        return _rebuild(content_type, key, metric, size, score_db)
+    finally:
+        _unlock(cache_key)
+
+def _get_top_scores(content_type, key, metric, size, score_db):
+    return list(models.Score.objects.using(score_db).filter(
+        content_type=content_type, key=key, num_votes__gt=0).order_by(
+        '-' + metric, 'object_id').values_list('object_id', metric)[:size])
+
+def _rebuild(content_type, key, metric, size, score_db):
+    # rebuild the leaderboard, the lock being acquired
+    using = score_db or router.db_for_write(models.LeaderboardEntry)
+    board = _get_top_scores(content_type, key, metric, size, score_db)
+    with models.in_transaction(using):
+        savepoint = transaction.savepoint(using=using)
+        try:
+            entries = models.LeaderboardEntry.objects.using(using).filter(
+                content_type=content_type, key=key, metric=metric)
+            entries._raw_delete(using)
+            models.LeaderboardEntry.objects.using(using).bulk_create([
+                models.LeaderboardEntry(content_type=content_type, 
+                    key=key, metric=metric, position=position, 
+                    object_id=object_id, value=value)
+                for position, (object_id, value) in enumerate(board, 1)])
+        except IntegrityError:
+            # a concurrent rebuild already stored the leaderboard
+            transaction.savepoint_rollback(savepoint, using=using)
+            return board
+        transaction.savepoint_commit(savepoint, using=using)
+    cache.set(get_cache_key(content_type, key, metric), board)
+    return board
+
+def _lock(cache_key):
+    # return True if the lock of the leaderboard is acquired, without 
+    # waiting for it
+    return cache.add(cache_key + ':lock', True, lock_timeout)
+
+def _unlock(cache_key):
+    cache.delete(cache_key + ':lock')
+
+def _read(content_type, key, metric, using):
+    return list(models.LeaderboardEntry.objects.using(using).filter(
+        content_type=content_type, key=key, metric=metric).order_by(
+        'position').values_list('object_id', 'value'))
+
+def get(content_type, key, metric, size, score_db=None):
+    """
+    Return the leaderboard of *content_type*, *key* and *metric* as
+    a list of *(object_id, value)*, highest values first.
+    """
+    cache_key = get_cache_key(content_type, key, metric)
+    board = cache.get(cache_key)
+    if board is None:
+        board = _read(content_type, key, metric, score_db)
+        if board:
+            cache.set(cache_key, board)
+        else:
+            board = rebuild(content_type, key, metric, size, score_db)
+    return board
+
+def _rank(entry):
+    # entries are sorted by value (highest first), then by object id
+    return -entry[1], entry[0]
+
+def _change(board, object_id, value, size):
+    """
+    Return the leaderboard *board* (a list of *(object_id, value)*) 
+    changed so that the object *object_id* has the given *value* (None 
+    if it has no votes), or None if the leaderboard must be rebuilt,
+    i.e. if an entry falls off a full leaderboard.
+    """
+    others = [i for i in board if i[0] != object_id]
+    full = len(board) >= size
+    if value is None:
+        if len(others) == len(board):
+            return board
+        return None if full else others
+    entry = (object_id, value)
+    if full and _rank(entry) > _rank(board[-1]):
+        # the object does not enter the leaderboard, or it was on the
+        # leaderboard and an object outside it may now replace it
+        return board if len(others) == len(board) else None
+    return sorted(others + [entry], key=_rank)[:size]
+
+def _store(content_type, key, metric, previous, board, using):
+    # store the changed entries of *board*, one row for each position
+    entries = models.LeaderboardEntry.objects.using(using).filter(
+        content_type=content_type, key=key, metric=metric)
+    with models.in_transaction(using):
+        for position, (object_id, value) in enumerate(board, 1):
+            if position > len(previous):
+                models.LeaderboardEntry.objects.using(using).create(
+                    content_type=content_type, key=key, metric=metric, 
+                    position=position, object_id=object_id, value=value)
+            elif previous[position - 1] != (object_id, value):
+                entries.filter(position=position).update(
+                    object_id=object_id, value=value)
+        if len(board) < len(previous):
+            entries.filter(position__gt=len(board)).delete()
+
+def update(score, metric, size, score_db=None):
+    """
+    Update the leaderboard for the changed *score* (and *metric*).
+    
+    Only the entries of the target object of *score*, and of the objects
+    it moves across, are changed. The leaderboard is rebuilt only if an 
+    entry falls off a full leaderboard. If the leaderboard is locked by
+    another change, nothing is done.
+    Return the leaderboard.
+    """
+    content_type = ContentType.objects.get_for_id(score.content_type_id)
+    cache_key = get_cache_key(content_type, score.key, metric)
+    if not _lock(cache_key):
+        return get(content_type, score.key, metric, size, score_db)
+    try:
+        using = score_db or router.db_for_write(models.LeaderboardEntry)
+        # the stored entries are the source of truth
+        previous = _read(content_type, score.key, metric, using)
+        if not previous:
+            return _rebuild(content_type, score.key, metric, size, score_db)
+        value = getattr(score, metric) if score.num_votes else None
+        board = _change(previous, score.object_id, value, size)
+        if board is None:
+            return _rebuild(content_type, score.key, metric, size, score_db)
+        if board != previous:
+            _store(content_type, score.key, metric, previous, board, using)
+        cache.set(cache_key, board)
+        return board
+    finally:
+        _unlock(cache_key)
+
+def get_containing(content_type, object_ids, score_db=None):
+    """
+    Return a list of *(key, metric)* identifying the leaderboards of 
+    *content_type* containing any of the given *object_ids*.
+    """
+    return list(models.LeaderboardEntry.objects.using(score_db).filter(
+        content_type=content_type, object_id__in=object_ids).values_list(
+        'key', 'metric').distinct())
+
+def discard(content_type, object_ids, size, score_db=None):
+    """
+    Rebuild the leaderboards of *content_type* containing any of the 
+    given *object_ids*, e.g. after the target objects are deleted.
+    """
+    for key, metric in get_containing(content_type, object_ids, score_db):
+        rebuild(content_type, key, metric, size, score_db)
@@ -0,0 +1,124 @@
+"""
+Backends used to limit the number of anonymous votes per ip address.
+
+A limiter is instantiated by the rating handler (see
+*RatingHandler.ip_limiter_class*) and used when the handler option
+*votes_per_ip_address* is set and anonymous votes are allowed.
+"""
+import datetime
+import time
+
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils import timezone
+
+from ratings import models
+
+class IPLimiter(object):
+    """
+    Database backed ip address limiter.
+
+    Every check counts the anonymous votes given to the target object
+    by the ip address, so the limit is applied to the whole life of the
+    target object.
+    """
+    def __init__(self, handler):
+        self.handler = handler
+
+    def allow(self, vote, ip_address):
+        """
+        Return True if *ip_address* can give the (unsaved) *vote*.
+        """
+        count = models.Vote.objects.using(self.handler.vote_db).filter(
+            content_type=vote.content_type_id, object_id=vote.object_id, 
+            user__isnull=True, ip_address=ip_address).count()
+        return count < self.handler.votes_per_ip_address
+
+    def hit(self, vote, ip_address):
+        """
+        Called by the handler after the *vote* by *ip_address* is created.
+        The database limiter does not need to store anything.
+        """
+        pass
+
+
+class CacheIPLimiter(IPLimiter):
+    """
+    Cache backed ip address limiter.
+
+    Votes are counted for each target object and ip address in a sliding
+    time window (see *RatingHandler.votes_per_ip_address_window*), using
+    two fixed size buckets stored in the Django cache: the count of the
+    previous bucket is weighted by the part of the window still
+    overlapping it.
+
+    A check costs a single cache operation. If the counters of a target
+    object are missing (e.g. the cache was cleared), the counters of all
+    the ip addresses that voted the target object in the window are 
+    rebuilt at once from the votes stored in the database, using a single
+    grouped query: after that, a missing counter means no votes.
+    """
+    key_prefix = 'ratings:ip'
+
+    def _get_keys(self, vote, ip_address, bucket):
+        base = '%s:%s:%s' % (vote.content_type_id, vote.object_id, ip_address)
+        return (
+            '%s:%s:%d' % (self.key_prefix, base, bucket),
+            '%s:%s:%d' % (self.key_prefix, base, bucket - 1),
+            self._get_seeded_key(vote),
+        )
+
+    def _get_seeded_key(self, vote):
+        return '%s:seeded:%s:%s' % (self.key_prefix, vote.content_type_id,
+            vote.object_id)
+
+    def _get_bucket(self, now):
+        window = self.handler.votes_per_ip_address_window
+        return int(now // window), (now % window) / float(window)
+
+    def rebuild(self, vote):
+        """
+        Count the anonymous votes given by each ip address to the target
+        object of *vote* in the current window, and store the results in
+        the cache. Return a dict mapping ip addresses with their counts.
+        """
+        window = self.handler.votes_per_ip_address_window
+        since = timezone.now() - datetime.timedelta(seconds=window)
+        counts = dict(models.Vote.objects.using(self.handler.vote_db).filter(
+            content_type=vote.content_type_id, object_id=vote.object_id, 
+            user=None, created_at__gte=since).values_list(
+            'ip_address').annotate(count=Count('id')).order_by())
+        bucket, _ = self._get_bucket(time.time())
+        values = {}
+        for ip_address, count in counts.items():
+            current_key, previous_key, _ = self._get_keys(vote, ip_address,
+                bucket)
+            values[current_key] = count
+            values[previous_key] = 0
+        if values:
+            cache.set_many(values, window * 2)
+        cache.set(self._get_seeded_key(vote), True, window)
+        return counts
+
+    def allow(self, vote, ip_address):
+        bucket, elapsed = self._get_bucket(time.time())
+        keys = self._get_keys(vote, ip_address, bucket)
+        current_key, previous_key, seeded_key = keys
+        values = cache.get_many(keys)
+        if seeded_key not in values:
+            count = self.rebuild(vote).get(ip_address, 0)
+        else:
+            previous = values.get(previous_key, 0) * (1 - elapsed)
+            count = values.get(current_key, 0) + previous
+        return count < self.handler.votes_per_ip_address
+
+    def hit(self, vote, ip_address):
+        window = self.handler.votes_per_ip_address_window
+        bucket, _ = self._get_bucket(time.time())
+        current_key = self._get_keys(vote, ip_address, bucket)[0]
+        try:
+            cache.incr(current_key)
+        except ValueError:
+            # the counter expired or was never created
+            if not cache.add(current_key, 1, window * 2):
+                cache.incr(current_key)
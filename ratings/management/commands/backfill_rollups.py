@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, make_option
+
+from ratings import models
+
+class Command(BaseCommand):
+    """
+    Rebuild the daily rollups of votes (see *RatingHandler.daily_rollups*)
+    streaming all the existing votes, e.g.::
+    
+        ./manage.py backfill_rollups -b 5000
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batch-size', 
+            action='store', dest='batch_size', default=1000, type='int',
+            help=('The number of votes read in a single query.')
+        ),
+        make_option("--vote-database", 
+            action='store', dest='vote_db', default=None,
+            help=('The database where votes are stored.')
+        ),
+    )
+    help = "Rebuild the daily rollups of votes."
+
+    def handle(self, **options):
+        counter = models.backfill_rollups(batch_size=options['batch_size'],
+            using=options['vote_db'])
+        if int(options.get('verbosity')) > 0:
+            print u'%d votes processed' % counter
@@ -0,0 +1,78 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError, make_option
+from django.db.models import get_model
+
+from ratings import models, recommend
+
+class Command(BaseCommand):
+    """
+    Compute the most similar objects (the neighbours) of each voted object,
+    used by *RatingHandler.get_similar* and
+    *RatingHandler.get_recommendations_for*, e.g.::
+
+        ./manage.py build_similarities blog.entry main -n 50 -m adjusted_cosine
+
+    If the model and the key are not given, similarities are built for
+    all the content types and keys having votes.
+    This command requires NumPy and SciPy.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--neighbours',
+            action='store', dest='neighbours', default=20, type='int',
+            help=('The number of neighbours stored for each object.')
+        ),
+        make_option('-m', '--method',
+            action='store', dest='method', default='cosine',
+            choices=recommend.METHODS,
+            help=('The similarity method: cosine or adjusted_cosine.')
+        ),
+        make_option('-c', '--chunk-size',
+            action='store', dest='chunk_size', default=100, type='int',
+            help=('The number of objects whose similarities are computed '
+                'at once.')
+        ),
+        make_option('-b', '--batch-size',
+            action='store', dest='batch_size', default=10000, type='int',
+            help=('The number of votes read in a single query.')
+        ),
+        make_option("--vote-database",
+            action='store', dest='vote_db', default=None,
+            help=('The database where votes are stored.')
+        ),
+        make_option("--score-database",
+            action='store', dest='score_db', default=None,
+            help=('The database where similarities are stored.')
+        ),
+    )
+    args = '[app_label.model [key]]'
+    help = "Compute the similarities between voted objects."
+
+    def handle(self, *args, **options):
+        verbose = int(options.get('verbosity')) > 0
+        vote_db = options['vote_db']
+        if args:
+            model = get_model(*args[0].split('.'))
+            if model is None:
+                raise CommandError('Invalid model: %s' % args[0])
+            votes = models.Vote.objects.using(vote_db).filter(
+                content_type=ContentType.objects.get_for_model(model))
+            if len(args) > 1:
+                votes = votes.filter(key=args[1])
+        else:
+            votes = models.Vote.objects.using(vote_db).all()
+        targets = votes.order_by().values_list('content_type', 'key')
+        for content_type_id, key in list(targets.distinct()):
+            content_type = ContentType.objects.get_for_id(content_type_id)
+            try:
+                counter = recommend.build_similarities(content_type, key,
+                    neighbours=options['neighbours'],
+                    method=options['method'],
+                    chunk_size=options['chunk_size'],
+                    batch_size=options['batch_size'],
+                    vote_db=vote_db, score_db=options['score_db'])
+            except ImproperlyConfigured, err:
+                raise CommandError(err)
+            if verbose:
+                print u'model %s key %s: %d objects' % (content_type, key,
+                    counter)
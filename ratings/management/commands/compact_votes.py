@@ -0,0 +1,43 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError, make_option
+
+from ratings import models
+
+class Command(BaseCommand):
+    """
+    Fold old votes in aggregates, one for each target object, key and score,
+    in order to shrink the votes table, e.g.::
+    
+        ./manage.py compact_votes -d 730
+        
+    Scores do not change, since aggregates are counted as if they were 
+    the original votes. The ids of users that voted are kept, so that it 
+    is still possible to check if a user voted, and a new vote by the same
+    user is not counted twice. Anonymous votes are never compacted.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--days', 
+            action='store', dest='days', default=730, type='int',
+            help=('Compact votes not modified in the last DAYS days.')
+        ),
+        make_option('-b', '--batch-size', 
+            action='store', dest='batch_size', default=1000, type='int',
+            help=('The number of votes compacted in a single transaction.')
+        ),
+        make_option("--vote-database",
+            action='store', dest='vote_db', default=None,
+            help=('The database where votes are stored.')
+        ),
+    )
+    help = "Fold old votes in aggregates, without changing scores."
+
+    def handle(self, **options):
+        if options['days'] < 0:
+            raise CommandError('The number of days must be positive.')
+        before = datetime.datetime.now() - datetime.timedelta(
+            days=options['days'])
+        counter = models.compact_votes(before, 
+            batch_size=options['batch_size'], using=options['vote_db'])
+        if int(options.get('verbosity')) > 0:
+            print u'%d votes compacted' % counter
@@ -0,0 +1,111 @@
+import datetime
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError, make_option
+from django.db.models import get_model
+from django.utils import timezone
+
+from ratings import exports, models
+
+class Command(BaseCommand):
+    """
+    Export votes as CSV, NumPy arrays (*npy* or *npz*) or Parquet, e.g.::
+
+        ./manage.py export_votes -f parquet -o votes.parquet --since 2013-01-01
+
+    Votes are streamed in batches, so memory usage does not depend on
+    the number of votes. Votes can be filtered by content type
+    (*--model app_label.model*), key and creation date (*--since* and
+    *--until*, both included). If no output file is given, CSV is written
+    to the standard output.
+    At the end, the number of exported votes per second is reported.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--format',
+            action='store', dest='format', default='csv',
+            choices=sorted(exports.FORMATS),
+            help=('The output format: csv, npy, npz or parquet.')
+        ),
+        make_option('-o', '--output',
+            action='store', dest='output', default=None,
+            help=('The output file.')
+        ),
+        make_option('-m', '--model',
+            action='store', dest='model', default=None,
+            help=('Export only votes given to this model (app_label.model).')
+        ),
+        make_option('-k', '--key',
+            action='store', dest='key', default=None,
+            help=('Export only votes given using this key.')
+        ),
+        make_option('--since',
+            action='store', dest='since', default=None,
+            help=('Export only votes created from this day (YYYY-MM-DD).')
+        ),
+        make_option('--until',
+            action='store', dest='until', default=None,
+            help=('Export only votes created until this day (YYYY-MM-DD).')
+        ),
+        make_option('-b', '--batch-size',
+            action='store', dest='batch_size', default=10000, type='int',
+            help=('The number of votes read in a single query.')
+        ),
+        make_option("--vote-database",
+            action='store', dest='vote_db', default=None,
+            help=('The database where votes are stored.')
+        ),
+    )
+    help = "Export votes as CSV, NumPy arrays or Parquet."
+
+    def handle(self, **options):
+        queryset = models.Vote.objects.using(options['vote_db']).all()
+        if options['model']:
+            model = get_model(*options['model'].split('.'))
+            if model is None:
+                raise CommandError('Invalid model: %s' % options['model'])
+            queryset = queryset.filter(
+                content_type=ContentType.objects.get_for_model(model))
+        if options['key']:
+            queryset = queryset.filter(key=options['key'])
+        if options['since']:
+            queryset = queryset.filter(
+                created_at__gte=self._get_datetime(options['since']))
+        if options['until']:
+            queryset = queryset.filter(created_at__lt=self._get_datetime(
+                options['until']) + datetime.timedelta(days=1))
+        # getting the writer
+        output, format = options['output'], options['format']
+        try:
+            if format == 'csv':
+                stream = self.stdout if output is None else open(output, 'wb')
+                writer = exports.CSVWriter(stream)
+            elif output is None:
+                raise CommandError('An output file is required for %s' %
+                    format)
+            else:
+                writer = exports.FORMATS[format](output)
+        except ImproperlyConfigured, err:
+            raise CommandError(err)
+        # exporting
+        start = time.time()
+        counter = exports.export_votes(queryset, writer,
+            batch_size=options['batch_size'])
+        elapsed = time.time() - start
+        if format == 'csv' and output is not None:
+            stream.close()
+        if int(options.get('verbosity')) > 0:
+            self.stderr.write(u'%d votes exported in %.2f seconds '
+                '(%d rows/sec)' % (counter, elapsed,
+                counter / elapsed if elapsed else counter))
+
+    def _get_datetime(self, value):
+        try:
+            value = datetime.datetime.strptime(value, '%Y-%m-%d')
+        except ValueError:
+            raise CommandError('Invalid date: %s' % value)
+        if settings.USE_TZ:
+            return timezone.make_aware(value, timezone.get_current_timezone())
+        return value
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from ratings import handlers
+
+class Command(BaseCommand):
+    """
+    Save the pending scores of coalesced vote changes (see 
+    *RatingHandler.vote_coalescing_window*) whose flush was lost, e.g.
+    because the process that scheduled it exited. Run it periodically, 
+    e.g. every few minutes::
+    
+        ./manage.py flush_pending_votes
+    """
+    help = "Save the pending scores of coalesced vote changes."
+
+    def handle(self, **options):
+        counter = 0
+        for handler in handlers.ratings._registry.values():
+            counter += len(handler.flush_pending_votes())
+        if int(options.get('verbosity')) > 0:
+            print u'%d votes saved' % counter
@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError, make_option
+
+from ratings import imports
+
+class Command(BaseCommand):
+    """
+    Import votes from CSV or JSON lines files, e.g. exported from a legacy
+    table or by the *export_votes* command::
+
+        ./manage.py import_votes votes.csv --on-conflict update
+
+    Each vote is validated using the handler of its model (score range 
+    and step), and target objects and users must exist. Votes are inserted
+    in batches, skipping (or updating, with *--on-conflict update*) votes
+    conflicting with existing ones. The scores of the voted objects
+    (and their daily rollups, if *RatingHandler.daily_rollups* is enabled)
+    are rebuilt at the end of the import.
+    
+    The format is guessed from the file extension, unless *--format* is 
+    given. Use '-' to read from the standard input.
+    """
+    option_list = BaseCommand.option_list + (
+        make_option('-f', '--format',
+            action='store', dest='format', default=None,
+            choices=sorted(imports.READERS),
+            help=('The input format: csv or jsonl.')
+        ),
+        make_option('--on-conflict',
+            action='store', dest='on_conflict', default=imports.SKIP,
+            choices=(imports.SKIP, imports.UPDATE),
+            help=('Skip or update votes conflicting with existing ones.')
+        ),
+        make_option('-b', '--batch-size',
+            action='store', dest='batch_size', default=1000, type='int',
+            help=('The number of votes inserted in a single query.')
+        ),
+        make_option("--vote-database",
+            action='store', dest='vote_db', default=None,
+            help=('The database where votes are stored.')
+        ),
+        make_option("--score-database",
+            action='store', dest='score_db', default=None,
+            help=('The database where scores are stored.')
+        ),
+    )
+    args = 'path'
+    help = "Import votes from CSV or JSON lines files."
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('A single input file is required.')
+        path = args[0]
+        format = options['format'] or os.path.splitext(path)[1][1:]
+        if format not in imports.READERS:
+            raise CommandError('Unknown format: %s' % format)
+        importer = imports.VoteImporter(batch_size=options['batch_size'],
+            on_conflict=options['on_conflict'], vote_db=options['vote_db'],
+            score_db=options['score_db'])
+        stream = sys.stdin if path == '-' else open(path, 'rb')
+        start = time.time()
+        try:
+            counters = importer.run(imports.READERS[format](stream))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if int(options.get('verbosity')) > 0:
+            for number, message in importer.errors:
+                self.stderr.write(u'row %d: %s' % (number, message))
+            self.stdout.write(u'%(created)d votes created, %(updated)d '
+                'updated, %(skipped)d skipped, %(invalid)d invalid' % 
+                counters)
+            self.stdout.write(u'%d scores rebuilt in %.2f seconds' % (
+                len(importer.targets), time.time() - start))
@@ -1,3 +1,6 @@
+import itertools
+
+from django.contrib.contenttypes.models import ContentType
 from django.core.management.base import BaseCommand, make_option
 
 from ratings import models
@@ -9,12 +12,23 @@ class Command(BaseCommand):
     or you want to change the weight of current votes, e.g.::
     
         ./manage.y upsert_scores -w 5
+        
+    Use *--vote-database* and *--score-database* if votes and scores are 
+    stored in different databases (see *RatingHandler.vote_db*).
     """
     option_list = BaseCommand.option_list + (
         make_option('-w', "--weight", 
             action='store', dest='weight', default=0, type='int',
             help=('The weight used to calculate average score.')
         ),
+        make_option("--vote-database", 
+            action='store', dest='vote_db', default=None,
+            help=('The database where votes are stored.')
+        ),
+        make_option("--score-database", 
+            action='store', dest='score_db', default=None,
+            help=('The database where scores are stored.')
+        ),
     )
     help = "Create or update all scores, based on existing votes."
 
@@ -23,11 +37,20 @@ class Command(BaseCommand):
             verbose = True
             counter = 0
         buffer = set()
-        for vote in models.Vote.objects.all():
-            content = (vote.content_type, vote.object_id, vote.key)
+        vote_db, score_db = options['vote_db'], options['score_db']
+        # compacted votes are counted too
+        contents = itertools.chain(
+            models.Vote.objects.using(vote_db).values_list('content_type', 
+                'object_id', 'key'),
+            models.VoteAggregate.objects.using(vote_db).values_list(
+                'content_type', 'object_id', 'key'))
+        for content_type_id, object_id, key in contents:
+            content = (ContentType.objects.get_for_id(content_type_id), 
+                object_id, key)
             if content not in buffer:
                 if verbose:
                     counter += 1
                     print u'#%d - model %s id %s key %s' % ((counter,) + content)
-                models.upsert_score(content[:2], content[2], options['weight'])
+                models.upsert_score(content[:2], content[2], options['weight'],
+                    vote_db=vote_db, score_db=score_db)
                 buffer.add(content)
@@ -53,6 +53,75 @@ class QuerysetWithContents(object):
         return len(self.queryset)
                 
 
+class QuerysetWithAnnotations(object):
+    """
+    Queryset wrapper attaching to each instance values fetched in bulk 
+    from a ratings model (e.g. *Score*) stored in the database *using*.
+    
+    This is used to annotate querysets when ratings and target objects 
+    live in different databases, so that a subquery cannot be used: the 
+    values are merged in Python and cannot be used to sort the queryset.
+    """
+    chunk_size = 500
+    # queryset methods returning querysets, whose results are wrapped
+    queryset_methods = ('all', 'filter', 'exclude', 'complex_filter', 
+        'order_by', 'reverse', 'distinct', 'select_related', 
+        'prefetch_related', 'select_for_update', 'using', 'defer', 'only',
+        'extra', 'annotate', 'none')
+    
+    def __init__(self, queryset, model, lookups, select, using):
+        self.queryset = queryset
+        self.model = model
+        self.lookups = lookups
+        self.select = select
+        self.using = using
+        
+    def _clone(self, queryset):
+        return self.__class__(queryset, self.model, self.lookups, 
+            self.select, self.using)
+        
+    def __getattr__(self, name):
+        attr = getattr(self.queryset, name)
+        if name in self.queryset_methods:
+            def _wrap(*args, **kwargs):
+                return self._clone(attr(*args, **kwargs))
+            return _wrap
+        return attr
+        
+    def get(self, *args, **kwargs):
+        return self._annotate_objects([self.queryset.get(*args, **kwargs)])[0]
+        
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return self._clone(self.queryset[key])
+        return self._annotate_objects([self.queryset[key]])[0]
+        
+    def _annotate_objects(self, objects):
+        """
+        Attach the requested values to the given *objects*, using 
+        one query for each chunk of *chunk_size* objects.
+        """
+        aliases, fields = zip(*self.select.items())
+        values = {}
+        pk_list = [i.pk for i in objects]
+        for i in range(0, len(pk_list), self.chunk_size):
+            queryset = self.model.objects.using(self.using).filter(
+                object_id__in=pk_list[i:i + self.chunk_size], **self.lookups)
+            for row in queryset.values_list('object_id', *fields):
+                values[row[0]] = row[1:]
+        empty = (None,) * len(fields)
+        for i in objects:
+            for alias, value in zip(aliases, values.get(i.pk, empty)):
+                setattr(i, alias, value)
+        return objects
+        
+    def __iter__(self):
+        return iter(self._annotate_objects(list(self.queryset)))
+        
+    def __len__(self):
+        return len(self.queryset)
+        
+
 class RatingsManager(models.Manager):
     """
     Manager used by *Score* and *Vote* models.
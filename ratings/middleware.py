@@ -0,0 +1,20 @@
+from ratings import routers, settings
+
+class ReadPinningMiddleware(object):
+    """
+    Pin the ratings reads of the current request to the write database
+    if the user recently voted (see *RatingHandler.pin_reads_after_vote*),
+    so that users always see their own votes even if replicas lag behind.
+    
+    This middleware also resets the pin and the replica chosen for the
+    request (see *ratings.routers.reset*), so that they do not leak to
+    the next request served by the same thread.
+    """
+    def process_request(self, request):
+        routers.reset()
+        if settings.PIN_COOKIE_NAME in request.COOKIES:
+            routers.pin()
+
+    def process_response(self, request, response):
+        routers.reset()
+        return response
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding index on 'Comment', fields ['content_type', 'object_id', 'created_at']
+        db.create_index(u'ratings_comment', ['content_type_id', 'object_id', 'created_at'])
+
+        # Adding index on 'Comment', fields ['content_type', 'object_id', 'key']
+        db.create_index(u'ratings_comment', ['content_type_id', 'object_id', 'key'])
+
+        # Adding index on 'Vote', fields ['content_type', 'object_id', 'ip_address', 'created_at']
+        db.create_index(u'ratings_vote', ['content_type_id', 'object_id', 'ip_address', 'created_at'])
+
+        # Adding index on 'Vote', fields ['content_type', 'object_id', 'modified_at']
+        db.create_index(u'ratings_vote', ['content_type_id', 'object_id', 'modified_at'])
+
+        # Adding index on 'Vote', fields ['content_type', 'object_id', 'key', 'cookie']
+        db.create_index(u'ratings_vote', ['content_type_id', 'object_id', 'key', 'cookie'])
+
+        # Adding index on 'Vote', fields ['user', 'content_type', 'modified_at']
+        db.create_index(u'ratings_vote', ['user_id', 'content_type_id', 'modified_at'])
+
+        # Adding index on 'Score', fields ['content_type', 'key', 'average']
+        db.create_index(u'ratings_score', ['content_type_id', 'key', 'average'])
+
+        # Adding index on 'Score', fields ['content_type', 'key', 'num_votes']
+        db.create_index(u'ratings_score', ['content_type_id', 'key', 'num_votes'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'Score', fields ['content_type', 'key', 'num_votes']
+        db.delete_index(u'ratings_score', ['content_type_id', 'key', 'num_votes'])
+
+        # Removing index on 'Score', fields ['content_type', 'key', 'average']
+        db.delete_index(u'ratings_score', ['content_type_id', 'key', 'average'])
+
+        # Removing index on 'Vote', fields ['user', 'content_type', 'modified_at']
+        db.delete_index(u'ratings_vote', ['user_id', 'content_type_id', 'modified_at'])
+
+        # Removing index on 'Vote', fields ['content_type', 'object_id', 'key', 'cookie']
+        db.delete_index(u'ratings_vote', ['content_type_id', 'object_id', 'key', 'cookie'])
+
+        # Removing index on 'Vote', fields ['content_type', 'object_id', 'modified_at']
+        db.delete_index(u'ratings_vote', ['content_type_id', 'object_id', 'modified_at'])
+
+        # Removing index on 'Vote', fields ['content_type', 'object_id', 'ip_address', 'created_at']
+        db.delete_index(u'ratings_vote', ['content_type_id', 'object_id', 'ip_address', 'created_at'])
+
+        # Removing index on 'Comment', fields ['content_type', 'object_id', 'key']
+        db.delete_index(u'ratings_comment', ['content_type_id', 'object_id', 'key'])
+
+        # Removing index on 'Comment', fields ['content_type', 'object_id', 'created_at']
+        db.delete_index(u'ratings_comment', ['content_type_id', 'object_id', 'created_at'])
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'ratings.comment': {
+            'Meta': {'object_name': 'Comment', 'index_together': "(('content_type', 'object_id', 'key'), ('content_type', 'object_id', 'created_at'))"},
+            'comment': ('django.db.models.fields.TextField', [], {'max_length': '3000'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            'cookie': ('django.db.models.fields.CharField', [], {'max_length': '64', 'null': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('django.db.models.fields.IPAddressField', [], {'max_length': '15', 'null': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'modified_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'comments'", 'null': 'True', 'to': u"orm['auth.User']"}),
+            'user_name': ('django.db.models.fields.CharField', [], {'max_length': '50', 'blank': 'True'}),
+            'vote': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'comments'", 'null': 'True', 'to': u"orm['ratings.Vote']"})
+        },
+        u'ratings.score': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'key'),)", 'object_name': 'Score', 'index_together': "(('content_type', 'key', 'average'), ('content_type', 'key', 'num_votes'))"},
+            'average': ('django.db.models.fields.FloatField', [], {'default': '0'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'num_votes': ('django.db.models.fields.PositiveIntegerField', [], {'default': '0'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'total': ('django.db.models.fields.IntegerField', [], {'default': '0'})
+        },
+        u'ratings.vote': {
+            'Meta': {'unique_together': "(('content_type', 'object_id', 'key', 'user'), ('content_type', 'object_id', 'key', 'ip_address', 'cookie'))", 'object_name': 'Vote', 'index_together': "(('content_type', 'object_id', 'modified_at'), ('content_type', 'object_id', 'ip_address', 'created_at'), ('content_type', 'object_id', 'key', 'cookie'), ('user', 'content_type', 'modified_at'))"},
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            'cookie': ('django.db.models.fields.CharField', [], {'max_length': '64', 'null': 'True', 'blank': 'True'}),
+            'created_at': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'ip_address': ('django.db.models.fields.IPAddressField', [], {'max_length': '15', 'null': 'True'}),
+            'key': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'modified_at': ('django.db.models.fields.DateTimeField', [], {'auto_now': 'True', 'blank': 'True'}),
+            'object_id': ('django.db.models.fields.PositiveIntegerField', [], {}),
+            'score': ('django.db.models.fields.FloatField', [], {}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'votes'", 'null': 'True', 'to': u"orm['auth.User']"})
+        }
+    }
+
+    complete_apps = ['ratings']
\ No newline at end of file
@@ -1,11 +1,22 @@
+from contextlib import contextmanager
+import itertools
+import math
 import string
 
-from django.db import models, transaction, IntegrityError
+from django.db import models, router, transaction, IntegrityError
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
+from django.utils import simplejson as json
+from django.utils import timezone
 from django.utils.datastructures import SortedDict
 from django.contrib.auth.models import User
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ratings import events
 from ratings import managers
 from ratings import settings
 
@@ -25,26 +36,59 @@ class Score(models.Model):
     total = models.IntegerField(default=0)
     num_votes = models.PositiveIntegerField(default=0)
     
+    # distribution of votes
+    sum_of_squares = models.FloatField(default=0)
+    variance = models.FloatField(default=0)
+    histogram = models.TextField(blank=True)
+    
+    # incremented each time the score is recalculated by *upsert_score*
+    version = models.PositiveIntegerField(default=0)
+    modified_at = models.DateTimeField(auto_now=True)
+    
     # manager
     objects = managers.RatingsManager()
         
     class Meta:
         unique_together = ('content_type', 'object_id', 'key')
+        index_together = (
+            # sorting scores by average, number of votes or controversy
+            ('content_type', 'key', 'average'),
+            ('content_type', 'key', 'num_votes'),
+            ('content_type', 'key', 'variance'),
+        )
 
     def __unicode__(self):
         return u'Score for %s' % self.content_object
         
-    def get_votes(self):
+    def get_votes(self, using=None):
         """
         Return all the related votes (same *content_object* and *key*).
+        
+        Use the optional argument *using* to read votes stored in 
+        a database other than the default one.
+        """
+        return Vote.objects.using(using).filter(
+            content_type=self.content_type_id, object_id=self.object_id, 
+            key=self.key)
+        
+    def get_aggregates(self, using=None):
+        """
+        Return all the related compacted votes (same *content_object* 
+        and *key*), see *VoteAggregate*.
+        
+        Use the optional argument *using* to read aggregates stored in 
+        a database other than the default one.
         """
-        return Vote.objects.filter(content_type=self.content_type,
-            object_id=self.object_id, key=self.key)
+        return VoteAggregate.objects.using(using).filter(
+            content_type=self.content_type_id, object_id=self.object_id, 
+            key=self.key)
     
-    def recalculate(self, weight=0, commit=True):
+    def recalculate(self, weight=0, commit=True, vote_db=None):
         """
-        Recalculate the score using all the related votes, and updating
-        average score, total score and number of votes.
+        Recalculate the score using all the related votes (including 
+        compacted ones), and updating average score, total score, 
+        number of votes and the distribution of votes (histogram, sum of
+        squares and variance).
         
         The optional argument *weight* is used to calculate the average
         score: an higher value means a lot of votes are needed to increase
@@ -52,20 +96,67 @@ class Score(models.Model):
         
         If the optional argument *commit* is False then the object
         is not saved.
+        
+        Votes are read from the *vote_db* database, if given: votes and 
+        scores are never joined, so they can be stored in different 
+        databases. The score is saved in the database it was read from.
         """
-        data = self.get_votes().aggregate(total=models.Sum('score'),
-            num_votes=models.Count('id'))
-        # total is None in MySQL if there are no votes
-        self.total = data['total'] or 0
-        self.num_votes = data['num_votes']
+        # scores are discrete: votes are counted for each score
+        counts = {}
+        votes = self.get_votes(vote_db).values_list('score').annotate(
+            num_votes=models.Count('id')).order_by()
+        aggregates = self.get_aggregates(vote_db).values_list('score', 
+            'num_votes')
+        for score, num_votes in itertools.chain(votes, aggregates):
+            counts[score] = counts.get(score, 0) + num_votes
+        self.set_histogram(counts)
+        self.num_votes = sum(counts.values())
+        self.total = sum(k * v for k, v in counts.items())
+        self.sum_of_squares = sum(k * k * v for k, v in counts.items())
         if self.num_votes:
             self.average = self.total / (self.num_votes + weight)
+            mean = self.total / float(self.num_votes)
+            self.variance = max(self.sum_of_squares / self.num_votes - 
+                mean * mean, 0)
         else:
-            self.average = 0
+            self.average = self.variance = 0
         if commit:
-            self.save()
+            self.save(using=self._state.db)
+        
+    def get_histogram(self):
+        """
+        Return a *SortedDict* mapping each score with the number of votes.
+        """
+        if not hasattr(self, '_histogram_cache'):
+            self._histogram_cache = SortedDict(
+                (k, v) for k, v in json.loads(self.histogram or '[]'))
+        return self._histogram_cache
         
-    def get_stats(self):
+    def set_histogram(self, counts):
+        """
+        Store the number of votes for each score, given the dict *counts*.
+        """
+        self._histogram_cache = SortedDict(
+            (k, counts[k]) for k in sorted(counts) if counts[k])
+        self.histogram = json.dumps(self._histogram_cache.items())
+        
+    def percentile(self, percent):
+        """
+        Return the score below which the given *percent* (from 0 to 100)
+        of votes falls, e.g. *score.percentile(90)*.
+        Return None if the score has no votes.
+        """
+        return _get_percentile(self.get_histogram(), percent)
+        
+    @property
+    def median(self):
+        return self.percentile(50)
+        
+    @property
+    def stddev(self):
+        return math.sqrt(self.variance)
+        
+    def get_stats(self, vote_db=None):
         """
         Return useful statistics for all the related votes 
         (same *content_object* and *key*). as a *SortedDict* mapping
@@ -77,8 +168,14 @@ class Score(models.Model):
                 'total_num_votes': 8, 
                 'num_votes': 3
             }
+            
+        The stored histogram is used, if available, so that votes are 
+        not counted again.
         """
-        return get_stats_for(self.get_votes(), num_votes=self.num_votes)
+        if self.histogram:
+            return _get_stats(self.get_histogram(), self.num_votes)
+        return get_stats_for(self.get_votes(vote_db), 
+            num_votes=self.num_votes, aggregates=self.get_aggregates(vote_db))
         
         
 class Vote(models.Model):
@@ -106,6 +203,16 @@ class Vote(models.Model):
             ('content_type', 'object_id', 'key', 'user'),
             ('content_type', 'object_id', 'key', 'ip_address', 'cookie'),
         )
+        index_together = (
+            # latest votes given to a target object
+            ('content_type', 'object_id', 'modified_at'),
+            # anonymous votes given by an ip address
+            ('content_type', 'object_id', 'ip_address', 'created_at'),
+            # anonymous votes looked up by cookie
+            ('content_type', 'object_id', 'key', 'cookie'),
+            # votes given by a user to a content type
+            ('user', 'content_type', 'modified_at'),
+        )
 
     def __unicode__(self):
         return u'Vote %d to %s by %s' % (self.score, self.content_object,
@@ -131,6 +238,144 @@ class Vote(models.Model):
         return not self.user_id
         
 
+class VoteAggregate(models.Model):
+    """
+    Old votes relating a content object, folded by the *compact_votes* 
+    management command: each instance represents the number of votes
+    with the same *key* and *score*.
+    
+    The field *voters* contains the ids of the users that gave the votes,
+    in the form *',1,5,9,'*.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    
+    key = models.CharField(max_length=16)
+    score = models.FloatField()
+    num_votes = models.PositiveIntegerField(default=0)
+    voters = models.TextField(blank=True)
+    
+    # manager
+    objects = managers.RatingsManager()
+    
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'key', 'score')
+
+    def __unicode__(self):
+        return u'%d votes %s to %s' % (self.num_votes, self.score, 
+            self.content_object)
+            
+    def get_voters(self):
+        """
+        Return the list of ids of users that gave the compacted votes.
+        """
+        return [int(i) for i in self.voters.split(',') if i]
+        
+
+class VoteRollup(models.Model):
+    """
+    The votes given to a content object in a single day: number of votes,
+    sum of scores and number of votes for each score (*histogram*).
+    
+    Rollups are maintained by the handler when votes are created, changed
+    or deleted (votes are counted in the day they were created), and can 
+    be rebuilt using the *backfill_rollups* management command.
+    """
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    
+    key = models.CharField(max_length=16)
+    day = models.DateField()
+    
+    num_votes = models.IntegerField(default=0)
+    total = models.FloatField(default=0)
+    histogram = models.TextField(blank=True)
+    
+    # manager
+    objects = managers.RatingsManager()
+    
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'key', 'day')
+        index_together = (
+            # rollups of all the objects of a content type in a period
+            ('content_type', 'key', 'day'),
+        )
+
+    def __unicode__(self):
+        return u'%d votes to %s on %s' % (self.num_votes, 
+            self.content_object, self.day)
+            
+    def get_histogram(self):
+        """
+        Return a *SortedDict* mapping each score with the number of votes.
+        """
+        return SortedDict((k, v) for k, v in json.loads(self.histogram or '[]'))
+        
+    def set_histogram(self, counts):
+        """
+        Store the number of votes for each score, given the dict *counts*.
+        """
+        self.histogram = json.dumps([(k, counts[k]) for k in sorted(counts) 
+            if counts[k]])
+        
+
+class LeaderboardEntry(models.Model):
+    """
+    A position in the leaderboard of the objects of a content type having
+    the highest values of a score field (*metric*) for a given *key*.
+    
+    Leaderboards are bounded and maintained by the handler when scores
+    change (see *ratings.leaderboards*): this table is the source of truth
+    for the leaderboards stored in the cache.
+    """
+    content_type = models.ForeignKey(ContentType)
+    key = models.CharField(max_length=16)
+    metric = models.CharField(max_length=16)
+    position = models.PositiveIntegerField()
+    
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    value = models.FloatField()
+    
+    class Meta:
+        unique_together = ('content_type', 'key', 'metric', 'position')
+        
+    def __unicode__(self):
+        return u'#%d %s by %s: %s' % (self.position, self.key, self.metric,
+            self.content_object)
+        
+
+class Similarity(models.Model):
+    """
+    The similarity between two objects of a content type, calculated 
+    using the votes given by users for a given *key*.
+    
+    Each object is stored together with its most similar objects
+    (the neighbours): similarities are precomputed by the 
+    *build_similarities* management command (see *ratings.recommend*).
+    """
+    content_type = models.ForeignKey(ContentType)
+    key = models.CharField(max_length=16)
+    
+    object_id = models.PositiveIntegerField()
+    content_object = generic.GenericForeignKey('content_type', 'object_id')
+    neighbour_id = models.PositiveIntegerField()
+    similarity = models.FloatField()
+    
+    class Meta:
+        unique_together = ('content_type', 'key', 'object_id', 'neighbour_id')
+        index_together = (
+            # neighbours of an object ordered by similarity
+            ('content_type', 'key', 'object_id', 'similarity'),
+        )
+        
+    def __unicode__(self):
+        return u'%s similar to %s (%s): %s' % (self.neighbour_id, 
+            self.content_object, self.key, self.similarity)
+        
+
 class Comment(models.Model):
     """
     A single comment relating a content object.
@@ -155,6 +400,13 @@ class Comment(models.Model):
     # manager
     objects = managers.RatingsManager()
 
+    class Meta:
+        index_together = (
+            # comments given to a target object
+            ('content_type', 'object_id', 'key'),
+            ('content_type', 'object_id', 'created_at'),
+        )
+
     def __unicode__(self):
         return u'Comment #%d to %s by %s' % (self.id, self.content_object,
             self.user or self.ip_address)
@@ -186,11 +438,34 @@ def _get_content(instance_or_content):
     else:
         return (managers.get_content_type_for_model(type(instance_or_content)), 
             object_id)
+
+@contextmanager
+def in_transaction(*databases):
+    """
+    Context manager running its block in a transaction on each of the
+    given *databases* (aliases), committing on success and rolling back 
+    on errors.
+    
+    A transaction is only opened on the databases not already under
+    transaction management (e.g. by an outer *in_transaction* or by the
+    *TransactionMiddleware*): there the block joins the caller's 
+    transaction, which is not committed early.
+    """
+    databases = sorted(set(databases))
+    if not databases:
+        yield
+    elif transaction.is_managed(using=databases[0]):
+        with in_transaction(*databases[1:]):
+            yield
+    else:
+        with transaction.commit_on_success(using=databases[0]):
+            with in_transaction(*databases[1:]):
+                yield
  
 
 # STATS         
             
-def get_stats_for(votes, num_votes=None):
+def get_stats_for(votes, num_votes=None, aggregates=None):
     """
     Return useful statistics for given *votes* as a *SortedDict* mapping
     the single score with stats, e.g.::
@@ -201,27 +476,208 @@ def get_stats_for(votes, num_votes=None):
             'total_num_votes': 8, 
             'num_votes': 3
         }
+        
+    The argument *votes* can be a queryset, counted using a single 
+    grouped query, or an already loaded sequence of votes or scores 
+    (e.g. a list of votes or a NumPy array), counted in memory without
+    hitting the database.
+        
+    The optional argument *aggregates* is a queryset or a sequence of 
+    compacted votes (see *VoteAggregate*) to be counted together 
+    with *votes*.
+    """
+    return _get_stats(_count_scores(votes, aggregates), num_votes)
+
+def get_summary_for(votes, percentiles=(25, 50, 75), aggregates=None):
+    """
+    Return a dict summarizing the given *votes* (and compacted votes 
+    *aggregates*, see *get_stats_for*), e.g.::
+    
+        {
+            'stats': SortedDict([(1.0, {...}), (4.0, {...})]),
+            'num_votes': 8,
+            'mean': 2.125,
+            'variance': 2.109375,
+            'percentiles': SortedDict([(25, 1.0), (50, 1.0), (75, 4.0)]),
+        }
+        
+    where *stats* are the statistics returned by *get_stats_for* and
+    *percentiles* maps each requested percentile with its score 
+    (nearest rank, see *Score.percentile*). 
+    Mean, variance and percentiles are None if there are no votes.
+    """
+    counts = _count_scores(votes, aggregates)
+    histogram = SortedDict((k, counts[k]) for k in sorted(counts))
+    num_votes = sum(counts.values())
+    summary = {
+        'stats': _get_stats(counts, num_votes),
+        'num_votes': num_votes,
+        'mean': None,
+        'variance': None,
+        'percentiles': SortedDict((i, _get_percentile(histogram, i)) 
+            for i in percentiles),
+    }
+    if num_votes:
+        mean = sum(k * v for k, v in counts.items()) / float(num_votes)
+        summary['mean'] = mean
+        summary['variance'] = max(sum(k * k * v for k, v in counts.items()) /
+            float(num_votes) - mean * mean, 0)
+    return summary
+
+def _count_scores(votes, aggregates=None):
+    """
+    Return a dict mapping each score with the number of *votes* 
+    (and compacted votes *aggregates*) having that score.
+    
+    Querysets are counted using a grouped query, while sequences of votes
+    or scores are counted in memory: if NumPy is installed, counting is 
+    vectorised using *bincount* over the grid of distinct scores.
+    """
+    if isinstance(votes, models.query.QuerySet):
+        counts = dict(votes.values_list('score').annotate(
+            num_votes=models.Count('id')).order_by())
+    elif numpy is not None:
+        if not isinstance(votes, numpy.ndarray):
+            votes = [getattr(i, 'score', i) for i in votes]
+        scores, indexes = numpy.unique(numpy.asarray(votes, 
+            dtype=numpy.float64), return_inverse=True)
+        counts = dict(zip(scores.tolist(), 
+            numpy.bincount(indexes).tolist()))
+    else:
+        counts = {}
+        for vote in votes:
+            score = float(getattr(vote, 'score', vote))
+            counts[score] = counts.get(score, 0) + 1
+    if aggregates is not None:
+        if isinstance(aggregates, models.query.QuerySet):
+            aggregates = aggregates.values_list('score', 'num_votes')
+        else:
+            aggregates = [(i.score, i.num_votes) for i in aggregates]
+        for score, aggregate_num_votes in aggregates:
+            counts[score] = counts.get(score, 0) + aggregate_num_votes
+    return counts
+
+def _get_percentile(histogram, percent):
+    """
+    Return the score below which the given *percent* of votes falls,
+    given the *histogram* (a *SortedDict* mapping each score with 
+    the number of votes), using the nearest rank method.
+    Return None if there are no votes.
+    """
+    num_votes = sum(histogram.values())
+    if not num_votes:
+        return None
+    rank = max(int(math.ceil(percent / 100.0 * num_votes)), 1)
+    counter = 0
+    for score, score_num_votes in histogram.items():
+        counter += score_num_votes
+        if counter >= rank:
+            return score
+    return score
+
+def _get_stats(counts, num_votes=None):
+    """
+    Return the stats *SortedDict* given the *counts* of votes for 
+    each score.
     """
     if num_votes is None:
-        try:
-            num_votes = votes.count()
-        except AttributeError:
-            num_votes = len(votes)
-    votes_stats = votes.order_by('score').values('score').annotate(
-        num_votes=models.Count('score'))
+        num_votes = sum(counts.values())
     stats = SortedDict()
-    for i in votes_stats:
-        i.update({
+    for score in sorted(counts):
+        stats[score] = {
+            'score': score,
+            'num_votes': counts[score],
             'total_num_votes': num_votes,
-            'percent': i['num_votes'] * 100.0 / num_votes,
-        })
-        stats[i['score']] = i
+            'percent': counts[score] * 100.0 / num_votes,
+        }
+    return stats
+    
+def get_versions_for_many(content_type, key, object_ids, using=None):
+    """
+    Return a dict mapping the given *object_ids* of *content_type* with
+    the versions of their scores for *key* (see *upsert_score*), using 
+    a single query. 
+    
+    A version is a string containing the *Score.version* counter and the
+    modification time of the score, so that it also changes when a score 
+    is deleted and created again (ids can be reused by the database).
+    The version of objects without a score is '0'.
+    """
+    versions = dict.fromkeys(object_ids, '0')
+    scores = Score.objects.using(using).filter(content_type=content_type,
+        key=key, object_id__in=object_ids).values_list('object_id', 
+        'version', 'modified_at')
+    for object_id, version, modified_at in scores:
+        versions[object_id] = '%s.%s' % (version, 
+            modified_at.strftime('%Y%m%d%H%M%S%f'))
+    return versions
+
+def get_stats_for_many(content_type_or_queryset, key, object_ids=None, 
+    vote_db=None, score_db=None):
+    """
+    Return the statistics (see *get_stats_for*) of many target objects
+    as a dict mapping each object id with a *SortedDict* of stats, e.g.::
+    
+        stats = get_stats_for_many(Article.objects.filter(is_active=True),
+            'main')
+        for article in articles:
+            stats.get(article.pk, {})
+    
+    The first argument can be a content type, and in that case all 
+    the objects of the content type are considered (unless *object_ids* 
+    is given), or a queryset of target objects. The argument *key* is 
+    the score key.
+    
+    Statistics are built from the histograms stored in scores, using 
+    a single query. Objects having a score without histogram (computed 
+    before histograms were introduced: use the *upsert_scores* command 
+    to update them) have their votes counted using a single query grouped 
+    by object and score, adding compacted votes (see *VoteAggregate*).
+    Objects without votes are not included in the returned dict.
+    
+    Use the optional arguments *vote_db* and *score_db* to read votes 
+    and scores stored in databases other than the default one.
+    """
+    if isinstance(content_type_or_queryset, ContentType):
+        content_type = content_type_or_queryset
+    else:
+        content_type = managers.get_content_type_for_model(
+            content_type_or_queryset.model)
+        object_ids = list(content_type_or_queryset.values_list('pk', 
+            flat=True))
+    lookups = {'content_type': content_type, 'key': key}
+    if object_ids is not None:
+        lookups['object_id__in'] = object_ids
+    stats, missing = {}, []
+    for object_id, num_votes, histogram in Score.objects.using(score_db
+        ).filter(**lookups).values_list('object_id', 'num_votes', 
+        'histogram'):
+        if histogram:
+            counts = dict(json.loads(histogram))
+            if counts:
+                stats[object_id] = _get_stats(counts)
+        elif num_votes:
+            missing.append(object_id)
+    if missing:
+        lookups['object_id__in'] = missing
+        counts = {}
+        votes = Vote.objects.using(vote_db).filter(**lookups).values(
+            'object_id', 'score').annotate(num_votes=models.Count('id')
+            ).order_by()
+        aggregates = VoteAggregate.objects.using(vote_db).filter(**lookups
+            ).values('object_id', 'score', 'num_votes')
+        for i in itertools.chain(votes, aggregates):
+            object_counts = counts.setdefault(i['object_id'], {})
+            object_counts[i['score']] = object_counts.get(i['score'], 0) + (
+                i['num_votes'])
+        stats.update((k, _get_stats(v)) for k, v in counts.items())
     return stats
         
         
 # ADDING OR CHANGING SCORES AND VOTES
 
-def upsert_score(instance_or_content, key, weight=0):
+def upsert_score(instance_or_content, key, weight=0, vote_db=None, 
+    score_db=None):
     """
     Update or create current score values (average score, total score and 
     number of votes) for target object *instance_or_content* and 
@@ -233,36 +689,406 @@ def upsert_score(instance_or_content, key, weight=0):
     You can use the optional argument *weight* to make more difficult
     for a target object to obtain a higher rating.
     
+    Votes are read from the *vote_db* database and the score is stored
+    in the *score_db* database: if not given, the databases are chosen
+    by the database routers.
+    
+    This function is safe under concurrency: the score row is locked 
+    before votes are counted, so that concurrent recalculations are 
+    serialized and the last one always sees all the committed votes.
+    This holds under the READ COMMITTED isolation level, and under 
+    REPEATABLE READ (the MySQL default) as long as the caller's 
+    transaction, if any, did not read from *score_db* before: the 
+    snapshot is taken at the first read, which must follow the lock.
+    If votes are stored in another database, that database should use
+    READ COMMITTED.
+    Each call increments the score *version*, and publishes the new
+    values to subscribers of live updates (see *ratings.events*).
+    
+    The score is saved in a transaction committed before returning, unless
+    the caller already manages a transaction on *score_db* (e.g. using 
+    *in_transaction* or the *TransactionMiddleware*): in that case the 
+    score joins the caller's transaction, and the row stays locked until
+    the caller commits.
+    
     Return a sequence *score, created*.
     """
     content_type, object_id = _get_content(instance_or_content)
-    score, created = Score.objects.get_or_create(content_type=content_type,
+    using = score_db or router.db_for_write(Score)
+    scores = Score.objects.using(using).filter(content_type=content_type,
         object_id=object_id, key=key)
-    score.recalculate(weight=weight)
+    bump = lambda: scores.update(version=models.F('version') + 1)
+    with in_transaction(using):
+        # the row is locked before anything is read: bumping the version 
+        # locks the row until the transaction ends (this works where 
+        # *select_for_update* is not supported), and under REPEATABLE READ
+        # the snapshot used to count votes is taken after the lock
+        created = not bump()
+        if created:
+            savepoint = transaction.savepoint(using=using)
+            try:
+                score = Score.objects.using(using).create(
+                    content_type=content_type, object_id=object_id, 
+                    key=key, version=1)
+            except IntegrityError:
+                # a concurrent transaction created the score
+                transaction.savepoint_rollback(savepoint, using=using)
+                created = False
+                bump()
+            else:
+                transaction.savepoint_commit(savepoint, using=using)
+        if not created:
+            score = scores.get()
+        score.recalculate(weight=weight, vote_db=vote_db)
+    # subscribers are notified once the new values are stored (committed,
+    # unless the caller manages the transaction)
+    events.publish_score(score)
     return score, created
 
 
+# COMPACTING VOTES
+
+def _compact_group(content, votes, using):
+    """
+    Fold the given *votes* (a sequence of *(id, score, user_id)*) 
+    of the target object and key *content* in the vote aggregates
+    stored in the *using* database.
+    """
+    content_type_id, object_id, key = content
+    grouped = {}
+    for vote_id, score, user_id in votes:
+        grouped.setdefault(score, []).append(user_id)
+    for score, voters in grouped.items():
+        aggregate, _ = VoteAggregate.objects.using(using).get_or_create(
+            content_type_id=content_type_id, object_id=object_id, 
+            key=key, score=score)
+        aggregate.num_votes += len(voters)
+        voters = sorted(set(aggregate.get_voters() + voters))
+        aggregate.voters = ',%s,' % ','.join(map(str, voters))
+        aggregate.save(using=using)
+    vote_ids = [i[0] for i in votes]
+    # comments must survive the compaction of their votes
+    Comment.objects.using(using).filter(vote__in=vote_ids).update(vote=None)
+    Vote.objects.using(using).filter(pk__in=vote_ids)._raw_delete(using)
+
+def compact_votes(before, queryset=None, batch_size=1000, using=None):
+    """
+    Fold all the votes not modified since *before* (a datetime) in 
+    aggregates, one for each target object, key and score 
+    (see *VoteAggregate*).
+    
+    Scores, stats and the *upsert_scores* command count aggregates as 
+    if they were the original votes, so scores do not change.
+    
+    The ids of users that voted are kept in aggregates, so that 
+    *RatingHandler.has_voted* still works for them, and a new vote by 
+    the same user replaces the compacted one (see *release_compacted_vote*)
+    instead of being counted twice. For the same reason, anonymous votes 
+    are never compacted.
+    
+    The optional argument *queryset* can be used to compact only a 
+    subset of votes. Votes and aggregates are stored in the *using* 
+    database (if not given, the database is chosen by the database 
+    routers). Votes are processed in batches of *batch_size*, each
+    one in its own transaction. Return the number of compacted votes.
+    """
+    using = using or router.db_for_write(Vote)
+    if queryset is None:
+        queryset = Vote.objects.all()
+    # ordering and filtering do not join other tables, which can live 
+    # in another database
+    queryset = queryset.using(using).filter(modified_at__lt=before).exclude(
+        user=None).order_by('pk')
+    counter = 0
+    while True:
+        rows = list(queryset.values_list('id', 'content_type', 'object_id',
+            'key', 'score', 'user')[:batch_size])
+        if not rows:
+            return counter
+        groups = SortedDict()
+        for vote_id, content_type_id, object_id, key, score, user_id in rows:
+            groups.setdefault((content_type_id, object_id, key), []).append(
+                (vote_id, score, user_id))
+        with transaction.commit_on_success(using=using):
+            for content, votes in groups.items():
+                _compact_group(content, votes, using)
+        counter += len(rows)
+
+def release_compacted_vote(instance_or_content, key, user, using=None):
+    """
+    Remove *user* from the compacted votes given to *instance_or_content*
+    using *key*: this must be done when a new vote replaces the 
+    compacted one.
+    
+    Return True if a compacted vote by *user* was found.
+    """
+    content_type, object_id = _get_content(instance_or_content)
+    aggregates = VoteAggregate.objects.using(using).filter(content_type=content_type,
+        object_id=object_id, key=key, voters__contains=',%s,' % user.pk)
+    for aggregate in aggregates:
+        voters = [i for i in aggregate.get_voters() if i != user.pk]
+        aggregate.voters = ',%s,' % ','.join(map(str, voters)) if voters else ''
+        aggregate.num_votes -= 1
+        if aggregate.num_votes:
+            aggregate.save(using=aggregate._state.db)
+        else:
+            aggregate.delete(using=aggregate._state.db)
+        return True
+    return False
+
+
+# DAILY ROLLUPS
+
+def get_day(value):
+    """
+    Return the day (in the current time zone) of the datetime *value*.
+    """
+    if timezone.is_aware(value):
+        value = timezone.localtime(value)
+    return value.date()
+
+def update_rollup(instance_or_content, key, day, added=(), removed=(), 
+    using=None):
+    """
+    Update the rollup of *day* for target object *instance_or_content*
+    and the given *key*, adding the scores in the sequence *added* and 
+    removing the scores in the sequence *removed*, e.g. when a vote
+    created on *day* is changed from 2 to 4::
+    
+        update_rollup(article, 'main', day, added=[4], removed=[2])
+        
+    The rollup row is locked while it is updated, in the caller's 
+    transaction if any (see *in_transaction*). Use the optional argument 
+    *using* to store rollups in a database other than the default one.
+    """
+    content_type, object_id = _get_content(instance_or_content)
+    using = using or router.db_for_write(VoteRollup)
+    with in_transaction(using):
+        rollup, _ = VoteRollup.objects.using(using).get_or_create(
+            content_type=content_type, object_id=object_id, key=key, day=day)
+        VoteRollup.objects.using(using).filter(pk=rollup.pk).update(
+            num_votes=models.F('num_votes'))
+        rollup = VoteRollup.objects.using(using).get(pk=rollup.pk)
+        counts = rollup.get_histogram()
+        for score, delta in itertools.chain(((i, 1) for i in added), 
+            ((i, -1) for i in removed)):
+            # scores are stored as floats
+            score = float(score)
+            counts[score] = counts.get(score, 0) + delta
+            rollup.num_votes += delta
+            rollup.total += score * delta
+        rollup.set_histogram(counts)
+        rollup.save(using=using)
+    return rollup
+
+def backfill_rollups(queryset=None, batch_size=1000, using=None):
+    """
+    Rebuild the rollups of the votes in *queryset* (default: all votes).
+    Existing rollups of the target objects and keys of those votes are 
+    deleted first, so *queryset* should include all the votes of each 
+    target object and key.
+    
+    Votes are streamed in batches of *batch_size*, and each batch is merged
+    in the rollups: memory usage does not depend on the number of votes.
+    Use the optional argument *using* to read votes and store rollups in
+    a database other than the default one.
+    
+    Rollups are rebuilt in a single transaction, so that they are never
+    seen partially deleted (see *in_transaction*).
+    
+    Return the number of processed votes.
+    """
+    rollup_db = using or router.db_for_write(VoteRollup)
+    with in_transaction(rollup_db):
+        # deleting existing rollups
+        rollups = VoteRollup.objects.using(using)
+        if queryset is None:
+            queryset = Vote.objects.using(using).all()
+            rollups.all()._raw_delete(rollup_db)
+        else:
+            targets = {}
+            for content_type_id, key, object_id in queryset.values_list(
+                'content_type', 'key', 'object_id').distinct().iterator():
+                targets.setdefault((content_type_id, key), []).append(
+                    object_id)
+            for (content_type_id, key), object_ids in targets.items():
+                for start in xrange(0, len(object_ids), batch_size):
+                    rollups.filter(content_type=content_type_id, key=key,
+                        object_id__in=object_ids[start:start + batch_size]
+                        )._raw_delete(rollup_db)
+        counter = last_id = 0
+        queryset = queryset.order_by('pk').values_list('id', 'content_type', 
+            'object_id', 'key', 'created_at', 'score')
+        while True:
+            rows = list(queryset.filter(pk__gt=last_id)[:batch_size])
+            if not rows:
+                return counter
+            groups = {}
+            for (vote_id, content_type_id, object_id, key, created_at, 
+                score) in rows:
+                groups.setdefault((content_type_id, object_id, key, 
+                    get_day(created_at)), []).append(score)
+            for (content_type_id, object_id, key, day), scores in (
+                groups.items()):
+                update_rollup((ContentType.objects.get_for_id(
+                    content_type_id), object_id), key, day, added=scores, 
+                    using=using)
+            counter += len(rows)
+            last_id = rows[-1][0]
+
+def get_rollups(instance_or_content, key, start=None, end=None, using=None):
+    """
+    Return the rollups of the target object *instance_or_content* for 
+    the given *key*, from day *start* to day *end* (both included and both
+    optional), ordered by day.
+    """
+    content_type, object_id = _get_content(instance_or_content)
+    rollups = VoteRollup.objects.using(using).filter(
+        content_type=content_type, object_id=object_id, key=key)
+    if start is not None:
+        rollups = rollups.filter(day__gte=start)
+    if end is not None:
+        rollups = rollups.filter(day__lte=end)
+    return rollups.order_by('day')
+    
+def get_daily_votes(instance_or_content, key, start=None, end=None, 
+    using=None):
+    """
+    Return a list of *(day, num_votes, average)* for each day with votes
+    given to *instance_or_content* using *key*, from day *start* to day 
+    *end*, e.g. to draw a trend chart.
+    """
+    rollups = get_rollups(instance_or_content, key, start, end, using)
+    values = rollups.values_list('day', 'num_votes', 'total')
+    return [(day, num_votes, float(total) / num_votes) 
+        for day, num_votes, total in values if num_votes]
+
+def get_period_score(instance_or_content, key, start=None, end=None, 
+    weight=0, using=None):
+    """
+    Return the score of *instance_or_content* for *key* considering only
+    the votes created from day *start* to day *end* (e.g. this month's 
+    rating), as a dict with keys *num_votes*, *total*, *average* 
+    and *histogram* (a *SortedDict* mapping scores with number of votes).
+    
+    Only rollups are read, so the cost does not depend on the number
+    of votes. The optional argument *weight* is used to calculate
+    the average score (see *Score.recalculate*).
+    """
+    counts = {}
+    for rollup in get_rollups(instance_or_content, key, start, end, using):
+        for score, num_votes in rollup.get_histogram().items():
+            counts[score] = counts.get(score, 0) + num_votes
+    histogram = SortedDict((k, counts[k]) for k in sorted(counts) 
+        if counts[k])
+    num_votes = sum(histogram.values())
+    total = sum(k * v for k, v in histogram.items())
+    return {
+        'num_votes': num_votes,
+        'total': total,
+        'average': float(total) / (num_votes + weight) if num_votes else 0,
+        'histogram': histogram,
+    }
+    
+
 # DELETING SCORES AND VOTES
 
-def delete_scores_for(instance_or_content):
+def delete_scores_for(instance_or_content, using=None):
     """
-    Delete all score objects related to *instance_or_content*, that can be 
-    a model instance or a sequence *(content_type, object_id)*.
+    Delete all score objects (and similarities) related to 
+    *instance_or_content*, that can be a model instance or a sequence 
+    *(content_type, object_id)*.
+    
+    Use the optional argument *using* to delete scores stored in 
+    a database other than the default one.
     """
     content_type, object_id = _get_content(instance_or_content)
-    Score.objects.filter(content_type=content_type, object_id=object_id).delete()
+    Score.objects.using(using).filter(content_type=content_type, 
+        object_id=object_id).delete()
+    Similarity.objects.using(using).filter(models.Q(object_id=object_id) | 
+        models.Q(neighbour_id=object_id), content_type=content_type).delete()
     
-def delete_votes_for(instance_or_content):
+def delete_votes_for(instance_or_content, using=None):
     """
     Delete all vote objects related to *instance_or_content*, that can be 
     a model instance or a sequence *(content_type, object_id)*.
+    
+    Use the optional argument *using* to delete votes stored in 
+    a database other than the default one.
     """
     content_type, object_id = _get_content(instance_or_content)
-    Vote.objects.filter(content_type=content_type, object_id=object_id).delete()
+    Vote.objects.using(using).filter(content_type=content_type, 
+        object_id=object_id).delete()
+    for model in (VoteAggregate, VoteRollup):
+        model.objects.using(using).filter(content_type=content_type, 
+            object_id=object_id).delete()
+
+def delete_ratings_for_queryset(queryset_or_model, chunk_size=500, 
+    vote_db=None, score_db=None):
+    """
+    Delete all comment, vote, score, similarity and leaderboard entry
+    objects related to the target objects in *queryset_or_model*, that can
+    be a queryset or a Django model object. Leaderboards are not rebuilt
+    (see *RatingHandler.deleting_target_queryset*).
+    
+    Ratings are deleted using set based DELETE queries, each one 
+    involving up to *chunk_size* target objects, and without loading 
+    votes and scores: this is much faster than calling *delete_scores_for*
+    and *delete_votes_for* for each target object.
+    
+    Comments and votes are deleted from the *vote_db* database and scores
+    from the *score_db* database: if not given, the databases are chosen
+    by the database routers. All the deletions run in one transaction 
+    for each database (see *in_transaction*).
+    
+    Note that ratings are not deleted in bulk when the target objects are 
+    deleted with a plain *queryset.delete()*: in that case Django sends
+    a *pre_delete* signal for each object, and the handler deletes its
+    ratings one object at a time. Use *RatingHandler.delete_queryset*
+    to delete the target objects together with their ratings in bulk.
+    """
+    vote_db = vote_db or router.db_for_write(Vote)
+    score_db = score_db or router.db_for_write(Score)
+    # getting the queryset
+    if isinstance(queryset_or_model, models.base.ModelBase):
+        queryset = queryset_or_model.objects.all()
+    else:
+        queryset = queryset_or_model
+    content_type = managers.get_content_type_for_model(queryset.model)
+    object_ids = list(queryset.values_list('pk', flat=True))
+    with in_transaction(vote_db, score_db):
+        for i in range(0, len(object_ids), chunk_size):
+            chunk = object_ids[i:i + chunk_size]
+            # comments are deleted first, since they can refer to votes
+            comments = Comment.objects.using(vote_db).filter(
+                models.Q(content_type=content_type, object_id__in=chunk) | 
+                models.Q(vote__content_type=content_type, 
+                    vote__object_id__in=chunk))
+            for lookups, using in (
+                (comments, vote_db), 
+                (Vote.objects.using(vote_db).filter(content_type=content_type,
+                    object_id__in=chunk), vote_db),
+                (VoteAggregate.objects.using(vote_db).filter(
+                    content_type=content_type, object_id__in=chunk), vote_db),
+                (VoteRollup.objects.using(vote_db).filter(
+                    content_type=content_type, object_id__in=chunk), vote_db),
+                (Score.objects.using(score_db).filter(
+                    content_type=content_type, object_id__in=chunk), score_db),
+                (Similarity.objects.using(score_db).filter(
+                    models.Q(object_id__in=chunk) | models.Q(
+                    neighbour_id__in=chunk), content_type=content_type), 
+                    score_db),
+                (LeaderboardEntry.objects.using(score_db).filter(
+                    content_type=content_type, object_id__in=chunk), 
+                    score_db)):
+                # raw deletes are safe: no model refers to ratings models
+                # with a foreign key (comments are deleted before votes),
+                # and no signal receiver relies on per-instance deletion
+                lookups._raw_delete(using)
 
 # IN BULK SELECT QUERIES
     
-def annotate_scores(queryset_or_model, key, **kwargs):
+def annotate_scores(queryset_or_model, key, using=None, **kwargs):
     """
     Annotate *queryset_or_model* with scores, in order to retreive from
     the database all score values in bulk.
@@ -273,7 +1099,8 @@ def annotate_scores(queryset_or_model, key, **kwargs):
     In *kwargs* it is possible to specify the values to retreive mapped 
     to field names (it is up to you to avoid name clashes).
     You can annotate the queryset with the number of votes (*num_votes*), 
-    the average score (*average*) and the total sum of all votes (*total*).
+    the average score (*average*), the total sum of all votes (*total*)
+    and the variance of votes (*variance*).
     
     For example, the following call::
     
@@ -290,6 +1117,17 @@ def annotate_scores(queryset_or_model, key, **kwargs):
             ).order_by('-staff_avg', '-staff_num_votes'):
             print 'staff num votes:', article.staff_num_votes
             print 'staff average:', article.staff_avg
+            
+    Sorting by variance shows the most controversial objects first::
+    
+        annotate_scores(Article, 'main', spread='variance'
+            ).order_by('-spread')
+    
+    The optional argument *using* is the database where scores are stored:
+    if it is not the database of the queryset, then the scores are fetched
+    in bulk and attached to instances while the queryset is evaluated
+    (see *managers.QuerysetWithAnnotations*). In that case it is not 
+    possible to sort the queryset by a score value.
     """
     # getting the queryset
     if isinstance(queryset_or_model, models.base.ModelBase):
@@ -298,11 +1136,15 @@ def annotate_scores(queryset_or_model, key, **kwargs):
         queryset = queryset_or_model
     # annotations are done only if fields are requested
     if kwargs:
+        content_type = managers.get_content_type_for_model(queryset.model)
+        if using is not None and using != queryset.db:
+            # scores live in another database: no subqueries
+            return managers.QuerysetWithAnnotations(queryset, Score,
+                {'content_type': content_type.pk, 'key': key}, kwargs, using)
         # preparing arguments for *extra* query
         select = SortedDict() # not really needed (see below)
         select_params = []
         opts = queryset.model._meta
-        content_type = managers.get_content_type_for_model(queryset.model)
         mapping = {
             'score_table': Score._meta.db_table,
             'model_table': opts.db_table,
@@ -327,7 +1169,7 @@ def annotate_scores(queryset_or_model, key, **kwargs):
         return queryset.extra(select=select, select_params=select_params)
     return queryset
     
-def annotate_votes(queryset_or_model, key, user, score='score'):
+def annotate_votes(queryset_or_model, key, user, score='score', using=None):
     """
     Annotate *queryset_or_model* with votes, in order to retreive from
     the database all vote values in bulk.
@@ -346,15 +1188,23 @@ def annotate_votes(queryset_or_model, key, user, score='score'):
         for article in annotate_votes(Article.objects.all(), 'main', myuser, 
             score='myscore'):
             print 'your vote:', article.myscore    
+    
+    As in *annotate_scores*, the optional argument *using* is the database 
+    where votes are stored.
     """
     # getting the queryset
     if isinstance(queryset_or_model, models.base.ModelBase):
         queryset = queryset_or_model.objects.all()
     else:
         queryset = queryset_or_model
+    content_type = managers.get_content_type_for_model(queryset.model)
+    if using is not None and using != queryset.db:
+        # votes live in another database: no subqueries
+        return managers.QuerysetWithAnnotations(queryset, Vote,
+            {'content_type': content_type.pk, 'key': key, 'user': user.pk}, 
+            {score: 'score'}, using)
     # preparing arguments for *extra* query
     opts = queryset.model._meta
-    content_type = managers.get_content_type_for_model(queryset.model)
     mapping = {
         'vote_table': Vote._meta.db_table,
         'model_table': opts.db_table,
@@ -0,0 +1,188 @@
+"""
+Item-to-item recommendations based on votes.
+
+The votes given by users to the objects of a content type for a given key
+form a sparse *objects x users* matrix of scores. The similarity between
+two objects is the cosine of the angle between their rows, optionally
+after subtracting from each score the average score of the user who gave
+the vote (*adjusted cosine*).
+
+For each object, only the most similar objects (the neighbours) are stored
+in the *Similarity* table: neighbours are computed, in chunks of objects,
+by the *build_similarities* management command, while recommendations are
+read from that precomputed table.
+
+Building similarities requires NumPy and SciPy, reading them does not.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router, transaction
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+from ratings import models
+
+METHODS = ('cosine', 'adjusted_cosine')
+
+def _check_dependencies():
+    if numpy is None or sparse is None:
+        raise ImproperlyConfigured('NumPy and SciPy are required to '
+            'build similarities.')
+
+def get_vote_matrix(content_type, key, batch_size=10000, using=None):
+    """
+    Return a sequence *(matrix, object_ids)* where *matrix* is the sparse
+    *objects x users* matrix of the scores given by users to the objects
+    of *content_type* using *key*, and *object_ids* is the array of
+    the object ids corresponding to the rows of the matrix.
+
+    Votes are streamed in batches of *batch_size*. Votes given by
+    anonymous users and compacted votes are ignored.
+    """
+    _check_dependencies()
+    queryset = models.Vote.objects.using(using).filter(
+        content_type=content_type, key=key, user__isnull=False).order_by(
+        'pk').values_list('id', 'object_id', 'user', 'score')
+    object_ids, user_ids, scores = [], [], []
+    last_id = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last_id)[:batch_size])
+        if not rows:
+            break
+        columns = zip(*rows)
+        object_ids.append(numpy.array(columns[1], dtype=numpy.int64))
+        user_ids.append(numpy.array(columns[2], dtype=numpy.int64))
+        scores.append(numpy.array(columns[3], dtype=numpy.float64))
+        last_id = rows[-1][0]
+    if not scores:
+        return sparse.csr_matrix((0, 0)), numpy.array([], dtype=numpy.int64)
+    object_ids, rows = numpy.unique(numpy.concatenate(object_ids),
+        return_inverse=True)
+    user_ids, columns = numpy.unique(numpy.concatenate(user_ids),
+        return_inverse=True)
+    matrix = sparse.csr_matrix((numpy.concatenate(scores), (rows, columns)),
+        shape=(len(object_ids), len(user_ids)))
+    return matrix, object_ids
+
+def get_neighbours(matrix, neighbours=20, method='cosine', chunk_size=100):
+    """
+    Given the sparse *objects x users* *matrix*, yield a sequence
+    *(row, neighbour_rows, similarities)* for each row, containing
+    the (up to *neighbours*) most similar rows, most similar first.
+    Only rows with a positive similarity are returned.
+
+    Similarities are computed multiplying chunks of *chunk_size* rows
+    by the whole matrix: each chunk needs a dense array of
+    *chunk_size x number of objects* floats.
+    """
+    _check_dependencies()
+    if method not in METHODS:
+        raise ValueError('Invalid similarity method: %r' % method)
+    matrix = sparse.csr_matrix(matrix, dtype=numpy.float64, copy=True)
+    num_objects, num_users = matrix.shape
+    size = min(neighbours, num_objects - 1)
+    if size < 1:
+        return
+    if method == 'adjusted_cosine':
+        # subtracting the average score of each user
+        counts = numpy.bincount(matrix.indices, minlength=num_users)
+        sums = numpy.bincount(matrix.indices, weights=matrix.data,
+            minlength=num_users)
+        matrix.data -= (sums / numpy.maximum(counts, 1))[matrix.indices]
+    # normalizing rows, so that dot products are cosines
+    norms = numpy.sqrt(numpy.bincount(
+        numpy.repeat(numpy.arange(num_objects), numpy.diff(matrix.indptr)),
+        weights=matrix.data ** 2, minlength=num_objects))
+    norms[norms == 0] = 1
+    matrix.data /= numpy.repeat(norms, numpy.diff(matrix.indptr))
+    transposed = matrix.T.tocsr()
+    for start in xrange(0, num_objects, chunk_size):
+        stop = min(start + chunk_size, num_objects)
+        rows = numpy.arange(stop - start)
+        block = (matrix[start:stop] * transposed).toarray()
+        # an object is not a neighbour of itself
+        block[rows, numpy.arange(start, stop)] = -numpy.inf
+        top = numpy.argpartition(-block, size - 1, axis=1)[:, :size]
+        values = block[rows[:, None], top]
+        order = numpy.argsort(-values, axis=1, kind='mergesort')
+        top, values = top[rows[:, None], order], values[rows[:, None], order]
+        for row in rows:
+            positive = values[row] > 0
+            yield start + row, top[row][positive], values[row][positive]
+
+def build_similarities(content_type, key, neighbours=20, method='cosine',
+    chunk_size=100, batch_size=10000, vote_db=None, score_db=None):
+    """
+    Compute and store the (up to *neighbours*) most similar objects of
+    each object of *content_type* voted using *key*, replacing existing
+    similarities. The similarity *method* can be 'cosine' or
+    'adjusted_cosine' (see *get_neighbours*).
+
+    Votes are read from *vote_db* in batches of *batch_size*, and
+    similarities are stored in *score_db*, in batches of *batch_size*.
+    Return the number of objects processed.
+    """
+    matrix, object_ids = get_vote_matrix(content_type, key,
+        batch_size=batch_size, using=vote_db)
+    using = score_db or router.db_for_write(models.Similarity)
+    manager = models.Similarity.objects.using(using)
+    with transaction.commit_on_success(using=using):
+        manager.filter(content_type=content_type, key=key)._raw_delete(using)
+        buffer = []
+        for row, columns, values in get_neighbours(matrix,
+            neighbours=neighbours, method=method, chunk_size=chunk_size):
+            object_id = int(object_ids[row])
+            buffer.extend(models.Similarity(content_type=content_type,
+                key=key, object_id=object_id, neighbour_id=int(
+                object_ids[column]), similarity=float(value))
+                for column, value in zip(columns, values))
+            if len(buffer) >= batch_size:
+                manager.bulk_create(buffer)
+                buffer = []
+        manager.bulk_create(buffer)
+    return len(object_ids)
+
+def get_similar(content_type, object_id, key, n=10, using=None):
+    """
+    Return the (up to *n*) objects of *content_type* most similar to
+    the object *object_id* for the given *key*, as a list of
+    *(object_id, similarity)*, most similar first.
+    """
+    similarities = models.Similarity.objects.using(using).filter(
+        content_type=content_type, key=key, object_id=object_id).order_by(
+        '-similarity', 'neighbour_id')
+    return list(similarities.values_list('neighbour_id', 'similarity')[:n])
+
+def get_recommendations_for(user, content_type, key, n=10, vote_db=None,
+    score_db=None, chunk_size=500):
+    """
+    Return the (up to *n*) objects of *content_type*, not yet voted by
+    *user*, that the user is expected to like most, as a list of
+    *(object_id, predicted score)*, highest scores first.
+
+    The score of each object is predicted as the average of the scores
+    given by *user* to its neighbours, weighted by similarity.
+    Votes are read from *vote_db* and similarities from *score_db*.
+    """
+    votes = dict(models.Vote.objects.using(vote_db).filter(
+        content_type=content_type, key=key, user=user).values_list(
+        'object_id', 'score'))
+    object_ids = votes.keys()
+    totals, weights = {}, {}
+    for i in range(0, len(object_ids), chunk_size):
+        similarities = models.Similarity.objects.using(score_db).filter(
+            content_type=content_type, key=key,
+            object_id__in=object_ids[i:i + chunk_size]).values_list(
+            'object_id', 'neighbour_id', 'similarity')
+        for object_id, neighbour_id, similarity in similarities:
+            if neighbour_id not in votes:
+                totals[neighbour_id] = totals.get(neighbour_id, 0) + (
+                    similarity * votes[object_id])
+                weights[neighbour_id] = weights.get(neighbour_id, 0) + (
+                    similarity)
+    predictions = [(totals[i] / weights[i], weights[i], i) for i in totals]
+    predictions.sort(key=lambda i: (-i[0], -i[1], i[2]))
+    return [(object_id, score) for score, _, object_id in predictions[:n]]
@@ -0,0 +1,112 @@
+"""
+Database routing for ratings models.
+
+To send ratings reads to replicas, add the router to the project's
+settings, together with the middleware used to pin the voter's reads
+to the write database after voting::
+
+    DATABASE_ROUTERS = ['ratings.routers.RatingsRouter']
+    MIDDLEWARE_CLASSES = (
+        ...
+        'ratings.middleware.ReadPinningMiddleware',
+    )
+    GENERIC_RATINGS_READ_DATABASES = ('replica1', 'replica2')
+    GENERIC_RATINGS_PIN_READS_AFTER_VOTE = 10
+"""
+from contextlib import contextmanager
+import random
+import threading
+
+from ratings import settings
+
+_local = threading.local()
+
+def pin():
+    """
+    Pin ratings reads of the current thread to the write database.
+    """
+    _local.pinned = True
+
+def unpin():
+    """
+    Release the pin set by *pin*.
+    """
+    _local.pinned = False
+
+def is_pinned():
+    """
+    Return True if ratings reads of the current thread are pinned
+    to the write database.
+    """
+    return getattr(_local, 'pinned', False)
+
+@contextmanager
+def pinned():
+    """
+    Context manager pinning ratings reads of the current thread to the
+    write database, restoring the previous state on exit, e.g.::
+
+        with pinned():
+            vote = Vote.objects.get(...)
+            vote.save()
+    """
+    previous = is_pinned()
+    pin()
+    try:
+        yield
+    finally:
+        _local.pinned = previous
+
+def reset():
+    """
+    Release the pin and forget the replica chosen for the current thread,
+    e.g. at the beginning and at the end of each request.
+    """
+    _local.pinned = False
+    _local.read_database = None
+
+def get_read_database():
+    """
+    Return the replica used to read ratings in the current thread.
+    The replica is randomly chosen at the first read and kept until
+    *reset* is called, so that all the reads of a request see the same
+    replica.
+    """
+    database = getattr(_local, 'read_database', None)
+    if database not in settings.READ_DATABASES:
+        database = _local.read_database = random.choice(
+            settings.READ_DATABASES)
+    return database
+
+
+class RatingsRouter(object):
+    """
+    Send ratings writes to the write database 
+    (*GENERIC_RATINGS_WRITE_DATABASE*) and reads to a random replica 
+    (*GENERIC_RATINGS_READ_DATABASES*), unless reads are pinned to the 
+    write database, e.g. while and just after the user votes.
+    The replica is chosen once per request (see *get_read_database*).
+    
+    Other models are left to the next routers.
+    """
+    app_label = 'ratings'
+
+    def _is_handled(self, model):
+        return model._meta.app_label == self.app_label
+
+    def db_for_read(self, model, **hints):
+        if self._is_handled(model):
+            if settings.READ_DATABASES and not is_pinned():
+                return get_read_database()
+            return settings.WRITE_DATABASE
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self._is_handled(model):
+            return settings.WRITE_DATABASE
+        return None
+
+    def allow_syncdb(self, db, model):
+        if self._is_handled(model):
+            return db == self.db_for_write(model)
+        return None
@@ -25,6 +25,11 @@ NEXT_QUERYSTRING_KEY = getattr(settings,
 VOTES_PER_IP_ADDRESS = getattr(settings, 
     'GENERIC_RATINGS_VOTES_PER_IP_ADDRESS', 0)
 
+# the sliding window (number of seconds) used by the cache backed
+# ip address limiter to count anonymous votes
+VOTES_PER_IP_ADDRESS_WINDOW = getattr(settings,
+    'GENERIC_RATINGS_VOTES_PER_IP_ADDRESS_WINDOW', 60 * 60 * 24) # one day
+
 # the pattern used to create a cookie name
 COOKIE_NAME_PATTERN = getattr(settings, 'GENERIC_RATINGS_COOKIE_NAME_PATTERN', 
     'grvote_%(model)s_%(object_id)s_%(key)s')
@@ -33,5 +38,56 @@ COOKIE_NAME_PATTERN = getattr(settings, 'GENERIC_RATINGS_COOKIE_NAME_PATTERN',
 COOKIE_MAX_AGE = getattr(settings, 'GENERIC_RATINGS_COOKIE_MAX_AGE', 
     60 * 60 * 24 * 365) # one year
 
+# set to True to identify anonymous voters using a single signed cookie
+# (containing a voter id) instead of a cookie for each voted object
+VOTER_COOKIE = getattr(settings, 'GENERIC_RATINGS_VOTER_COOKIE', False)
+
+# the name of the signed cookie containing the anonymous voter id
+VOTER_COOKIE_NAME = getattr(settings, 'GENERIC_RATINGS_VOTER_COOKIE_NAME',
+    'grvoter')
+
+# the database used by *ratings.routers.RatingsRouter* to write ratings
+WRITE_DATABASE = getattr(settings, 'GENERIC_RATINGS_WRITE_DATABASE', 'default')
+
+# a sequence of read replicas used by *ratings.routers.RatingsRouter*
+# to read ratings (if empty, reads go to the write database)
+READ_DATABASES = getattr(settings, 'GENERIC_RATINGS_READ_DATABASES', ())
+
+# the number of seconds a voter's reads are pinned to the write database
+# after voting (0 = reads are pinned only during the voting request)
+PIN_READS_AFTER_VOTE = getattr(settings, 
+    'GENERIC_RATINGS_PIN_READS_AFTER_VOTE', 0)
+
+# the name of the short-lived cookie used to pin reads after voting
+PIN_COOKIE_NAME = getattr(settings, 'GENERIC_RATINGS_PIN_COOKIE_NAME', 
+    'grpinned')
+
+# set to True to maintain daily rollups of votes
+DAILY_ROLLUPS = getattr(settings, 'GENERIC_RATINGS_DAILY_ROLLUPS', False)
+
+# the number of seconds fragments are cached by the *ratingcache* templatetag
+FRAGMENT_CACHE_TIMEOUT = getattr(settings, 
+    'GENERIC_RATINGS_FRAGMENT_CACHE_TIMEOUT', 60 * 60 * 24) # one day
+
+# the number of read-only star widgets (one for each displayed value) 
+# kept in memory by the *show_starrating* templatetag
+STARRATING_CACHE_SIZE = getattr(settings, 
+    'GENERIC_RATINGS_STARRATING_CACHE_SIZE', 256)
+
+# the maximum number of objects whose scores can be requested at once
+# to the *ratings_scores* view
+BULK_SCORES_MAX_IDS = getattr(settings, 
+    'GENERIC_RATINGS_BULK_SCORES_MAX_IDS', 100)
+
+# the minimum number of seconds between two live updates of the same
+# score sent by the *ratings_events* view
+LIVE_UPDATES_INTERVAL = getattr(settings, 
+    'GENERIC_RATINGS_LIVE_UPDATES_INTERVAL', 1)
+
+# the number of seconds during which repeated changes of the same vote
+# are coalesced (0 = every change is saved)
+VOTE_COALESCING_WINDOW = getattr(settings, 
+    'GENERIC_RATINGS_VOTE_COALESCING_WINDOW', 0)
+
 # maximum length for comments
 COMMENT_MAX_LENGTH = getattr(settings, 'GENERIC_COMMENT_MAX_LENGTH', 3000)
@@ -3,11 +3,32 @@ Signals relating to ratings.
 """
 from django.dispatch import Signal
 
+# the dispatch uid used by the ratings registry to connect its receivers
+REGISTRY_UID = 'ratings.registry'
+
+
+class VoteSignal(Signal):
+    """
+    A signal remembering if receivers other than the one connected by 
+    the ratings registry (see *REGISTRY_UID*) were ever connected, so that
+    the registry can skip dispatching when no one else is listening.
+    """
+    def __init__(self, providing_args=None):
+        super(VoteSignal, self).__init__(providing_args)
+        self.has_other_receivers = False
+
+    def connect(self, receiver, sender=None, weak=True, dispatch_uid=None):
+        if dispatch_uid != REGISTRY_UID:
+            self.has_other_receivers = True
+        super(VoteSignal, self).connect(receiver, sender=sender, weak=weak, 
+            dispatch_uid=dispatch_uid)
+
+
 # fired before a vote is saved
-vote_will_be_saved = Signal(providing_args=['vote', 'request'])
+vote_will_be_saved = VoteSignal(providing_args=['vote', 'request'])
 # fired after a vote is saved
-vote_was_saved = Signal(providing_args=['vote', 'request', 'created'])
+vote_was_saved = VoteSignal(providing_args=['vote', 'request', 'created'])
 # fired before a vote is deleted
-vote_will_be_deleted = Signal(providing_args=['vote', 'request'])
+vote_will_be_deleted = VoteSignal(providing_args=['vote', 'request'])
 # fired after a vote is deleted
-vote_was_deleted = Signal(providing_args=['vote', 'request'])
+vote_was_deleted = VoteSignal(providing_args=['vote', 'request'])
@@ -52,6 +52,45 @@
                 }
             });
         };
+        // filling cacheable forms with the user dependent data,
+        // using a single request for each hydration url
+        var hydrate_forms = {};
+        $('form.ratings[data-hydrate-url]').each(function() {
+            var form_object = $(this);
+            if (form_object.find('[name=timestamp]').val()) {
+                return;
+            };
+            var target = [
+                form_object.find('[name=content_type]').val(),
+                form_object.find('[name=object_pk]').val(),
+                form_object.find('[name=key]').val()
+            ].join(':');
+            var url = form_object.attr('data-hydrate-url');
+            hydrate_forms[url] = hydrate_forms[url] || {};
+            hydrate_forms[url][target] = hydrate_forms[url][target] || [];
+            hydrate_forms[url][target].push(form_object);
+        });
+        $.each(hydrate_forms, function(url, targets) {
+            $.ajax({
+                type: "GET",
+                url: url,
+                data: {target: $.map(targets, function(forms, target) {
+                    return target;
+                })},
+                traditional: true,
+                cache: false,
+                success: function(data) {
+                    $.each(data.forms, function(target, state) {
+                        $.each(targets[target] || [], function() {
+                            this.find('[name=timestamp]').val(state.timestamp);
+                            this.find('[name=security_hash]').val(
+                                state.security_hash);
+                            this.trigger('vote_hydrate', [state.score]);
+                        });
+                    });
+                }
+            });
+        });
         $('form.ratings').each(function() {
             var form_object = $(this);
             form_object.submit(function() {
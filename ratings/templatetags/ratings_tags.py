@@ -1,8 +1,19 @@
+import hashlib
+import math
 import re
+import threading
+from decimal import Decimal
 
 from django import template
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db.models import get_model
+from django.template.loader import render_to_string
+from django.utils.datastructures import SortedDict
+from django.utils.safestring import mark_safe
 
-from ratings import handlers
+from ratings import handlers, settings
+from ratings.forms import StarWidget
 
 register = template.Library()
 
@@ -38,6 +49,20 @@ def _parse(token):
     msg = '%r tag requires 4 or 6 arguments' % tokens[0]
     raise template.TemplateSyntaxError(msg)
 
+def _get_argument(value, default=None):
+    # a quoted string or a template variable (numbers are resolved by
+    # the variable), *default* if the argument is missing
+    if value is None:
+        return default
+    if value[0] in ('"', "'") and value[-1] == value[0]:
+        return value[1:-1]
+    return template.Variable(value)
+    
+def _resolve_argument(value, context):
+    if isinstance(value, template.Variable):
+        return value.resolve(context)
+    return value
+
 
 # FORM
 
@@ -224,7 +249,8 @@ def scores_annotate(parser, token):
         {% endfor %}
                 
     You can annotate a queryset with different score values at the same time, 
-    remembering that accepted values are 'average', 'total' and 'num_votes':
+    remembering that accepted values are 'average', 'total', 'num_votes' 
+    and 'variance':
     
     .. code-block:: html+django
     
@@ -739,9 +765,320 @@ class VotesAnnotateNode(template.Node):
         return u''
 
 
+STATS_ANNOTATE_PATTERN = r"""
+    ^ # begin of line
+    (?P<objects>\w+) # queryset or list of objects
+    \s+with\s+(?P<field>[\w'"]+) # field name
+    \s+using\s+(?P<key>[\w'"]+) # key
+    (\s+as\s+(?P<varname>\w+))? # varname
+    $ # end of line
+"""
+STATS_ANNOTATE_EXPRESSION = re.compile(STATS_ANNOTATE_PATTERN, re.VERBOSE)
+ 
+@register.tag
+def stats_annotate(parser, token):
+    """
+    Use this templatetag when you need to display the distribution of 
+    votes for each object in a list, e.g.:
+    
+    .. code-block:: html+django
+    
+        {% stats_annotate object_list with 'stats' using 'main' %}
+        {% for object in object_list %}
+            {% for score, stat in object.stats.items %}
+                {{ score }}: {{ stat.percent }}% ({{ stat.num_votes }})
+            {% endfor %}
+        {% endfor %}
+        
+    After this call each object has a *stats* attribute containing the 
+    statistics of its votes for the key 'main' (see 
+    *ratings.models.get_stats_for*), an empty dict if the object 
+    has no votes. The statistics of all the objects are retreived using
+    a single grouped query.
+    
+    The field name and the key can also be passed as template variables, 
+    without quotes. The objects can be a queryset or a list (e.g. the 
+    objects of a page): a queryset is evaluated, so you can also specify 
+    a new context variable for the resulting list, e.g.:
+    
+    .. code-block:: html+django
+    
+        {% stats_annotate queryset with 'stats' using 'main' as object_list %}
+        
+    If the objects' model is not handled, then this templatetag 
+    does nothing.
+    """
+    try:
+        tag_name, arg = token.contents.split(None, 1)
+    except ValueError:
+        error = u"%r tag requires arguments" % token.contents.split()[0]
+        raise template.TemplateSyntaxError, error
+    # args validation
+    match = STATS_ANNOTATE_EXPRESSION.match(arg)
+    if not match:
+        error = u"%r tag has invalid arguments" % tag_name
+        raise template.TemplateSyntaxError, error
+    # to the node
+    return StatsAnnotateNode(**match.groupdict())
+
+class StatsAnnotateNode(template.Node):
+    def __init__(self, objects, field, key, varname):
+        self.objects = template.Variable(objects)
+        self.field = _get_argument(field)
+        self.key = _get_argument(key)
+        self.varname = varname or objects
+        
+    def render(self, context):
+        objects = list(self.objects.resolve(context))
+        if objects:
+            handler = handlers.ratings.get_handler(type(objects[0]))
+            # if model is not handled the objects are not changed
+            if handler is not None:
+                field = _resolve_argument(self.field, context)
+                key = _resolve_argument(self.key, context)
+                # retreiving all the stats
+                content_type = ContentType.objects.get_for_model(handler.model)
+                stats = handler.get_stats_for_many(content_type, key, 
+                    object_ids=[i.pk for i in objects])
+                for instance in objects:
+                    setattr(instance, field, stats.get(instance.pk, {}))
+        context[self.varname] = objects
+        return u''
+
+
+GET_TOP_RATED_PATTERN = r"""
+    ^ # begin of line
+    (?P<model>\w+\.\w+) # app_label.model
+    (\s+using\s+(?P<key>[\w'"]+))? # key
+    (\s+by\s+(?P<metric>[\w'"]+))? # metric
+    (\s+limit\s+(?P<limit>\w+))? # limit
+    \s+as\s+(?P<varname>\w+) # varname
+    $ # end of line
+"""
+GET_TOP_RATED_EXPRESSION = re.compile(GET_TOP_RATED_PATTERN, re.VERBOSE)
+
+@register.tag
+def get_top_rated(parser, token):
+    """
+    Return the top rated objects of the given model, reading 
+    the leaderboard maintained by its handler 
+    (see *RatingHandler.leaderboard_metrics*), e.g.:
+    
+    .. code-block:: html+django
+    
+        {% get_top_rated blog.entry as top_entries %}
+        {% for entry in top_entries %}
+            {{ entry }}: {{ entry.leaderboard_value }}
+        {% endfor %}
+        
+    The key, the metric (defaulting to *settings.GENERIC_RATINGS_DEFAULT_KEY*
+    and 'average') and the number of objects can also be specified, 
+    as strings or template variables, e.g.:
+    
+    .. code-block:: html+django
+    
+        {% get_top_rated blog.entry using 'main' by 'num_votes' limit 5 as top_entries %}
+        
+    The leaderboard is usually read from the cache, and the objects are
+    retreived using a single query.
+    If the model is not handled, or no leaderboard is maintained for the
+    given metric, then the context variable is set to an empty list.
+    """
+    try:
+        tag_name, arg = token.contents.split(None, 1)
+    except ValueError:
+        error = u"%r tag requires arguments" % token.contents.split()[0]
+        raise template.TemplateSyntaxError, error
+    # args validation
+    match = GET_TOP_RATED_EXPRESSION.match(arg)
+    if not match:
+        error = u"%r tag has invalid arguments" % tag_name
+        raise template.TemplateSyntaxError, error
+    # to the node
+    return TopRatedNode(**match.groupdict())
+
+class TopRatedNode(template.Node):
+    def __init__(self, model, key, metric, limit, varname):
+        self.model = get_model(*model.split('.'))
+        if self.model is None:
+            error = u"%r is not a valid model" % model
+            raise template.TemplateSyntaxError, error
+        self.key = _get_argument(key, settings.DEFAULT_KEY)
+        self.metric = _get_argument(metric, 'average')
+        self.limit = _get_argument(limit)
+        self.varname = varname
+        
+    def render(self, context):
+        handler = handlers.ratings.get_handler(self.model)
+        objects = []
+        metric = _resolve_argument(self.metric, context)
+        # if model is not handled, or the leaderboard is not maintained,
+        # then the list of objects is empty
+        if handler is not None and metric in handler.leaderboard_metrics:
+            limit = _resolve_argument(self.limit, context)
+            objects = handler.get_top_rated(
+                _resolve_argument(self.key, context), metric, 
+                limit=None if limit is None else int(limit))
+        context[self.varname] = objects
+        return u''
+
+
+# FRAGMENT CACHING
+
+VERSIONS_ANNOTATE_PATTERN = r"""
+    ^ # begin of line
+    (?P<objects>\w+) # queryset or list of objects
+    \s+using\s+(?P<key>[\w'"]+) # key
+    (\s+as\s+(?P<varname>\w+))? # varname
+    $ # end of line
+"""
+VERSIONS_ANNOTATE_EXPRESSION = re.compile(VERSIONS_ANNOTATE_PATTERN, 
+    re.VERBOSE)
+
+@register.tag
+def versions_annotate(parser, token):
+    """
+    Use this templatetag before caching rating fragments of many objects
+    (see *ratingcache*), in order to retreive the versions of their 
+    scores using a single query, e.g.:
+    
+    .. code-block:: html+django
+    
+        {% versions_annotate object_list using 'main' %}
+        {% for object in object_list %}
+            {% ratingcache score_widget object 'main' %}...{% endratingcache %}
+        {% endfor %}
+        
+    The key can also be passed as a template variable, without quotes. 
+    A queryset is evaluated, so you can also specify a new context variable
+    for the resulting list, e.g.:
+    
+    .. code-block:: html+django
+    
+        {% versions_annotate queryset using 'main' as object_list %}
+        
+    If the objects' model is not handled, then this templatetag 
+    does nothing.
+    """
+    try:
+        tag_name, arg = token.contents.split(None, 1)
+    except ValueError:
+        error = u"%r tag requires arguments" % token.contents.split()[0]
+        raise template.TemplateSyntaxError, error
+    # args validation
+    match = VERSIONS_ANNOTATE_EXPRESSION.match(arg)
+    if not match:
+        error = u"%r tag has invalid arguments" % tag_name
+        raise template.TemplateSyntaxError, error
+    # to the node
+    return VersionsAnnotateNode(**match.groupdict())
+
+class VersionsAnnotateNode(template.Node):
+    def __init__(self, objects, key, varname):
+        self.objects = template.Variable(objects)
+        self.key = _get_argument(key)
+        self.varname = varname or objects
+        
+    def render(self, context):
+        objects = list(self.objects.resolve(context))
+        if objects:
+            handler = handlers.ratings.get_handler(type(objects[0]))
+            # if model is not handled the objects are not changed
+            if handler is not None:
+                key = _resolve_argument(self.key, context)
+                versions = handler.get_versions(objects, key)
+                for instance in objects:
+                    _get_versions(instance)[key] = versions[instance.pk]
+        context[self.varname] = objects
+        return u''
+
+
+@register.tag
+def ratingcache(parser, token):
+    """
+    Cache the enclosed template fragment until the score of the given
+    target object changes, e.g.:
+    
+    .. code-block:: html+django
+    
+        {% ratingcache score_widget object 'main' %}
+            {% get_rating_score for object using 'main' as score %}
+            {% show_starrating score %} ({{ score.num_votes }} votes)
+        {% endratingcache %}
+        
+    The first argument is the name of the fragment, as in Django's *cache*
+    templatetag: fragments having the same name share their cache entries.
+    The cache key also includes the version of the score of the target object
+    for the given key (see *RatingHandler.get_versions*): the version 
+    changes each time a vote is added, changed or deleted, and when the 
+    score is created again, so the fragment is rendered again only when
+    the score changes. 
+    Fragments are cached for *GENERIC_RATINGS_FRAGMENT_CACHE_TIMEOUT* 
+    seconds.
+    
+    The key can also be passed as a template variable, without quotes.
+    Additional arguments are template variables the fragment depends on,
+    as in Django's *cache* templatetag, e.g.:
+    
+    .. code-block:: html+django
+    
+        {% ratingcache score_widget object 'main' request.user.pk %}...{% endratingcache %}
+        
+    Getting the version costs a query for each fragment: use the 
+    *versions_annotate* templatetag to retreive the versions of a list
+    of objects in bulk.
+    
+    If the target object's model is not handled, then the fragment is 
+    not cached.
+    """
+    bits = token.split_contents()
+    if len(bits) < 4:
+        error = u"%r tag requires at least 3 arguments" % bits[0]
+        raise template.TemplateSyntaxError, error
+    nodelist = parser.parse(('endratingcache',))
+    parser.delete_first_token()
+    return RatingCacheNode(nodelist, bits[1], bits[2], bits[3], bits[4:])
+
+class RatingCacheNode(template.Node):
+    def __init__(self, nodelist, fragment, target_object, key, vary_on):
+        self.nodelist = nodelist
+        self.fragment = fragment
+        self.target_object = template.Variable(target_object)
+        self.key = _get_argument(key)
+        self.vary_on = [template.Variable(i) for i in vary_on]
+        
+    def render(self, context):
+        target_object = self.target_object.resolve(context)
+        handler = handlers.ratings.get_handler(type(target_object))
+        if handler is None:
+            return self.nodelist.render(context)
+        key = _resolve_argument(self.key, context)
+        versions = _get_versions(target_object)
+        if key not in versions:
+            versions[key] = handler.get_versions([target_object], 
+                key)[target_object.pk]
+        vary_on = u':'.join([key] + [unicode(i.resolve(context)) 
+            for i in self.vary_on])
+        content_type = ContentType.objects.get_for_model(handler.model)
+        cache_key = u'ratings:fragment:%s:%s:%s:%s:%s' % (self.fragment, 
+            content_type.pk, target_object.pk, 
+            hashlib.md5(vary_on.encode('utf-8')).hexdigest(), versions[key])
+        value = cache.get(cache_key)
+        if value is None:
+            value = self.nodelist.render(context)
+            cache.set(cache_key, value, settings.FRAGMENT_CACHE_TIMEOUT)
+        return value
+
+def _get_versions(instance):
+    # the score versions retreived for *instance*, by key
+    if not hasattr(instance, '_ratings_versions'):
+        instance._ratings_versions = {}
+    return instance._ratings_versions
+
+
 # STARRATING
 
-@register.inclusion_tag("ratings/star_widget.html")
+@register.simple_tag
 def show_starrating(score_or_vote, stars=None, split=None):
     """
     Show the starrating widget in read-only mode for the given *score_or_vote*.
@@ -763,26 +1100,67 @@ def show_starrating(score_or_vote, stars=None, split=None):
     Normally the handler is used to get the number of stars and the how each 
     one must be splitted, but you can override using *stars* and *split*
     arguments.
+    
+    The widget does not hit the database, and the markup of the widget is 
+    rendered once for each displayed value and kept in memory (see 
+    *GENERIC_RATINGS_STARRATING_CACHE_SIZE*), so that displaying a long list 
+    of votes is cheap.
     """
-    model = score_or_vote.content_type.model_class()
-    handler = handlers.ratings.get_handler(model)
+    content_type = ContentType.objects.get_for_id(score_or_vote.content_type_id)
+    handler = handlers.ratings.get_handler(content_type.model_class())
     if handler:
         # getting *max_value* and *step*
         max_value = stars or handler.score_range[1]
         if split:
-            from decimal import Decimal
             step = Decimal(1) / split
         else:
             step =  handler.score_step
-        # using starrating widget displaying it in read-only mode
-        from ratings.forms import StarWidget
-        widget = StarWidget(1, max_value, step, score_or_vote.content_object,
-            can_delete_vote=handler.can_delete_vote, read_only=True)
         # duck taking the score value
         try:
             value = score_or_vote.average
         except AttributeError:
             value = score_or_vote.score
-        # the widget has a *get_context* method: how lucky we are!
-        return widget.get_context(u'score', value, {'id': u'id_score'})
-    return {}
+        markup = _render_starrating(max_value, step, handler.can_delete_vote,
+            value)
+        # the same id the widget would build using the target object
+        star_id = u'star-score-%s_%s-%s' % (content_type.app_label, 
+            content_type.model, score_or_vote.object_id)
+        return mark_safe(markup.replace(STAR_ID_PLACEHOLDER, star_id))
+    return u''
+
+STAR_ID_PLACEHOLDER = u'__star_id__'
+
+_starrating_cache = SortedDict()
+_starrating_lock = threading.Lock()
+
+def _render_starrating(max_value, step, can_delete_vote, value):
+    """
+    Return the markup of the read-only star widget (see *show_starrating*),
+    using *STAR_ID_PLACEHOLDER* as the widget id.
+    
+    Rendered widgets are kept in a bounded LRU cache, since only a few
+    distinct values are usually displayed. The widget is rendered using
+    the value rounded down to the *step*, which selects the same stars:
+    this way the cache is keyed by a few values, and the markup is the
+    same for all the values sharing a key.
+    """
+    split = int(1 / step)
+    if value is not None:
+        value = math.floor(value * split) / split
+    key = (max_value, step, can_delete_vote, value)
+    with _starrating_lock:
+        markup = _starrating_cache.pop(key, None)
+        if markup is not None:
+            _starrating_cache[key] = markup
+            return markup
+    widget = StarWidget(1, max_value, step, can_delete_vote=can_delete_vote, 
+        read_only=True)
+    # the widget has a *get_context* method: how lucky we are!
+    context = widget.get_context(u'score', value, {'id': u'id_score'})
+    context['star_id'] = STAR_ID_PLACEHOLDER
+    markup = render_to_string(widget.template, context)
+    with _starrating_lock:
+        _starrating_cache[key] = markup
+        while len(_starrating_cache) > settings.STARRATING_CACHE_SIZE:
+            del _starrating_cache[_starrating_cache.keyOrder[0]]
+    return markup
@@ -1,3 +1,1827 @@
+import csv
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import connection, connections, router, transaction
+from django.db.models.query import QuerySet
+from django.db.models.signals import pre_delete as pre_delete_signal
+from django.template import Context, Template, TemplateSyntaxError
+from django.template.loader import render_to_string
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.client import RequestFactory
+from django.utils import unittest
+from django.utils import simplejson as json
+from django.utils.crypto import salted_hmac
+
+from ratings import cookies, events, exports, forms, handlers, leaderboards
+from ratings import limiters, models, recommend, routers, settings, signals
+from ratings import views
+from ratings.middleware import ReadPinningMiddleware
+from ratings.templatetags import ratings_tags
+
 __test__ = {"doctest": """
 
 """}
+
+class VotingMixin(object):
+    """
+    Vote as *user* for *target*, through the handler of the test case.
+    """
+    def _vote(self, user, target, score, **kwargs):
+        vote = None
+        if user is not None:
+            vote = models.Vote.objects.db_manager(self.handler.vote_db
+                ).get_for(target, 'main', user=user)
+        if vote is None:
+            vote = models.Vote(key='main', user=user, 
+                content_type=ContentType.objects.get_for_model(User), 
+                object_id=target.pk, **kwargs)
+        vote.score = score
+        self.handler.vote(RequestFactory().post('/'), vote)
+        return vote
+
+
+class SecurityHashTest(SimpleTestCase):
+    """
+    Check that the security hash of vote forms matches *salted_hmac*,
+    and that the HMAC key setup is done once for each salt (timings are
+    measured by tests/benchmarks.py).
+    """
+    key_salt = 'ratings.forms.VoteForm'
+    values = ['ratings.vote-%d-main-1300000000' % i for i in range(100)]
+
+    def setUp(self):
+        forms._hmac_cache.clear()
+
+    def test_same_hash(self):
+        for value in self.values:
+            self.assertEqual(
+                forms.security_hmac(self.key_salt, value).hexdigest(),
+                salted_hmac(self.key_salt, value).hexdigest())
+
+    def test_cached_key(self):
+        macs = [forms.security_hmac(self.key_salt, value) 
+            for value in self.values[:2]]
+        self.assertEqual(len(forms._hmac_cache), 1)
+        base = forms._hmac_cache.values()[0]
+        # each hash is computed on a copy of the cached HMAC object,
+        # which is left untouched
+        self.assertFalse(base in macs)
+        self.assertEqual(base.hexdigest(), 
+            salted_hmac(self.key_salt, '').hexdigest())
+        forms.security_hmac(self.key_salt, self.values[2])
+        self.assertTrue(forms._hmac_cache.values()[0] is base)
+        # changing the secret key changes the key
+        with self.settings(SECRET_KEY='changed'):
+            self.assertEqual(
+                forms.security_hmac(self.key_salt, self.values[0]).hexdigest(),
+                salted_hmac(self.key_salt, self.values[0]).hexdigest())
+        self.assertEqual(len(forms._hmac_cache), 2)
+
+
+class VoterCookieTest(SimpleTestCase):
+    """
+    Check the signed voter cookie used to identify anonymous voters.
+    """
+    def _get_request(self, value=None):
+        request = RequestFactory().get('/')
+        if value is not None:
+            request.COOKIES[settings.VOTER_COOKIE_NAME] = value
+        return request
+
+    def test_round_trip(self):
+        voter_id = cookies.new_voter_id()
+        value = cookies.get_voter_value(voter_id)
+        self.assertNotEqual(value, voter_id)
+        self.assertEqual(cookies.load_voter_id(
+            {settings.VOTER_COOKIE_NAME: value}), voter_id)
+        request = self._get_request(value)
+        self.assertEqual(cookies.get_voter_id(request), voter_id)
+        self.assertEqual(cookies.get_voter_id(request, create=True), voter_id)
+        self.assertFalse(cookies.voter_id_created(request))
+
+    def test_tampered(self):
+        value = cookies.get_voter_value(cookies.new_voter_id())
+        # changed signature, changed voter id, unsigned value
+        signature = 'A' if value[-1] != 'A' else 'B'
+        for tampered in (value[:-1] + signature, 
+            cookies.new_voter_id() + value[value.index(':'):], 'garbage'):
+            self.assertEqual(cookies.load_voter_id(
+                {settings.VOTER_COOKIE_NAME: tampered}), None)
+            self.assertEqual(cookies.get_voter_id(
+                self._get_request(tampered)), None)
+        # a new voter id replaces the invalid one
+        request = self._get_request('garbage')
+        voter_id = cookies.get_voter_id(request, create=True)
+        self.assertTrue(voter_id)
+        self.assertTrue(cookies.voter_id_created(request))
+        self.assertEqual(cookies.get_voter_id(request), voter_id)
+        self.assertEqual(cookies.get_voter_id(self._get_request()), None)
+
+
+class VoterCookieViewTest(TestCase):
+    """
+    Check that anonymous voters are identified by the voter cookie set
+    by the vote view.
+    """
+    def setUp(self):
+        handlers.ratings.register(User, allow_anonymous=True, 
+            voter_cookie=True)
+        self.handler = handlers.ratings.get_handler(User)
+        self.target = User.objects.create(username='target')
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def _post_vote(self, score, cookies):
+        request = RequestFactory().post('/')
+        request.user = AnonymousUser()
+        kwargs = self.handler.get_vote_form_kwargs(request, self.target, 
+            'main')
+        data = self.handler.get_vote_form_class(request)(self.target, 
+            'main', **kwargs).initial
+        data['score'] = score
+        request = RequestFactory().post(reverse('ratings_vote'), data)
+        request.user = AnonymousUser()
+        request.COOKIES.update(cookies)
+        return views.vote(request)
+
+    def test_vote_twice(self):
+        response = self._post_vote(2, {})
+        self.assertEqual(response.status_code, 302)
+        cookie = response.cookies[settings.VOTER_COOKIE_NAME].value
+        vote = models.Vote.objects.get()
+        self.assertEqual(cookies.load_voter_id(
+            {settings.VOTER_COOKIE_NAME: cookie}), vote.cookie)
+        # the second vote changes the first one, without a new cookie
+        response = self._post_vote(4, {settings.VOTER_COOKIE_NAME: cookie})
+        self.assertEqual(response.status_code, 302)
+        self.assertNotIn(settings.VOTER_COOKIE_NAME, response.cookies)
+        self.assertEqual(list(models.Vote.objects.values_list('id', 
+            'score')), [(vote.pk, 4)])
+        self.assertEqual(self.handler.get_score(self.target, 'main'
+            ).num_votes, 1)
+
+
+class SignalDispatchTest(TestCase):
+    """
+    Check vote signals dispatching, with and without third party receivers.
+    """
+    def setUp(self):
+        handlers.ratings.register(User)
+        self.handler = handlers.ratings.get_handler(User)
+        self.user = User.objects.create(username='voter')
+        self.request = RequestFactory().post('/')
+        self.request.user = self.user
+        self.vote = models.Vote(key='main', score=3, user=self.user,
+            content_type=ContentType.objects.get_for_model(User), 
+            object_id=self.user.pk)
+        self.has_other = signals.vote_will_be_saved.has_other_receivers
+        signals.vote_will_be_saved.has_other_receivers = False
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        signals.vote_will_be_saved.has_other_receivers = self.has_other
+
+    def _send(self):
+        # recording the calls to the handler hook and to the signal
+        calls = []
+        self.handler.pre_vote = lambda request, vote: calls.append('hook')
+        send = signals.vote_will_be_saved.send
+        def recorder(*args, **kwargs):
+            calls.append('send')
+            return send(*args, **kwargs)
+        signals.vote_will_be_saved.send = recorder
+        try:
+            responses = handlers.ratings.send_signal(
+                signals.vote_will_be_saved, self.handler, self.vote, 
+                self.request)
+        finally:
+            del signals.vote_will_be_saved.send
+            del self.handler.pre_vote
+        return responses, calls
+
+    def test_fast_path(self):
+        self.assertTrue(handlers.ratings.has_only_own_receiver(
+            signals.vote_will_be_saved, models.Vote))
+        responses, calls = self._send()
+        # the hook is called directly, without dispatching the signal
+        self.assertEqual(calls, ['hook'])
+        self.assertEqual(responses, [(handlers.ratings.pre_vote, None)])
+
+    def test_other_receivers(self):
+        received = []
+        def receiver(sender, vote, request, **kwargs):
+            received.append(vote)
+            return False
+        signals.vote_will_be_saved.connect(receiver, sender=models.Vote)
+        try:
+            self.assertFalse(handlers.ratings.has_only_own_receiver(
+                signals.vote_will_be_saved, models.Vote))
+            responses, calls = self._send()
+        finally:
+            signals.vote_will_be_saved.disconnect(receiver, sender=models.Vote)
+        # the signal is dispatched to both receivers
+        self.assertEqual(calls, ['send', 'hook'])
+        self.assertEqual(received, [self.vote])
+        self.assertEqual(responses, [
+            (handlers.ratings.pre_vote, None), (receiver, False)])
+        # receivers of other senders are not called
+        signals.vote_will_be_saved.connect(receiver, sender=User)
+        try:
+            responses, calls = self._send()
+        finally:
+            signals.vote_will_be_saved.disconnect(receiver, sender=User)
+        self.assertEqual(received, [self.vote])
+        self.assertEqual(responses, [(handlers.ratings.pre_vote, None)])
+
+
+class VerticalPartitioningTest(TestCase):
+    """
+    Vote using a handler storing votes and scores in different databases,
+    both different from the one of the target objects.
+    """
+    multi_db = True
+
+    def setUp(self):
+        handlers.ratings.register(User, vote_db='votes', score_db='scores')
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='voter%d' % i) 
+            for i in range(3)]
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def _vote(self, user, target, score):
+        request = RequestFactory().post('/')
+        request.user = user
+        form_class = self.handler.get_vote_form_class(request)
+        kwargs = self.handler.get_vote_form_kwargs(request, target, 'main')
+        data = form_class(target, 'main', **kwargs).initial
+        data['score'] = score
+        form = form_class(target, 'main', data=data, **kwargs)
+        self.assertTrue(form.is_valid(), form.errors)
+        vote = form.get_vote(request, self.handler.allow_anonymous)
+        return self.handler.vote(request, vote)
+
+    def test_vote(self):
+        target = self.users[0]
+        self.assertTrue(self._vote(self.users[1], target, 2))
+        self.assertTrue(self._vote(self.users[2], target, 5))
+        # changing a vote
+        self.assertFalse(self._vote(self.users[2], target, 4))
+        self.assertEqual(models.Vote.objects.using('votes').count(), 2)
+        self.assertFalse(models.Vote.objects.using('default').exists())
+        self.assertFalse(models.Score.objects.using('default').exists())
+        score = self.handler.get_score(target, 'main')
+        self.assertEqual((score.num_votes, score.total, score.average), 
+            (2, 6, 3))
+        self.assertTrue(self.handler.has_voted(target, 'main', self.users[1]))
+        self.assertEqual(self.handler.get_vote(target, 'main', 
+            self.users[2]).score, 4)
+
+    def test_annotate(self):
+        self._vote(self.users[1], self.users[0], 2)
+        self._vote(self.users[1], self.users[2], 5)
+        queryset = self.handler.annotate_scores(User.objects.order_by('pk'),
+            'main', average='average', num_votes='num_votes')
+        self.assertEqual([(i.average, i.num_votes) for i in queryset],
+            [(2, 1), (None, None), (5, 1)])
+        self.assertEqual(queryset[2].average, 5)
+        queryset = self.handler.annotate_votes(User.objects.order_by('pk'),
+            'main', self.users[1], score='myscore')
+        self.assertEqual([i.myscore for i in queryset[1:]], [None, 5])
+        # methods not returning querysets return the real results
+        self.assertEqual(queryset.get(pk=self.users[2].pk).myscore, 5)
+        self.assertEqual(queryset.filter(pk=self.users[2].pk).get().myscore,
+            5)
+        self.assertEqual(list(queryset.values_list('username', flat=True)),
+            ['voter0', 'voter1', 'voter2'])
+        self.assertEqual(queryset.count(), 3)
+
+    def test_ajax_response(self):
+        target = self.users[0]
+        self._vote(self.users[1], target, 2)
+        vote = self.handler.get_vote(target, 'main', self.users[1])
+        request = RequestFactory().post('/', 
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        response = self.handler.ajax_response(request, vote, True, False)
+        data = json.loads(response.content)
+        self.assertEqual((data['score_average'], data['score_num_votes']), 
+            (2, 1))
+
+    def test_delete_queryset(self):
+        self._vote(self.users[1], self.users[0], 2)
+        self._vote(self.users[0], self.users[2], 5)
+        self.handler.delete_queryset(User.objects.filter(
+            pk__in=[self.users[0].pk, self.users[1].pk]))
+        self.assertEqual(models.Vote.objects.using('votes').get().object_id,
+            self.users[2].pk)
+        self.assertEqual(models.Score.objects.using('scores').get().object_id,
+            self.users[2].pk)
+
+
+class RoutingTest(TestCase):
+    """
+    Route ratings reads to a replica (*scores*, left empty as a lagging
+    replica would be) and writes to the *default* database, and check 
+    that votes always see the write database.
+    """
+    multi_db = True
+
+    def setUp(self):
+        self.routers = router.routers
+        router.routers = [routers.RatingsRouter()]
+        self.databases = settings.WRITE_DATABASE, settings.READ_DATABASES
+        settings.WRITE_DATABASE = 'default'
+        settings.READ_DATABASES = ('scores',)
+        routers.reset()
+        handlers.ratings.register(User)
+        self.handler = handlers.ratings.get_handler(User)
+        self.voter, self.target = [User.objects.create(username='user%d' % i)
+            for i in range(2)]
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        routers.reset()
+        settings.WRITE_DATABASE, settings.READ_DATABASES = self.databases
+        router.routers = self.routers
+
+    def _post_vote(self, score):
+        request = RequestFactory().post('/')
+        request.user = self.voter
+        kwargs = self.handler.get_vote_form_kwargs(request, self.target, 
+            'main')
+        data = self.handler.get_vote_form_class(request)(self.target, 
+            'main', **kwargs).initial
+        data['score'] = score
+        request = RequestFactory().post(reverse('ratings_vote'), data)
+        request.user = self.voter
+        return views.vote(request)
+
+    def test_router(self):
+        self.assertEqual(router.db_for_write(models.Vote), 'default')
+        self.assertEqual(router.db_for_read(models.Vote), 'scores')
+        self.assertEqual(router.db_for_read(User), 'default')
+        with routers.pinned():
+            self.assertEqual(router.db_for_read(models.Vote), 'default')
+            with routers.pinned():
+                pass
+            # nested pins keep the outer one
+            self.assertTrue(routers.is_pinned())
+        self.assertFalse(routers.is_pinned())
+        # the replica is chosen once per request
+        settings.READ_DATABASES = ('scores', 'votes')
+        routers.reset()
+        databases = set(router.db_for_read(models.Vote) for i in range(20))
+        self.assertEqual(len(databases), 1)
+
+    def test_middleware(self):
+        middleware = ReadPinningMiddleware()
+        routers.pin()
+        request = RequestFactory().get('/')
+        # a pin left by code running outside requests is released
+        middleware.process_request(request)
+        self.assertFalse(routers.is_pinned())
+        request.COOKIES[settings.PIN_COOKIE_NAME] = '1'
+        middleware.process_request(request)
+        self.assertTrue(routers.is_pinned())
+        middleware.process_response(request, None)
+        self.assertFalse(routers.is_pinned())
+
+    def test_vote(self):
+        self.assertEqual(self._post_vote(2).status_code, 302)
+        # the existing vote is found in the write database, not duplicated
+        self.assertEqual(self._post_vote(4).status_code, 302)
+        self.assertEqual(models.Vote.objects.using('default').get().score, 4)
+        self.assertEqual(models.Score.objects.using('default').get(
+            ).num_votes, 1)
+        self.assertFalse(models.Vote.objects.using('scores').exists())
+        # the pin does not leak after the request
+        self.assertFalse(routers.is_pinned())
+        self.handler.delete(RequestFactory().post('/'), 
+            models.Vote.objects.using('default').get())
+        self.assertFalse(routers.is_pinned())
+
+
+class DeleteQuerysetTest(TransactionTestCase):
+    """
+    Delete many target objects together with their ratings.
+    """
+    def setUp(self):
+        handlers.ratings.register(User)
+        self.handler = handlers.ratings.get_handler(User)
+        self.voter = User.objects.create(username='voter')
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(6)]
+        request = RequestFactory().post('/')
+        content_type = ContentType.objects.get_for_model(User)
+        for target in self.users:
+            self.handler.vote(request, models.Vote(key='main', 
+                user=self.voter, score=3, content_type=content_type, 
+                object_id=target.pk))
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def _raise(self, **kwargs):
+        raise ValueError
+
+    def test_delete_queryset(self):
+        object_ids = [i.pk for i in self.users[:5]]
+        self.handler.delete_queryset(User.objects.filter(pk__in=object_ids))
+        self.assertEqual(User.objects.count(), 2)
+        for model in (models.Vote, models.Score):
+            self.assertEqual(list(model.objects.values_list('object_id', 
+                flat=True)), [self.users[5].pk])
+
+    def test_rollback(self):
+        # the ratings are kept if the target objects cannot be deleted
+        pre_delete_signal.connect(self._raise, sender=User)
+        try:
+            self.assertRaises(ValueError, self.handler.delete_queryset, 
+                User.objects.exclude(pk=self.voter.pk))
+        finally:
+            pre_delete_signal.disconnect(self._raise, sender=User)
+        self.assertEqual(User.objects.count(), 7)
+        self.assertEqual(models.Vote.objects.count(), 6)
+        self.assertEqual(models.Score.objects.count(), 6)
+
+
+class CompactionTest(VotingMixin, TestCase):
+    """
+    Fold old votes in aggregates, using the handler's vote database.
+    """
+    multi_db = True
+
+    def setUp(self):
+        handlers.ratings.register(User, vote_db='votes', score_db='scores')
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='voter%d' % i) 
+            for i in range(4)]
+        self.content_type = ContentType.objects.get_for_model(User)
+        self.request = RequestFactory().post('/')
+        first, second = self.users[:2]
+        for user, target, score in ((self.users[1], first, 2), 
+            (self.users[2], first, 4), (self.users[3], first, 4),
+            (self.users[1], second, 5), (None, first, 3)):
+            self._vote(user, target, score, ip_address='127.0.0.1',
+                cookie=None if user else 'anonymous')
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def _get_score(self, target):
+        score = self.handler.get_score(target, 'main')
+        return score.num_votes, score.total, score.average
+
+    def test_compact(self):
+        first, second = self.users[:2]
+        scores = [self._get_score(first), self._get_score(second)]
+        before = datetime.datetime.now() + datetime.timedelta(days=1)
+        self.assertEqual(models.compact_votes(before, using='votes'), 4)
+        # anonymous votes are not compacted
+        self.assertEqual(models.Vote.objects.using('votes').get().cookie,
+            'anonymous')
+        self.assertFalse(models.VoteAggregate.objects.exists())
+        aggregates = models.VoteAggregate.objects.using('votes').filter(
+            object_id=first.pk).order_by('score')
+        self.assertEqual([(i.score, i.num_votes, i.get_voters()) 
+            for i in aggregates], [(2, 1, [self.users[1].pk]), 
+            (4, 2, [self.users[2].pk, self.users[3].pk])])
+        # scores do not change
+        for target in (first, second):
+            models.upsert_score(target, 'main', vote_db='votes', 
+                score_db='scores')
+        self.assertEqual([self._get_score(first), self._get_score(second)],
+            scores)
+        self.assertTrue(self.handler.has_voted(first, 'main', self.users[2]))
+        self.assertEqual(models.compact_votes(before, using='votes'), 0)
+
+    def test_release(self):
+        first = self.users[0]
+        before = datetime.datetime.now() + datetime.timedelta(days=1)
+        models.compact_votes(before, using='votes')
+        # a new vote replaces the compacted one
+        self._vote(self.users[2], first, 1)
+        self.assertEqual(self._get_score(first), (4, 10, 2.5))
+        aggregate = models.VoteAggregate.objects.using('votes').get(
+            object_id=first.pk, score=4)
+        self.assertEqual((aggregate.num_votes, aggregate.get_voters()),
+            (1, [self.users[3].pk]))
+        self.assertFalse(models.release_compacted_vote(first, 'main', 
+            self.users[2], using='votes'))
+        self.assertTrue(models.release_compacted_vote(first, 'main', 
+            self.users[1], using='votes'))
+        self.assertFalse(models.VoteAggregate.objects.using('votes').filter(
+            object_id=first.pk, score=2).exists())
+
+
+class StatsForManyTest(TestCase):
+    """
+    Retreive the stats of many objects using grouped queries.
+    """
+    def setUp(self):
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(5)]
+        self.content_type = ContentType.objects.get_for_model(User)
+        for target, voter, score in ((0, 1, 3), (0, 2, 3), (0, 3, 5), 
+            (1, 0, 2), (4, 0, 1)):
+            models.Vote.objects.create(content_type=self.content_type, 
+                object_id=self.users[target].pk, key='main', score=score, 
+                user=self.users[voter])
+        models.VoteAggregate.objects.create(content_type=self.content_type,
+            object_id=self.users[1].pk, key='main', score=2, num_votes=3)
+        for i in (0, 1, 4):
+            models.upsert_score(self.users[i], 'main')
+
+    def _get_expected(self, user):
+        score = models.Score(content_type=self.content_type, 
+            object_id=user.pk, key='main')
+        score.recalculate(commit=False)
+        return models.get_stats_for(score.get_votes(), 
+            aggregates=score.get_aggregates())
+
+    def test_same_stats(self):
+        queryset = User.objects.exclude(pk=self.users[4].pk)
+        with self.assertNumQueries(2):
+            stats = models.get_stats_for_many(queryset, 'main')
+        self.assertEqual(sorted(stats), [self.users[0].pk, self.users[1].pk])
+        for user in self.users[:2]:
+            self.assertEqual(stats[user.pk], self._get_expected(user))
+        
+    def test_object_ids(self):
+        with self.assertNumQueries(1):
+            stats = models.get_stats_for_many(self.content_type, 'main',
+                object_ids=[self.users[1].pk, self.users[2].pk])
+        self.assertEqual(stats.keys(), [self.users[1].pk])
+        self.assertEqual(stats[self.users[1].pk][2]['num_votes'], 4)
+
+    def test_missing_histograms(self):
+        models.Score.objects.filter(object_id=self.users[1].pk).update(
+            histogram='')
+        with self.assertNumQueries(3):
+            stats = models.get_stats_for_many(self.content_type, 'main')
+        self.assertEqual(len(stats), 3)
+        for user in self.users[:2]:
+            self.assertEqual(stats[user.pk], self._get_expected(user))
+
+
+    def test_loaded_votes(self):
+        user = self.users[1]
+        expected = self._get_expected(user)
+        score = models.Score.objects.get(object_id=user.pk, key='main')
+        votes = list(score.get_votes())
+        aggregates = list(score.get_aggregates())
+        with self.assertNumQueries(0):
+            self.assertEqual(models.get_stats_for(votes, 
+                aggregates=aggregates), expected)
+            self.assertEqual(models.get_stats_for([i.score for i in votes], 
+                aggregates=aggregates), expected)
+            summary = models.get_summary_for(votes, percentiles=(50, 100),
+                aggregates=aggregates)
+        self.assertEqual(summary['stats'], expected)
+        self.assertEqual(summary['num_votes'], score.num_votes)
+        self.assertAlmostEqual(summary['mean'], score.total / score.num_votes)
+        self.assertAlmostEqual(summary['variance'], score.variance)
+        self.assertEqual(summary['percentiles'].items(), 
+            [(50, score.median), (100, score.percentile(100))])
+        self.assertEqual(models.get_summary_for([])['mean'], None)
+
+    def test_templatetag(self):
+        handlers.ratings.register(User)
+        try:
+            template = Template('{% load ratings_tags %}'
+                "{% stats_annotate users with field using 'main' as result %}"
+                '{% for user in result %}{{ user.stats|length }} '
+                '{% endfor %}')
+            context = Context({'users': self.users[:3], 'field': 'stats'})
+            self.assertEqual(template.render(context), u'2 1 0 ')
+            self.assertEqual(context['result'][0].stats, 
+                self._get_expected(self.users[0]))
+        finally:
+            handlers.ratings.unregister(User)
+
+
+class DistributionTest(TestCase):
+    """
+    Check median, percentiles and variance of scores.
+    """
+    def setUp(self):
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(5)]
+        self.content_type = ContentType.objects.get_for_model(User)
+        for target, scores in ((0, (1, 2, 2, 5)), (1, (3, 3, 3))):
+            for voter, score in enumerate(scores):
+                models.Vote.objects.create(content_type=self.content_type, 
+                    object_id=self.users[target].pk, key='main', 
+                    score=score, user=self.users[voter + 1])
+            models.upsert_score(self.users[target], 'main')
+
+    def test_distribution(self):
+        score = models.Score.objects.get_for(self.users[0], 'main')
+        self.assertEqual(score.get_histogram().items(), 
+            [(1, 1), (2, 2), (5, 1)])
+        self.assertEqual(score.median, 2)
+        self.assertEqual(score.percentile(0), 1)
+        self.assertEqual(score.percentile(75), 2)
+        self.assertEqual(score.percentile(90), 5)
+        self.assertEqual(score.sum_of_squares, 34)
+        self.assertAlmostEqual(score.variance, 2.25)
+        self.assertAlmostEqual(score.stddev, 1.5)
+        score = models.Score.objects.get_for(self.users[1], 'main')
+        self.assertEqual((score.median, score.variance), (3, 0))
+        
+    def test_sort_by_variance(self):
+        queryset = models.annotate_scores(User.objects.filter(
+            pk__in=[self.users[0].pk, self.users[1].pk]), 'main', 
+            spread='variance').order_by('-spread')
+        self.assertEqual([i.pk for i in queryset], 
+            [self.users[0].pk, self.users[1].pk])
+
+
+class RollupTest(VotingMixin, TestCase):
+    """
+    Check that daily rollups are maintained when voting, and rebuilt by
+    the backfill.
+    """
+    def setUp(self):
+        handlers.ratings.register(User, daily_rollups=True)
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(4)]
+        self.target = self.users[0]
+        self.request = RequestFactory().post('/')
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def _get_rollups(self):
+        return list(models.get_rollups(self.target, 'main').values_list(
+            'day', 'num_votes', 'total', 'histogram'))
+
+    def test_maintained(self):
+        for user, score in zip(self.users[1:], (2, 4, 4)):
+            self._vote(user, self.target, score)
+        # changing and deleting votes
+        self._vote(self.users[2], self.target, 5)
+        self.handler.delete(self.request, self._vote(self.users[3], 
+            self.target, 4))
+        today = datetime.date.today()
+        period = self.handler.get_period_score(self.target, 'main', 
+            start=today, end=today)
+        self.assertEqual(period['histogram'].items(), [(2, 1), (5, 1)])
+        score = self.handler.get_score(self.target, 'main')
+        self.assertEqual((period['num_votes'], period['total'], 
+            period['average']), (score.num_votes, score.total, score.average))
+        self.assertEqual(self.handler.get_daily_votes(self.target, 'main'),
+            [(today, 2, 3.5)])
+        # the backfill gives the same rollups
+        rollups = self._get_rollups()
+        self.assertEqual(models.backfill_rollups(batch_size=1), 2)
+        self.assertEqual(self._get_rollups(), rollups)
+
+    def test_periods(self):
+        for user, score in zip(self.users[1:], (1, 3, 5)):
+            self._vote(user, self.target, score)
+        today = datetime.date.today()
+        for days, user in enumerate(self.users[1:]):
+            models.Vote.objects.filter(user=user).update(
+                created_at=datetime.datetime.now() - datetime.timedelta(
+                    days=days))
+        models.backfill_rollups()
+        self.assertEqual([i[:2] for i in self.handler.get_daily_votes(
+            self.target, 'main')], [(today - datetime.timedelta(days=2), 1),
+            (today - datetime.timedelta(days=1), 1), (today, 1)])
+        period = self.handler.get_period_score(self.target, 'main', 
+            start=today - datetime.timedelta(days=1))
+        self.assertEqual((period['num_votes'], period['average']), (2, 2))
+        # changing an old vote updates the rollup of its day
+        self._vote(self.users[3], self.target, 4)
+        period = self.handler.get_period_score(self.target, 'main', 
+            end=today - datetime.timedelta(days=2))
+        self.assertEqual(period['histogram'].items(), [(4, 1)])
+
+    def test_backfill_queryset(self):
+        other = self.users[1]
+        for user, score in zip(self.users[1:], (1, 3, 5)):
+            self._vote(user, self.target, score)
+            self._vote(user, other, score)
+        rollups = self._get_rollups()
+        models.VoteRollup.objects.update(num_votes=0)
+        # only the rollups of the votes in the queryset are rebuilt, 
+        # with a single delete
+        votes = models.Vote.objects.filter(object_id=self.target.pk)
+        connection.use_debug_cursor = True
+        try:
+            del connection.queries[:]
+            self.assertEqual(models.backfill_rollups(votes), 3)
+            deletes = [i for i in connection.queries 
+                if i['sql'].startswith('DELETE')]
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual(len(deletes), 1)
+        self.assertEqual(self._get_rollups(), rollups)
+        self.assertEqual(list(models.get_rollups(other, 'main').values_list(
+            'num_votes', flat=True)), [0])
+
+
+class LeaderboardTest(VotingMixin, TestCase):
+    """
+    Check that leaderboards are maintained when voting, and read without
+    hitting the database.
+    """
+    def setUp(self):
+        cache.clear()
+        handlers.ratings.register(User, leaderboard_metrics=('average', 
+            'num_votes'), leaderboard_size=2)
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(4)]
+        self.request = RequestFactory().post('/')
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        cache.clear()
+
+    def test_maintained(self):
+        first, second, third, voter = self.users
+        self._vote(voter, first, 3)
+        self._vote(voter, second, 5)
+        self._vote(third, second, 4)
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(second.pk, 4.5), (first.pk, 3)])
+        # a new object enters the leaderboard
+        self._vote(voter, third, 4)
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(second.pk, 4.5), (third.pk, 4)])
+        self.assertEqual(self.handler.get_leaderboard('main', 'num_votes'),
+            [(second.pk, 2), (first.pk, 1)])
+        # changing and deleting votes of objects in the leaderboard
+        self._vote(voter, second, 1)
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(third.pk, 4), (first.pk, 3)])
+        self.handler.delete(self.request, self._vote(voter, third, 4))
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(first.pk, 3), (second.pk, 2.5)])
+        # the table is the source of truth
+        cache.clear()
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(first.pk, 3), (second.pk, 2.5)])
+        # deleting a target object
+        first.delete()
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(second.pk, 2.5)])
+
+    def test_delete_queryset(self):
+        first, second, third, voter = self.users
+        for target, score in ((first, 3), (second, 5), (third, 4)):
+            self._vote(voter, target, score)
+        self.handler.delete_queryset(User.objects.filter(pk=second.pk))
+        # the entries of the deleted objects are replaced
+        cache.clear()
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(third.pk, 4), (first.pk, 3)])
+        # bulk deleting ratings also deletes leaderboard entries
+        models.delete_ratings_for_queryset(User.objects.filter(pk=third.pk))
+        self.assertFalse(models.LeaderboardEntry.objects.filter(
+            object_id=third.pk).exists())
+
+    def test_top_rated(self):
+        first, second, third, voter = self.users
+        self._vote(voter, first, 2)
+        self._vote(voter, second, 5)
+        self.handler.get_leaderboard('main')
+        with self.assertNumQueries(1):
+            top_rated = Template("{% load ratings_tags %}"
+                "{% get_top_rated auth.user using 'main' limit 1 as top %}"
+                "{% for i in top %}{{ i.username }} {{ i.leaderboard_value }}"
+                "{% endfor %}").render(Context())
+        self.assertEqual(top_rated, 'user1 5.0')
+        self.assertRaises(ValueError, self.handler.get_leaderboard, 'main',
+            'total')
+
+    def test_in_place(self):
+        first, second, third, voter = self.users
+        rebuild = leaderboards._rebuild
+        rebuilds = []
+        def counting_rebuild(*args):
+            rebuilds.append(args[2])
+            return rebuild(*args)
+        leaderboards._rebuild = counting_rebuild
+        try:
+            # the first vote builds the leaderboards
+            self._vote(voter, first, 3)
+            self.assertEqual(sorted(rebuilds), ['average', 'num_votes'])
+            del rebuilds[:]
+            # entries are added, moved and changed in place
+            self._vote(voter, second, 4)
+            self._vote(third, first, 5)
+            self._vote(voter, third, 2)
+            self.assertEqual(rebuilds, [])
+            self.assertEqual(self.handler.get_leaderboard('main'), 
+                [(first.pk, 4), (second.pk, 4)])
+            # an entry falls off and is replaced
+            self._vote(voter, second, 1)
+            self.assertEqual(rebuilds, ['average'])
+        finally:
+            leaderboards._rebuild = rebuild
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(first.pk, 4), (third.pk, 2)])
+        cache.clear()
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(first.pk, 4), (third.pk, 2)])
+
+    def test_locked(self):
+        first, second, third, voter = self.users
+        self._vote(voter, first, 3)
+        content_type = ContentType.objects.get_for_model(User)
+        cache_key = leaderboards.get_cache_key(content_type, 'main', 
+            'average')
+        # changes are skipped while another process holds the lock
+        cache.set(cache_key + ':lock', True)
+        self._vote(voter, second, 4)
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(first.pk, 3)])
+        cache.delete(cache_key + ':lock')
+        self._vote(voter, third, 2)
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(first.pk, 3), (third.pk, 2)])
+        self.assertEqual(leaderboards.rebuild(content_type, 'main', 
+            'average', 2), [(second.pk, 4), (first.pk, 3)])
+
+    def test_concurrent_rebuild(self):
+        first, second, third, voter = self.users
+        self._vote(voter, first, 2)
+        content_type = ContentType.objects.get_for_model(User)
+        # another process rebuilds the leaderboard just after the entries
+        # are deleted
+        raw_delete = QuerySet._raw_delete
+        def concurrent_delete(queryset, using):
+            raw_delete(queryset, using)
+            if queryset.model is models.LeaderboardEntry:
+                models.LeaderboardEntry.objects.create(
+                    content_type=content_type, key='main', metric='average', 
+                    position=1, object_id=second.pk, value=5)
+        QuerySet._raw_delete = concurrent_delete
+        try:
+            board = leaderboards.rebuild(content_type, 'main', 'average', 2)
+        finally:
+            QuerySet._raw_delete = raw_delete
+        self.assertEqual(board, [(first.pk, 2)])
+        self.assertEqual(list(models.LeaderboardEntry.objects.filter(
+            metric='average').values_list('object_id', flat=True)), 
+            [second.pk])
+        # the lock is released, and the entries stored by the other 
+        # process are read
+        cache_key = leaderboards.get_cache_key(content_type, 'main', 
+            'average')
+        self.assertEqual(cache.get(cache_key + ':lock'), None)
+        cache.delete(cache_key)
+        self.assertEqual(self.handler.get_leaderboard('main'), 
+            [(second.pk, 5)])
+        self.assertEqual(leaderboards.rebuild(content_type, 'main', 'average',
+            2), [(first.pk, 2)])
+
+
+class RecommendTest(TestCase):
+    """
+    Check that similar objects and recommendations are read from
+    the precomputed similarities, and that similarities are built
+    from votes (if NumPy and SciPy are installed).
+    """
+    def setUp(self):
+        handlers.ratings.register(User)
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(5)]
+        self.content_type = ContentType.objects.get_for_model(User)
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def _vote(self, user, target, score):
+        models.Vote.objects.create(key='main', user=user, score=score,
+            content_type=self.content_type, object_id=target.pk)
+
+    def _similarity(self, target, neighbour, similarity):
+        models.Similarity.objects.create(content_type=self.content_type, 
+            key='main', object_id=target.pk, neighbour_id=neighbour.pk, 
+            similarity=similarity)
+
+    def test_read(self):
+        first, second, third, fourth, voter = self.users
+        self._similarity(first, second, 0.5)
+        self._similarity(first, third, 0.9)
+        self._similarity(fourth, third, 0.1)
+        self._similarity(fourth, second, 0.3)
+        similar = self.handler.get_similar(first, 'main')
+        self.assertEqual([(i, i.similarity) for i in similar], 
+            [(third, 0.9), (second, 0.5)])
+        self.assertEqual(self.handler.get_similar(first, 'main', n=1), 
+            [third])
+        self.assertEqual(self.handler.get_recommendations_for(voter, 'main'),
+            [])
+        self._vote(voter, first, 5)
+        self._vote(voter, fourth, 1)
+        recommendations = self.handler.get_recommendations_for(voter, 'main')
+        self.assertEqual([(i, round(i.predicted_score, 2)) 
+            for i in recommendations],
+            [(third, 4.6), (second, 3.5)])
+        # similarities are deleted together with the target object
+        third.delete()
+        self.assertEqual(self.handler.get_similar(first, 'main'), [second])
+
+    @unittest.skipIf(recommend.numpy is None or recommend.sparse is None,
+        'NumPy and SciPy are required to build similarities')
+    def test_build(self):
+        first, second, third, fourth, voter = self.users
+        for user, scores in zip(self.users, ((5, 5, 1), (4, 5, 2), 
+            (1, 1, 5), (5, 4, None))):
+            for target, score in zip((first, second, third), scores):
+                if score is not None:
+                    self._vote(user, target, score)
+        for method in recommend.METHODS:
+            self.assertEqual(recommend.build_similarities(self.content_type,
+                'main', neighbours=1, method=method, chunk_size=2), 3)
+            self.assertEqual(self.handler.get_similar(first, 'main'), 
+                [second])
+            self.assertEqual(self.handler.get_similar(second, 'main'), 
+                [first])
+
+
+class ExportTest(TestCase):
+    """
+    Check the streaming export of votes.
+    """
+    def setUp(self):
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(3)]
+        content_type = ContentType.objects.get_for_model(User)
+        for i, (key, user) in enumerate([('main', self.users[1]), 
+            ('main', None), ('other', self.users[2])]):
+            models.Vote.objects.create(content_type=content_type, key=key,
+                object_id=self.users[0].pk, score=i + 1, user=user, 
+                ip_address='127.0.0.%d' % i)
+        # an old vote
+        models.Vote.objects.filter(score=1).update(
+            created_at=datetime.datetime(2013, 1, 1))
+
+    def _export(self, **options):
+        stdout, stderr = StringIO(), StringIO()
+        call_command('export_votes', stdout=stdout, stderr=stderr, 
+            batch_size=1, **options)
+        self.assertIn('rows/sec', stderr.getvalue())
+        return list(csv.reader(StringIO(stdout.getvalue())))
+
+    def test_csv(self):
+        rows = self._export()
+        self.assertEqual(tuple(rows[0]), exports.COLUMNS)
+        self.assertEqual([row[4] for row in rows[1:]], ['1.0', '2.0', '3.0'])
+        self.assertEqual(rows[2][1:6], ['auth.user', str(self.users[0].pk),
+            'main', '2.0', ''])
+        self.assertEqual(rows[1][8], '2013-01-01T00:00:00')
+        
+    def test_filters(self):
+        rows = self._export(model='auth.user', key='main', 
+            since=datetime.date.today().isoformat())
+        self.assertEqual([row[4] for row in rows[1:]], ['2.0'])
+        rows = self._export(until='2013-01-01')
+        self.assertEqual([row[4] for row in rows[1:]], ['1.0'])
+
+    @unittest.skipIf(exports.numpy is None, 'NumPy is required')
+    def test_arrays(self):
+        directory = tempfile.mkdtemp()
+        try:
+            for format in ('npy', 'npz'):
+                path = os.path.join(directory, 'votes.' + format)
+                call_command('export_votes', format=format, output=path,
+                    batch_size=2, verbosity=0)
+                data = exports.numpy.load(path)
+                self.assertEqual(list(data['score']), [1, 2, 3])
+                self.assertEqual(list(data['user']), 
+                    [self.users[1].pk, -1, self.users[2].pk])
+        finally:
+            shutil.rmtree(directory)
+
+
+class ImportTest(TestCase):
+    """
+    Check the validation and conflict handling of imported votes.
+    """
+    def setUp(self):
+        handlers.ratings.register(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(3)]
+        self.target = self.users[0]
+        models.Vote.objects.create(content_type=ContentType.objects.\
+            get_for_model(User), object_id=self.target.pk, key='main', 
+            score=1, user=self.users[1])
+        models.upsert_score(self.target, 'main')
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        shutil.rmtree(self.directory)
+
+    def _import(self, rows, **options):
+        path = os.path.join(self.directory, 'votes.jsonl')
+        with open(path, 'w') as output:
+            for row in rows:
+                row.setdefault('content_type', 'auth.user')
+                row.setdefault('object_id', self.target.pk)
+                output.write(json.dumps(row) + '\n')
+        stdout, stderr = StringIO(), StringIO()
+        call_command('import_votes', path, stdout=stdout, stderr=stderr,
+            **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_import(self):
+        stdout, stderr = self._import([
+            {'score': 4, 'user': self.users[2].pk,
+                'created_at': '2013-01-01T10:00:00'},
+            {'score': 5, 'user': self.users[1].pk},
+            {'score': 3, 'ip_address': '10.0.0.1', 'cookie': 'abc'},
+            {'score': 2, 'ip_address': '10.0.0.1', 'cookie': 'abc'},
+            {'score': 9, 'user': self.users[2].pk},
+            {'score': 2.5, 'user': self.users[2].pk},
+            {'score': 3, 'user': 999},
+            {'score': 3, 'object_id': 999, 'user': self.users[1].pk},
+            {'score': 3, 'content_type': 'auth.group', 'user': 1},
+            {'score': 3},
+        ], batch_size=3)
+        self.assertIn('2 votes created, 0 updated, 2 skipped, 6 invalid', 
+            stdout)
+        self.assertIn('row 5: Score is not in range', stderr)
+        self.assertIn('row 8: Invalid target object.', stderr)
+        score = models.Score.objects.get(object_id=self.target.pk)
+        self.assertEqual((score.num_votes, score.total), (3, 8))
+        vote = models.Vote.objects.get(user=self.users[2])
+        self.assertEqual(vote.created_at.year, 2013)
+
+    def test_update(self):
+        stdout, _ = self._import([{'score': 5, 'user': self.users[1].pk}],
+            on_conflict='update')
+        self.assertIn('0 votes created, 1 updated', stdout)
+        score = models.Score.objects.get(object_id=self.target.pk)
+        self.assertEqual((score.num_votes, score.average), (1, 5))
+
+    def test_rollups(self):
+        handlers.ratings.unregister(User)
+        handlers.ratings.register(User, daily_rollups=True)
+        self._import([
+            {'score': 4, 'user': self.users[2].pk,
+                'created_at': '2013-01-01T10:00:00'},
+            {'score': 5, 'user': self.users[1].pk},
+        ], on_conflict='update')
+        # the existing vote is counted too
+        today = models.get_day(models.Vote.objects.get(
+            user=self.users[1]).created_at)
+        self.assertEqual(list(models.get_rollups(self.target, 'main'
+            ).values_list('day', 'num_votes', 'total')), 
+            [(datetime.date(2013, 1, 1), 1, 4), (today, 1, 5)])
+
+
+class StarratingTest(TestCase):
+    """
+    Check that read-only star widgets are rendered without hitting 
+    the database, and are the same widgets built using target objects.
+    """
+    def setUp(self):
+        handlers.ratings.register(User, score_range=(1, 10), score_step=0.5)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(3)]
+        content_type = ContentType.objects.get_for_model(User)
+        for i, user in enumerate(self.users):
+            models.Vote.objects.create(content_type=content_type, 
+                object_id=user.pk, key='main', score=i + 3, user=user)
+        self.template = Template('{% load ratings_tags %}'
+            '{% for vote in votes %}{% show_starrating vote %}{% endfor %}')
+        
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        
+    def test_rendering(self):
+        votes = list(models.Vote.objects.order_by('pk'))
+        with self.assertNumQueries(0):
+            markup = self.template.render(Context({'votes': votes * 2}))
+        expected = []
+        for vote in votes:
+            widget = forms.StarWidget(1, 10, 0.5, vote.content_object, 
+                read_only=True)
+            expected.append(render_to_string(widget.template, 
+                widget.get_context(u'score', vote.score, {'id': u'id_score'})))
+        self.assertEqual(markup, u''.join(expected * 2))
+        self.assertIn(u'star-score-auth_user-%s' % self.users[2].pk, markup)
+
+    def test_rounded_value(self):
+        content_type = ContentType.objects.get_for_model(User)
+        template = Template('{% load ratings_tags %}'
+            '{% show_starrating score %}')
+        target = self.users[0]
+        def render(average):
+            score = models.Score(content_type=content_type, 
+                object_id=target.pk, key='main', average=average)
+            return template.render(Context({'score': score}))
+        def render_widget(average):
+            widget = forms.StarWidget(1, 10, 0.5, target, read_only=True)
+            return render_to_string(widget.template, widget.get_context(
+                u'score', average, {'id': u'id_score'}))
+        # the stars are the same as the ones of the exact value
+        ratings_tags._starrating_cache.clear()
+        self.assertEqual(render(3.7), render_widget(3.7))
+        # a widget template also rendering the hidden input
+        directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(directory, 'ratings'))
+        with open(os.path.join(directory, 'ratings', 'star_widget.html'), 
+            'w') as f:
+            f.write('{{ parent }} {{ value }}')
+        ratings_tags._starrating_cache.clear()
+        try:
+            with self.settings(TEMPLATE_DIRS=(directory,)):
+                for average, rounded in ((3, 3.0), (3.5, 3.5), (3.25, 3.0), 
+                    (3.7, 3.5), (0, 0.0)):
+                    # values rounded to the same step share the markup
+                    self.assertEqual(render(average), render_widget(rounded))
+            self.assertEqual(len(ratings_tags._starrating_cache), 3)
+        finally:
+            ratings_tags._starrating_cache.clear()
+            shutil.rmtree(directory)
+
+
+class RatingCacheTest(VotingMixin, TestCase):
+    """
+    Check that rating fragments are cached until scores change.
+    """
+    def setUp(self):
+        cache.clear()
+        handlers.ratings.register(User)
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(3)]
+        self.request = RequestFactory().post('/')
+        self.template = Template('{% load ratings_tags %}'
+            '{% versions_annotate users using "main" %}'
+            '{% for user in users %}{% ratingcache average user "main" %}'
+            '{% get_rating_score for user using "main" as score %}'
+            '{{ score.average|default:"-" }} {% endratingcache %}'
+            '{% endfor %}')
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        cache.clear()
+
+    def _render(self):
+        users = list(User.objects.order_by('pk'))
+        context = Context({'users': users, 'request': self.request})
+        return self.template.render(context)
+
+    def test_versions(self):
+        first, second, third = self.users
+        self._vote(third, first, 2)
+        score = models.Score.objects.get()
+        self.assertEqual(self.handler.get_versions(self.users, 'main'),
+            {first.pk: '1.%s' % score.modified_at.strftime('%Y%m%d%H%M%S%f'),
+            second.pk: '0', third.pk: '0'})
+        self.assertEqual(self._render(), '2.0 - - ')
+        # cached fragments are used until the score changes
+        with self.assertNumQueries(2):
+            self.assertEqual(self._render(), '2.0 - - ')
+        self._vote(third, first, 4)
+        self._vote(third, second, 5)
+        self.assertEqual(self._render(), '4.0 5.0 - ')
+        self.handler.delete(self.request, self._vote(third, first, 4))
+        self.assertEqual(self._render(), '- 5.0 - ')
+        # a score created again does not reuse the fragments of the old one
+        models.Score.objects.filter(object_id=second.pk).delete()
+        self.assertEqual(self._render(), '- - - ')
+        self._vote(third, second, 3)
+        self.assertEqual(models.Score.objects.get(object_id=second.pk
+            ).version, 1)
+        self.assertEqual(self._render(), '- 3.0 - ')
+
+    def test_fragment_names(self):
+        first, second, third = self.users
+        self._vote(third, first, 2)
+        template = Template('{% load ratings_tags %}'
+            '{% ratingcache average user "main" %}{{ user.username }}'
+            '{% endratingcache %} {% ratingcache name user "main" %}'
+            '{{ user.username }}{% endratingcache %}')
+        self.assertEqual(self._render(), '2.0 - - ')
+        # fragments with the same name share their cache entries
+        self.assertEqual(template.render(Context({'user': first})), 
+            '2.0  user0')
+        self.assertRaises(TemplateSyntaxError, Template, 
+            '{% load ratings_tags %}{% ratingcache user "main" %}'
+            '{% endratingcache %}')
+
+
+class ScoreViewTest(VotingMixin, TestCase):
+    """
+    Check the json score view and its conditional responses.
+    """
+    def setUp(self):
+        handlers.ratings.register(User)
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(3)]
+        self.target = self.users[0]
+        self.url = reverse('ratings_score', args=['auth.user', 
+            self.target.pk, 'main'])
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def test_score(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['num_votes'], 0)
+        self._vote(self.users[1], self.target, 2)
+        self._vote(self.users[2], self.target, 4)
+        response = self.client.get(self.url + '?distribution')
+        data = json.loads(response.content)
+        self.assertEqual((data['average'], data['num_votes'], 
+            data['version'], data['median']), (3, 2, 2, 2))
+        self.assertEqual([i['num_votes'] for i in data['stats']], [1, 1])
+        # unregistered models
+        response = self.client.get(reverse('ratings_score', 
+            args=['auth.group', 1, 'main']))
+        self.assertEqual(response.status_code, 400)
+
+    def test_conditional(self):
+        self._vote(self.users[1], self.target, 2)
+        response = self.client.get(self.url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, 
+            HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        # the distribution has its own entity tag
+        response = self.client.get(self.url + '?distribution', 
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        # a new vote changes the entity tag
+        self._vote(self.users[2], self.target, 4)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(json.loads(response.content)['num_votes'], 2)
+
+
+class BulkScoresViewTest(VotingMixin, TestCase):
+    """
+    Check that scores and user votes of many objects are returned by 
+    the bulk scores view using two queries.
+    """
+    def setUp(self):
+        handlers.ratings.register(User)
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(3)]
+        self.voter = User.objects.create(username='voter')
+        self.url = reverse('ratings_scores', args=['auth.user', 'main'])
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def test_scores(self):
+        first, second, third = self.users
+        self._vote(self.voter, first, 2)
+        self._vote(third, first, 4)
+        self._vote(third, second, 5)
+        ids = ','.join(str(i.pk) for i in self.users)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {'ids': ids})
+        data = json.loads(response.content)
+        self.assertEqual(data['fields'], 
+            ['average', 'total', 'num_votes', 'version'])
+        self.assertEqual(data['scores'], {str(first.pk): [3, 6, 2, 2], 
+            str(second.pk): [5, 5, 1, 1], str(third.pk): [0, 0, 0, 0]})
+        self.assertFalse('votes' in data)
+        # current user votes
+        request = RequestFactory().get(self.url, {'ids': ids, 'votes': ''})
+        request.user = self.voter
+        with self.assertNumQueries(2):
+            response = views.scores(request, 'auth.user', 'main')
+        self.assertEqual(json.loads(response.content)['votes'], 
+            {str(first.pk): 2})
+
+    def test_anonymous_handler(self):
+        # authenticated users of handlers allowing anonymous votes vote
+        # using cookies
+        handlers.ratings.unregister(User)
+        handlers.ratings.register(User, allow_anonymous=True)
+        handler = handlers.ratings.get_handler(User)
+        target = self.users[0]
+        request = RequestFactory().post('/')
+        request.user = self.voter
+        kwargs = handler.get_vote_form_kwargs(request, target, 'main')
+        data = handler.get_vote_form_class(request)(target, 'main', 
+            **kwargs).initial
+        data['score'] = 4
+        request = RequestFactory().post(reverse('ratings_vote'), data)
+        request.user = self.voter
+        response = views.vote(request)
+        self.assertEqual(response.status_code, 302)
+        request = RequestFactory().get(self.url, {'ids': str(target.pk), 
+            'votes': ''})
+        request.user = self.voter
+        request.COOKIES = dict((k, v.value) 
+            for k, v in response.cookies.items())
+        response = views.scores(request, 'auth.user', 'main')
+        self.assertEqual(json.loads(response.content)['votes'], 
+            {str(target.pk): 4})
+
+    def test_invalid(self):
+        response = self.client.get(self.url, {'ids': '1,a'})
+        self.assertEqual(response.status_code, 400)
+        ids = ','.join(str(i) for i in range(1, 
+            settings.BULK_SCORES_MAX_IDS + 2))
+        response = self.client.get(self.url, {'ids': ids})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(handlers.ratings.get_handler_for_label('auth.user'),
+            self.handler)
+        self.assertEqual(handlers.ratings.get_handler_for_label('auth.group'),
+            None)
+
+
+class LiveUpdatesTest(VotingMixin, TestCase):
+    """
+    Check that score changes are published, coalesced and streamed.
+    """
+    def setUp(self):
+        handlers.ratings.register(User)
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(3)]
+        self.content_type = ContentType.objects.get_for_model(User)
+        self.interval = settings.LIVE_UPDATES_INTERVAL
+        settings.LIVE_UPDATES_INTERVAL = 0
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        settings.LIVE_UPDATES_INTERVAL = self.interval
+
+    def test_bus(self):
+        first, second, third = self.users
+        target = (self.content_type.pk, first.pk, 'main')
+        subscription = events.bus.subscribe([target])
+        self.assertEqual(subscription.get(0), [])
+        # a burst of changes is coalesced
+        self._vote(second, first, 2)
+        self._vote(third, first, 4)
+        self._vote(third, second, 5)
+        self.assertEqual(subscription.get(0), [(target, {'average': 3, 
+            'total': 6, 'num_votes': 2, 'version': 2})])
+        subscription.close()
+        self._vote(second, first, 3)
+        self.assertEqual(subscription.get(0), [])
+        self.assertFalse(target in events.bus.subscriptions)
+
+    def test_stream(self):
+        first, second, third = self.users
+        url = reverse('ratings_events', args=['auth.user', 'main'])
+        request = RequestFactory().get(url, {'ids': first.pk})
+        response = views.events(request, 'auth.user', 'main')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = iter(response.streaming_content)
+        self.assertEqual(next(content), 'retry: 1000\n\n')
+        self._vote(second, first, 2)
+        self._vote(second, second, 2)
+        message = next(content)
+        self.assertTrue(message.startswith('event: score\ndata: '))
+        self.assertEqual(json.loads(message.split('data: ')[1]), {
+            'content_type': 'auth.user', 'object_id': first.pk, 
+            'key': 'main', 'average': 2, 'total': 2, 'num_votes': 1, 
+            'version': 1})
+        response.close()
+        self.assertEqual(events.bus.subscriptions, {})
+        response = self.client.get(url, {'ids': ''})
+        self.assertEqual(response.status_code, 400)
+
+
+class CacheableFormsTest(TestCase):
+    """
+    Check that cacheable forms do not depend on the user, and that user 
+    dependent data is loaded by the hydration view.
+    """
+    def setUp(self):
+        handlers.ratings.register(User, form_class=forms.StarVoteForm,
+            cacheable_forms=True)
+        self.handler = handlers.ratings.get_handler(User)
+        self.users = [User.objects.create(username='user%d' % i) 
+            for i in range(3)]
+        self.template = Template('{% load ratings_tags %}'
+            '{% get_rating_form for target using "main" as form %}'
+            '{{ form }}')
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def _get_request(self, user, *args, **kwargs):
+        request = RequestFactory().get(*args, **kwargs)
+        request.user = user
+        return request
+
+    def test_markup(self):
+        first, second, third = self.users
+        self.handler.vote(self._get_request(second, '/'), models.Vote(
+            key='main', user=second, score=4, object_id=first.pk,
+            content_type=ContentType.objects.get_for_model(User)))
+        contents = []
+        for user in (second, third):
+            context = Context({'target': first, 
+                'request': self._get_request(user, '/')})
+            with self.assertNumQueries(0):
+                contents.append(self.template.render(context))
+        self.assertEqual(contents[0], contents[1])
+        self.assertFalse('checked' in contents[0])
+        self.assertTrue('name="timestamp" type="hidden"' in contents[0] or
+            'type="hidden" name="timestamp"' in contents[0])
+
+    def test_hydrate(self):
+        first, second, third = self.users
+        self.handler.vote(self._get_request(second, '/'), models.Vote(
+            key='main', user=second, score=4, object_id=first.pk,
+            content_type=ContentType.objects.get_for_model(User)))
+        targets = ['auth.user:%d:main' % i.pk for i in self.users]
+        request = self._get_request(second, reverse('ratings_hydrate'),
+            {'target': targets})
+        with self.assertNumQueries(2):
+            response = views.hydrate(request)
+        data = json.loads(response.content)['forms']
+        self.assertEqual(sorted(data), sorted(targets))
+        self.assertEqual([data[i]['score'] for i in targets], 
+            [4, None, None])
+        # the security data is valid
+        state = data[targets[1]]
+        form = forms.StarVoteForm(second, 'main', score_range=(1, 5),
+            score_step=1, data={'content_type': 'auth.user', 
+            'object_pk': str(second.pk), 'key': 'main', 'score': 3, 
+            'timestamp': state['timestamp'], 
+            'security_hash': state['security_hash']})
+        self.assertTrue(form.is_valid())
+        # invalid targets
+        request = self._get_request(second, reverse('ratings_hydrate'),
+            {'target': 'auth.group:1:main'})
+        self.assertEqual(views.hydrate(request).status_code, 400)
+
+
+class VoteCoalescingTest(TestCase):
+    """
+    Check that rapid changes of a vote are coalesced, and that only
+    the latest one is saved when the window ends.
+    """
+    def setUp(self):
+        cache.clear()
+        self.flushes = []
+        class CoalescingHandler(handlers.RatingHandler):
+            vote_coalescing_window = 60
+            def schedule_flush(handler, vote_id):
+                self.flushes.append(vote_id)
+        handlers.ratings.register(User, CoalescingHandler)
+        self.handler = handlers.ratings.get_handler(User)
+        self.voter, self.target = [User.objects.create(username='user%d' % i)
+            for i in range(2)]
+        self.request = RequestFactory().post('/')
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        cache.clear()
+
+    def _vote(self, score):
+        vote = models.Vote.objects.get_for(self.target, 'main', 
+            user=self.voter)
+        if vote is None:
+            vote = models.Vote(key='main', user=self.voter, 
+                content_type=ContentType.objects.get_for_model(User), 
+                object_id=self.target.pk)
+        vote.score = score
+        return vote
+
+    def _get_stored(self):
+        vote = models.Vote.objects.get_for(self.target, 'main', 
+            user=self.voter)
+        return vote.score, vote.get_score().average
+
+    def test_coalescing(self):
+        self.assertTrue(self.handler.vote(self.request, self._vote(1)))
+        # the window is open: changes are not saved
+        for score in (2, 3, 4):
+            vote = self._vote(score)
+            with self.assertNumQueries(0):
+                self.assertFalse(self.handler.vote(self.request, vote))
+        self.assertEqual(self._get_stored(), (1, 1))
+        self.assertEqual(self.flushes, [vote.pk])
+        # the pending score is the current vote of the user
+        self.assertEqual(self.handler.get_vote(self.target, 'main', 
+            self.voter).score, 4)
+        self.assertEqual(self.handler.get_votes_for_many([self.target.pk], 
+            'main', self.voter), {self.target.pk: 4})
+        # the latest change is saved when the window ends
+        self.assertEqual(self.handler.flush_pending_vote(vote.pk).score, 4)
+        self.assertEqual(self._get_stored(), (4, 4))
+        self.assertEqual(self.handler.flush_pending_vote(vote.pk), None)
+        # deleting the vote discards pending changes
+        self.handler.vote(self.request, self._vote(5))
+        self.handler.delete(self.request, self._vote(5))
+        self.assertEqual(self.handler.flush_pending_vote(vote.pk), None)
+        self.assertEqual(models.Score.objects.get_for(self.target, 
+            'main').num_votes, 0)
+
+    def test_change_while_flushing(self):
+        self.handler.vote(self.request, self._vote(1))
+        self.handler.vote(self.request, self._vote(2))
+        # a change is stored while the pending score is being saved
+        save_vote = self.handler.save_vote
+        def change_and_save(vote):
+            self.assertTrue(routers.is_pinned())
+            self.handler.vote(self.request, self._vote(3))
+            return save_vote(vote)
+        self.handler.save_vote = change_and_save
+        try:
+            self.assertEqual(self.handler.flush_pending_vote(
+                self._vote(2).pk).score, 2)
+        finally:
+            del self.handler.save_vote
+        self.assertEqual(self._get_stored(), (2, 2))
+        # the latest change is still pending
+        vote = self._vote(3)
+        self.assertEqual(self.handler.get_pending_scores([vote.pk]), 
+            {vote.pk: 3})
+        self.assertEqual(self.handler.flush_pending_vote(vote.pk).score, 3)
+        self.assertEqual(self.handler.get_pending_scores([vote.pk]), {})
+
+    def test_flush_pending_votes(self):
+        self.handler.vote(self.request, self._vote(1))
+        self.handler.vote(self.request, self._vote(2))
+        # the process that scheduled the flush exited
+        call_command('flush_pending_votes', verbosity=0)
+        self.assertEqual(self._get_stored(), (2, 2))
+        self.assertEqual(self.handler.flush_pending_votes(), [])
+
+
+class CacheIPLimiterTest(TestCase):
+    """
+    Check that cache counters are rebuilt for all the ip addresses of
+    a target object.
+    """
+    def setUp(self):
+        cache.clear()
+        handlers.ratings.register(User, allow_anonymous=True, 
+            votes_per_ip_address=1, votes_per_ip_address_window=60,
+            ip_limiter_class=limiters.CacheIPLimiter)
+        self.handler = handlers.ratings.get_handler(User)
+        self.target = User.objects.create(username='target')
+        self.content_type = ContentType.objects.get_for_model(User)
+        for ip_address in ('10.0.0.1', '10.0.0.2'):
+            models.Vote.objects.create(content_type=self.content_type, 
+                object_id=self.target.pk, key='main', score=3, 
+                ip_address=ip_address, cookie=ip_address)
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+        cache.clear()
+
+    def test_rebuild(self):
+        limiter = self.handler.get_ip_limiter()
+        vote = models.Vote(content_type=self.content_type, 
+            object_id=self.target.pk, key='main', score=4)
+        # the counters of all the ip addresses are rebuilt at once
+        with self.assertNumQueries(1):
+            self.assertFalse(limiter.allow(vote, '10.0.0.1'))
+        with self.assertNumQueries(0):
+            self.assertFalse(limiter.allow(vote, '10.0.0.2'))
+            self.assertTrue(limiter.allow(vote, '10.0.0.3'))
+        limiter.hit(vote, '10.0.0.3')
+        self.assertFalse(limiter.allow(vote, '10.0.0.3'))
+
+
+class UpsertScoreTransactionTest(TransactionTestCase):
+    """
+    Check that scores join the transaction managed by the caller.
+    """
+    def setUp(self):
+        self.voter, self.target = [User.objects.create(username='user%d' % i)
+            for i in range(2)]
+
+    def test_outer_transaction(self):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        try:
+            models.Vote.objects.create(key='main', score=4, user=self.voter,
+                content_type=ContentType.objects.get_for_model(User),
+                object_id=self.target.pk)
+            score, created = models.upsert_score(self.target, 'main')
+            self.assertEqual((score.num_votes, created), (1, True))
+            # the outer transaction is not committed by the score update
+            transaction.rollback()
+        finally:
+            transaction.leave_transaction_management()
+        self.assertFalse(models.Vote.objects.exists())
+        self.assertFalse(models.Score.objects.exists())
+        # without an outer transaction, the score is committed
+        models.upsert_score(self.target, 'main')
+        self.assertEqual(models.Score.objects.get().num_votes, 0)
+
+    def test_lock_first(self):
+        # the score row is locked before anything is read, so that under
+        # REPEATABLE READ votes are counted in a snapshot taken after it
+        connection.use_debug_cursor = True
+        try:
+            for created in (True, False):
+                del connection.queries[:]
+                self.assertEqual(models.upsert_score(self.target, 
+                    'main')[1], created)
+                self.assertTrue(connection.queries[0]['sql'].startswith(
+                    'UPDATE'))
+        finally:
+            connection.use_debug_cursor = None
+        self.assertEqual(models.Score.objects.get().version, 2)
+
+
+class ConcurrentVotesTest(TransactionTestCase):
+    """
+    Fire concurrent votes at the same target object from several threads,
+    using a file backed SQLite database, and check that the score always
+    matches the votes at the end of each burst.
+    """
+    multi_db = True
+    num_threads = 10
+    num_bursts = 10
+
+    def setUp(self):
+        if connections['stress'].vendor != 'sqlite':
+            self.skipTest('the stress test uses a SQLite database')
+        handlers.ratings.register(User, allow_anonymous=True, 
+            vote_db='stress', score_db='stress')
+        self.handler = handlers.ratings.get_handler(User)
+        self.target = User.objects.create(username='target')
+        self.content_type = ContentType.objects.get_for_model(User)
+        self.request = RequestFactory().post('/')
+        self.votes = []
+        self.errors = []
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def _voter(self, vote, delete, start):
+        start.wait()
+        try:
+            if delete:
+                self.handler.delete(self.request, vote)
+            else:
+                self.handler.vote(self.request, vote)
+        except Exception as err:
+            self.errors.append(err)
+        finally:
+            connections['stress'].close()
+
+    def _burst(self, burst):
+        """
+        Create, change or delete *num_threads* votes at the same time.
+        """
+        actions = []
+        for i in range(self.num_threads):
+            if self.votes and random.random() < 0.3:
+                vote = self.votes.pop(random.randrange(len(self.votes)))
+                delete = random.random() < 0.5
+                if not delete:
+                    vote.score = random.randint(1, 5)
+                    self.votes.append(vote)
+            else:
+                vote = models.Vote(content_type=self.content_type, 
+                    object_id=self.target.pk, key='main', 
+                    score=random.randint(1, 5), ip_address='10.0.0.1',
+                    cookie='%d-%d' % (burst, i))
+                delete = False
+                self.votes.append(vote)
+            actions.append((vote, delete))
+        start = threading.Event()
+        threads = [threading.Thread(target=self._voter, 
+            args=(vote, delete, start)) for vote, delete in actions]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+    def test_score_matches_votes(self):
+        for burst in range(self.num_bursts):
+            self._burst(burst)
+            self.assertEqual(self.errors, [])
+            score = models.Score.objects.using('stress').get()
+            expected = models.Score(content_type=self.content_type, 
+                object_id=self.target.pk, key='main')
+            expected.recalculate(commit=False, vote_db='stress')
+            self.assertEqual(
+                (score.num_votes, score.total, score.average),
+                (expected.num_votes, expected.total, expected.average),
+                'burst %d: score drifted from votes' % burst)
+
+
+class QueryPlanTest(TransactionTestCase):
+    """
+    Check, using SQLite *EXPLAIN QUERY PLAN*, that the queries performed
+    by managers and handlers do not scan the ratings tables.
+    
+    This is a transaction test case since the SQLite driver commits 
+    the current transaction before executing *EXPLAIN* statements.
+    """
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('query plans are only checked on SQLite')
+        handlers.ratings.register(User, allow_anonymous=True, 
+            votes_per_ip_address=1)
+        self.handler = handlers.ratings.get_handler(User)
+        self.user = User.objects.create(username='voter')
+        self.vote = models.Vote(key='main', score=3, ip_address='1.2.3.4',
+            content_type=ContentType.objects.get_for_model(User), 
+            object_id=self.user.pk)
+
+    def tearDown(self):
+        handlers.ratings.unregister(User)
+
+    def assertUsesIndexes(self, queryset, columns=(), ordered=False):
+        """
+        Assert that *queryset* does not scan the ratings tables.
+        If *columns* are given, they must be used in the index search.
+        If *ordered* is True, the index must also be used for sorting.
+        """
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN QUERY PLAN %s' % sql, params)
+        details = [row[-1] for row in cursor.fetchall()]
+        searches = [i for i in details if 'ratings_' in i]
+        for detail in searches:
+            self.assertFalse(detail.startswith('SCAN'), 
+                'full scan in %r for query %s' % (detail, sql))
+        for column in columns:
+            self.assertTrue(any('%s=' % column in i for i in searches),
+                'column %r not in index search %r' % (column, searches))
+        if ordered:
+            self.assertFalse(any('TEMP B-TREE' in i for i in details),
+                'index not used for ordering in %r' % details)
+
+    def test_votes(self):
+        manager = models.Vote.objects
+        self.assertUsesIndexes(manager.filter_for(self.user, key='main'),
+            columns=('content_type_id', 'object_id', 'key'))
+        self.assertUsesIndexes(manager.filter_for(self.user, key='main',
+            user=self.user), columns=('object_id', 'key', 'user_id'))
+        self.assertUsesIndexes(manager.filter_for(self.user, key='main',
+            cookie='cookie', user__isnull=True), 
+            columns=('object_id', 'key', 'cookie'))
+
+    def test_latest_votes(self):
+        votes = self.handler.get_votes_for(self.user)
+        self.assertUsesIndexes(votes.order_by('modified_at').queryset,
+            columns=('object_id',), ordered=True)
+        votes = self.handler.get_votes_by(self.user)
+        self.assertUsesIndexes(votes.order_by('modified_at').queryset,
+            columns=('user_id', 'content_type_id'), ordered=True)
+        votes = handlers.ratings.get_votes_by(self.user)
+        self.assertUsesIndexes(votes.order_by('modified_at').queryset,
+            columns=('user_id',))
+
+    def test_ip_address(self):
+        votes = models.Vote.objects.filter(
+            content_type=self.vote.content_type_id, object_id=self.user.pk,
+            user__isnull=True, ip_address='1.2.3.4')
+        self.assertUsesIndexes(votes, columns=('object_id', 'ip_address'))
+        self.assertUsesIndexes(votes.filter(
+            created_at__gte=self.user.date_joined), 
+            columns=('object_id', 'ip_address'))
+
+    def test_scores(self):
+        self.assertUsesIndexes(models.Score.objects.filter_for(self.user,
+            key='main'), columns=('object_id', 'key'))
+        scores = models.Score.objects.filter_for(User, key='main')
+        self.assertUsesIndexes(scores.order_by('-average'), 
+            columns=('key',), ordered=True)
+        self.assertUsesIndexes(scores.order_by('-num_votes'), 
+            columns=('key',), ordered=True)
+        self.assertUsesIndexes(self.handler.annotate_scores(User.objects.all(),
+            'main', average='average', num_votes='num_votes'),
+            columns=('object_id', 'key'))
+        self.assertUsesIndexes(self.handler.annotate_votes(User.objects.all(),
+            'main', self.user), columns=('object_id', 'key'))
+
+    def test_comments(self):
+        manager = models.Comment.objects
+        self.assertUsesIndexes(manager.filter_for(self.user, key='main'),
+            columns=('object_id', 'key'))
+        self.assertUsesIndexes(manager.filter_for(self.user).order_by(
+            '-created_at'), columns=('object_id',), ordered=True)
@@ -2,4 +2,11 @@ from django.conf.urls.defaults import patterns, url
 
 urlpatterns = patterns('ratings.views',
     url(r'^vote/$', 'vote', name='ratings_vote'),
-)
\ No newline at end of file
+    url(r'^hydrate/$', 'hydrate', name='ratings_hydrate'),
+    url(r'^score/(?P<content_type>\w+\.\w+)/(?P<object_pk>\d+)/(?P<key>[^/]+)/$',
+        'score', name='ratings_score'),
+    url(r'^scores/(?P<content_type>\w+\.\w+)/(?P<key>[^/]+)/$',
+        'scores', name='ratings_scores'),
+    url(r'^events/(?P<content_type>\w+\.\w+)/(?P<key>[^/]+)/$',
+        'events', name='ratings_events'),
+)
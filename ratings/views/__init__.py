@@ -1,7 +1,22 @@
+import calendar
+import hashlib
+import time
+
+from django.contrib.contenttypes.models import ContentType
 from django.db.models import get_model
 from django import http
+from django.utils import simplejson as json
+from django.utils import timezone
+from django.utils.cache import add_never_cache_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe
+from django.utils.http import quote_etag
+from django.views.decorators.csrf import ensure_csrf_cookie
+
+from ratings import handlers, signals, models, routers, settings
+from ratings import events as ratings_events
 
-from ratings import handlers, signals, models
+# the score fields returned by the bulk scores view, in this order
+SCORE_FIELDS = ('average', 'total', 'num_votes', 'version')
 
 def vote(request, extra_context=None, form_class=None, using=None):
     """
@@ -46,70 +61,322 @@ def vote(request, extra_context=None, form_class=None, using=None):
         if form.is_valid():
             created = deleted = False
         
-            # getting unsaved vote
-            vote = form.get_vote(request, handler.allow_anonymous)
+            # reads are pinned to the write database, so that the existing
+            # vote is looked up where it is saved (see *ratings.routers*)
+            with routers.pinned():
+                # getting unsaved vote
+                vote = form.get_vote(request, handler.allow_anonymous)
             
-            # handling vote deletion
-            if form.delete(request):
-                deleted = True
-                # pre-delete signal: receivers can stop the delete process
-                # note: one receiver is always called: *handler.pre_delete*
-                # handler can disallow the vote deletion
-                responses = signals.vote_will_be_deleted.send(
-                    sender=vote.__class__, 
-                    vote=vote, request=request)
+                # handling vote deletion
+                if form.delete(request):
+                    deleted = True
+                    # pre-delete signal: receivers can stop the delete process
+                    # note: one receiver is always called: *handler.pre_delete*
+                    # handler can disallow the vote deletion
+                    responses = handlers.ratings.send_signal(
+                        signals.vote_will_be_deleted, handler, vote, request)
 
-                # if one of the receivers reurns False then vote deletion 
-                # must be killed
-                for receiver, response in responses:
-                    if response == False:
-                        return http.HttpResponseBadRequest(
-                            'Receiver %r killed the deletion process' % 
-                            receiver.__name__)
+                    # if one of the receivers reurns False then vote deletion 
+                    # must be killed
+                    for receiver, response in responses:
+                        if response == False:
+                            return http.HttpResponseBadRequest(
+                                'Receiver %r killed the deletion process' % 
+                                receiver.__name__)
                 
-                # actually delete the vote    
-                handler.delete(request, vote)
+                    # actually delete the vote    
+                    handler.delete(request, vote)
                 
-                # post-delete signal
-                # note: one receiver is always called: *handler.post_delete*
-                signals.vote_was_deleted.send(sender=vote.__class__, 
-                    vote=vote, request=request)
+                    # post-delete signal
+                    # note: one receiver is always called: *handler.post_delete*
+                    handlers.ratings.send_signal(signals.vote_was_deleted, 
+                        handler, vote, request)
             
-            else:
+                else:
                                 
-                # pre-vote signal: receivers can stop the vote process
-                # note: one receiver is always called: *handler.pre_vote*
-                # handler can disallow the vote
-                responses = signals.vote_will_be_saved.send(
-                    sender=vote.__class__, 
-                    vote=vote, request=request)
+                    # pre-vote signal: receivers can stop the vote process
+                    # note: one receiver is always called: *handler.pre_vote*
+                    # handler can disallow the vote
+                    responses = handlers.ratings.send_signal(
+                        signals.vote_will_be_saved, handler, vote, request)
         
-                # if one of the receivers reurns False then voting must be killed
-                for receiver, response in responses:
-                    if response == False:
-                        return http.HttpResponseBadRequest(
-                            'Receiver %r killed the voting process' % 
-                            receiver.__name__)
+                    # if one of the receivers reurns False then voting must be killed
+                    for receiver, response in responses:
+                        if response == False:
+                            return http.HttpResponseBadRequest(
+                                'Receiver %r killed the voting process' % 
+                                receiver.__name__)
         
-                # actually save the vote
-                created = handler.vote(request, vote)
+                    # actually save the vote
+                    created = handler.vote(request, vote)
         
-                # post-vote signal
-                # note: one receiver is always called: *handler.post_vote*
-                signals.vote_was_saved.send(sender=vote.__class__, 
-                    vote=vote, request=request, created=created)
+                    # post-vote signal
+                    # note: one receiver is always called: *handler.post_vote*
+                    handlers.ratings.send_signal(signals.vote_was_saved, 
+                        handler, vote, request, created=created)
 
-            if form.cleaned_data.get('comment'):
-                # getting unsaved comment
-                comment = form.get_comment(request, handler.allow_anonymous)
-                comment.vote_id = vote.id
-                comment.save()
+                if form.cleaned_data.get('comment'):
+                    # getting unsaved comment
+                    comment = form.get_comment(request, handler.allow_anonymous)
+                    comment.vote_id = vote.id
+                    comment.save(using=handler.vote_db)
         
-            # vote is saved or deleted: redirect
-            return handler.success_response(request, vote, created, deleted)
+                # vote is saved or deleted: redirect
+                return handler.success_response(request, vote, created, deleted)
         
         # form is not valid: must handle errors
         return handler.failure_response(request, form.errors)
         
     # only answer POST requests
     return http.HttpResponseForbidden('Forbidden.')
+
+
+def score(request, content_type, object_pk, key):
+    """
+    Score view: return the score of the target object as json, e.g.::
+    
+        {
+            'key': 'main',
+            'average': 3.5,
+            'total': 7,
+            'num_votes': 2,
+            'version': 4,
+            'modified_at': '2013-01-01T10:00:00+00:00'
+        }
+        
+    If the querystring contains *distribution*, then the distribution of
+    votes (*stats*, see *Score.get_stats*, *median* and *variance*) is 
+    also included.
+    
+    The response has *ETag* and *Last-Modified* headers, based on the score
+    version and modification time: conditional requests for unchanged
+    scores get a *304 Not Modified* response, costing a single query
+    that does not load the score.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return http.HttpResponseNotAllowed(['GET', 'HEAD'])
+    handler = handlers.ratings.get_handler_for_label(content_type)
+    if handler is None:
+        return http.HttpResponseBadRequest('Bad or unregistered content type.')
+    scores = models.Score.objects.using(handler.score_db).filter(
+        content_type=ContentType.objects.get_for_model(handler.model), 
+        object_id=object_pk, key=key)
+    distribution = 'distribution' in request.GET
+    # conditional get: only version and modification time are read
+    try:
+        version, modified_at = scores.values_list('version', 
+            'modified_at')[0]
+    except IndexError:
+        version, modified_at = 0, None
+    etag = _get_etag(request, version, modified_at)
+    if _not_modified(request, etag, modified_at):
+        response = http.HttpResponseNotModified()
+    else:
+        data = {
+            'key': key, 
+            'average': 0, 
+            'total': 0, 
+            'num_votes': 0, 
+            'version': 0,
+            'modified_at': None,
+        }
+        try:
+            score = scores[0]
+        except IndexError:
+            score = None
+            modified_at = None
+        else:
+            version, modified_at = score.version, score.modified_at
+            data.update(average=score.average, total=score.total, 
+                num_votes=score.num_votes, version=version,
+                modified_at=modified_at.isoformat())
+        if distribution:
+            data['stats'] = data['median'] = data['variance'] = None
+            if score is not None and score.num_votes:
+                data['stats'] = score.get_stats(handler.vote_db).values()
+                data['median'] = score.median
+                data['variance'] = score.variance
+        etag = _get_etag(request, version, modified_at)
+        response = http.HttpResponse(json.dumps(data), 
+            content_type='application/json')
+    response['ETag'] = etag
+    if modified_at is not None:
+        response['Last-Modified'] = http_date(_get_timestamp(modified_at))
+    return response
+
+def scores(request, content_type, key):
+    """
+    Bulk scores view: return the scores of many target objects as json.
+    Object ids are given as a comma separated list in the *ids* 
+    querystring argument, e.g. ``?ids=1,2,3``, and can be at most
+    *settings.BULK_SCORES_MAX_IDS*.
+    
+    Scores are returned as lists of values in the order given by *fields*,
+    so that field names are not repeated for each object, e.g.::
+    
+        {
+            'key': 'main',
+            'fields': ['average', 'total', 'num_votes', 'version'],
+            'scores': {'1': [3.5, 7, 2, 4], '2': [0, 0, 0, 0], ...}
+        }
+    
+    If the querystring contains *votes*, the scores given by the current 
+    user (or anonymous voter) are also returned, as *votes*, mapping 
+    the ids of the voted objects with the scores.
+    
+    Scores are retreived using a single query, and user votes using 
+    another one.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return http.HttpResponseNotAllowed(['GET', 'HEAD'])
+    handler = handlers.ratings.get_handler_for_label(content_type)
+    if handler is None:
+        return http.HttpResponseBadRequest('Bad or unregistered content type.')
+    object_ids = _get_object_ids(request)
+    if object_ids is None:
+        return http.HttpResponseBadRequest('Invalid object ids.')
+    if len(object_ids) > settings.BULK_SCORES_MAX_IDS:
+        return http.HttpResponseBadRequest('Too many object ids.')
+    scores = dict.fromkeys(object_ids, [0] * len(SCORE_FIELDS))
+    if object_ids:
+        queryset = models.Score.objects.using(handler.score_db).filter(
+            content_type=ContentType.objects.get_for_model(handler.model),
+            key=key, object_id__in=object_ids)
+        for values in queryset.values_list('object_id', *SCORE_FIELDS):
+            scores[values[0]] = values[1:]
+    data = {'key': key, 'fields': SCORE_FIELDS, 'scores': scores}
+    if 'votes' in request.GET:
+        data['votes'] = {}
+        # the same voter used by the vote forms
+        user_or_cookies = handler._get_voter(request)
+        if object_ids and user_or_cookies is not None:
+            data['votes'] = handler.get_votes_for_many(object_ids, key,
+                user_or_cookies)
+    return http.HttpResponse(json.dumps(data, separators=(',', ':')), 
+        content_type='application/json')
+
+def events(request, content_type, key):
+    """
+    Live updates view: stream the changes of the scores of the target 
+    objects as Server-Sent Events, e.g.::
+    
+        event: score
+        data: {"content_type":"films.film","object_id":1,"key":"main",
+            "average":3.5,"total":7,"num_votes":2,"version":4}
+    
+    Object ids are given as a comma separated list in the *ids* 
+    querystring argument, e.g. ``?ids=1,2,3``, and can be at most
+    *settings.BULK_SCORES_MAX_IDS*.
+    
+    At most one event per target object is sent every
+    *settings.LIVE_UPDATES_INTERVAL* seconds: only the latest values of 
+    scores changing faster are sent.
+    
+    Each connection is served by a long running response: deploy this view
+    using asynchronous workers (e.g. gevent).
+    """
+    if request.method != 'GET':
+        return http.HttpResponseNotAllowed(['GET'])
+    handler = handlers.ratings.get_handler_for_label(content_type)
+    if handler is None:
+        return http.HttpResponseBadRequest('Bad or unregistered content type.')
+    object_ids = _get_object_ids(request)
+    if object_ids is None:
+        return http.HttpResponseBadRequest('Invalid object ids.')
+    if not object_ids or len(object_ids) > settings.BULK_SCORES_MAX_IDS:
+        return http.HttpResponseBadRequest('Too many or no object ids.')
+    content_type_id = ContentType.objects.get_for_model(handler.model).pk
+    subscription = ratings_events.bus.subscribe(
+        [(content_type_id, i, key) for i in object_ids])
+    response = http.StreamingHttpResponse(ratings_events.stream(
+        subscription, interval=settings.LIVE_UPDATES_INTERVAL),
+        content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+@ensure_csrf_cookie
+def hydrate(request):
+    """
+    Return as json the user dependent data of cacheable vote forms
+    (see *RatingHandler.cacheable_forms*), used by *ratings.js*.
+    
+    Forms are given as *target* querystring arguments, each one in the form
+    *app_label.model:object_pk:key*, e.g. ``?target=films.film:1:main``.
+    The response maps each target with its form data, e.g.::
+    
+        {
+            'forms': {
+                'films.film:1:main': {
+                    'timestamp': '1356994800',
+                    'security_hash': '...',
+                    'score': 4
+                }
+            }
+        }
+        
+    At most *settings.BULK_SCORES_MAX_IDS* targets can be requested at once.
+    The *csrf* cookie is also set, since cacheable pages cannot set it.
+    """
+    if request.method != 'GET':
+        return http.HttpResponseNotAllowed(['GET'])
+    targets = request.GET.getlist('target')
+    if len(targets) > settings.BULK_SCORES_MAX_IDS:
+        return http.HttpResponseBadRequest('Too many targets.')
+    groups = {}
+    for target in targets:
+        try:
+            label, object_pk, key = target.split(':', 2)
+            object_pk = int(object_pk)
+        except ValueError:
+            return http.HttpResponseBadRequest('Invalid target.')
+        handler = handlers.ratings.get_handler_for_label(label)
+        if handler is None:
+            return http.HttpResponseBadRequest(
+                'Bad or unregistered content type.')
+        groups.setdefault((label, key), set()).add(object_pk)
+    forms = {}
+    for (label, key), object_ids in groups.items():
+        handler = handlers.ratings.get_handler_for_label(label)
+        states = handler.get_vote_form_states(request, object_ids, key)
+        for object_pk, state in states.items():
+            forms['%s:%s:%s' % (label, object_pk, key)] = state
+    response = http.HttpResponse(json.dumps({'forms': forms}), 
+        content_type='application/json')
+    add_never_cache_headers(response)
+    return response
+
+def _get_object_ids(request):
+    # the set of object ids in the querystring, None if not valid
+    try:
+        return set(int(i) for i in request.GET.get('ids', '').split(',') 
+            if i)
+    except ValueError:
+        return None
+
+def _get_etag(request, version, modified_at):
+    # the entity tag of the score (and distribution) representation
+    value = u'%s:%s:%s:%s' % (request.path, version, 
+        modified_at and modified_at.isoformat(), 
+        'distribution' in request.GET)
+    return quote_etag(hashlib.md5(value.encode('utf-8')).hexdigest())
+
+def _get_timestamp(value):
+    # seconds since the epoch of the given datetime
+    if timezone.is_aware(value):
+        return calendar.timegm(value.utctimetuple())
+    return time.mktime(value.timetuple())
+
+def _not_modified(request, etag, modified_at):
+    """
+    Return True if the conditional headers of *request* match the given 
+    *etag* or modification time.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag.strip('"') in etags
+    if_modified_since = parse_http_date_safe(
+        request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_modified_since is not None and modified_at is not None:
+        return int(_get_timestamp(modified_at)) <= if_modified_since
+    return False
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Timings of the ratings hot paths, compared with the plain approaches
+they replace. Run from this directory::
+
+    python benchmarks.py
+"""
+import os
+import sys
+import time
+
+sys.path.append('..')
+os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.test.client import RequestFactory
+from django.utils.crypto import salted_hmac
+
+from ratings import forms, handlers, models, signals
+
+def best_of(func, repeat=5, number=100):
+    """
+    Return the best time, in seconds, of *repeat* runs of *number* calls
+    of *func*.
+    """
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            func(j)
+        timings.append(time.time() - start)
+    return min(timings)
+
+def security_hash():
+    key_salt = 'ratings.forms.VoteForm'
+    value = 'ratings.vote-%d-main-1300000000'
+    return [
+        ('salted_hmac', best_of(
+            lambda i: salted_hmac(key_salt, value % i).hexdigest())),
+        ('security_hmac', best_of(
+            lambda i: forms.security_hmac(key_salt, value % i).hexdigest())),
+    ]
+
+def signal_dispatch():
+    handlers.ratings.register(User)
+    handler = handlers.ratings.get_handler(User)
+    # an unsaved content type, so that no database is needed
+    content_type = ContentType(id=1, app_label='auth', model='user')
+    vote = models.Vote(key='main', score=3, content_type=content_type, 
+        object_id=1)
+    request = RequestFactory().post('/')
+    send = lambda i: handlers.ratings.send_signal(signals.vote_will_be_saved,
+        handler, vote, request)
+    direct = best_of(send, number=1000)
+    receiver = lambda sender, **kwargs: None
+    signals.vote_will_be_saved.connect(receiver, sender=models.Vote)
+    try:
+        dispatched = best_of(send, number=1000)
+    finally:
+        signals.vote_will_be_saved.disconnect(receiver, sender=models.Vote)
+        handlers.ratings.unregister(User)
+    return [('direct hooks', direct), ('signals', dispatched)]
+
+BENCHMARKS = [security_hash, signal_dispatch]
+
+if __name__ == "__main__":
+    for benchmark in BENCHMARKS:
+        print benchmark.__name__
+        for name, timing in benchmark():
+            print '    %-20s %.6fs' % (name, timing)
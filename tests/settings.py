@@ -1,6 +1,34 @@
-DATABASE_ENGINE = 'sqlite3'
-ROOT_URLCONF = ''
+import os
+import tempfile
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+    # votes and scores stored in separate databases
+    'votes': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+    'scores': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+    # a file backed database shared by concurrent threads
+    'stress': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'ratings_stress.db'),
+        'TEST_NAME': os.path.join(tempfile.gettempdir(), 
+            'test_ratings_stress.db'),
+        'OPTIONS': {'timeout': 30},
+    },
+}
+ROOT_URLCONF = 'ratings.urls'
 SITE_ID = 1
+SECRET_KEY = 'ratings-tests'
 INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
     'ratings',
 )